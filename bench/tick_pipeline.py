@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the daemon's per-tick data path: RRDTrafficCounter fed with
+# synthetic table snapshots, writing to rrdtool children that acknowledge
+# every command without doing anything.
+#
+# Results are written as one JSON object per scenario, e.g.
+#   python bench/tick_pipeline.py --ifaces 4 --rules 50,500 --foreign 100
+# Each scenario runs in a process of its own, so memory figures don't carry
+# over between them. Allocation figures are only reported where tracemalloc
+# can provide them (python 3.9 and later).
+
+import gc
+import json
+import logging
+import optparse
+import os.path
+import resource
+import subprocess
+import sys
+import time
+
+try:
+   import tracemalloc
+except ImportError:
+   tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from teucrium.constants import LAYOUT_PER_RULE, LAYOUT_MULTI_DS
+from teucrium.rrd_tc import RRDTrafficCounter
+
+
+# ---------------------------------------------------------------- synthetic table snapshots
+class Match:
+   def __init__(self, name, data):
+      self.name = name
+      self.data = data
+   def data_get_str(self):
+      return self.data
+
+
+class Entry:
+   """Stand-in for gonium xtables entries, providing the interface
+      RRDTrafficCounter uses."""
+   def __init__(self, target, chain, comment=None):
+      self.target = target
+      self.chain = chain
+      if (comment is None):
+         self.matches = []
+      else:
+         self.matches = [Match('comment', comment)]
+      self.counter_bytes = 0
+      self.counter_packets = 0
+   def get_target_str(self):
+      return self.target
+   def get_chain_name(self):
+      return self.chain
+
+
+class EntriesContainer:
+   def __init__(self, entries):
+      self.entries = entries
+
+
+class Snapshot:
+   def __init__(self, entries, ts):
+      self.xtge = EntriesContainer(entries)
+      self.ts = ts
+   def ts_get(self):
+      return self.ts
+
+
+class TableGenerator:
+   """Build table snapshots with our chains for ifaces interfaces in both
+      directions, rules counting rules in each, and foreign unrelated
+      rules in front of them."""
+   def __init__(self, ifaces, rules, foreign):
+      self.rules2ds = {}
+      self.chain2diriface = {}
+      for i in range(rules):
+         self.rules2ds['%d:%08x' % (i, i)] = 'r%d' % (i,)
+
+      entries = []
+      for i in range(foreign):
+         entries.append(Entry('ACCEPT', 'INPUT'))
+      for i in range(ifaces):
+         for (dir_, dirname) in ((0, 'in'), (1, 'out')):
+            chain = 'teuc_eth%d_%s' % (i, dirname)
+            self.chain2diriface[chain] = ('eth%d' % (i,), dir_)
+            entries.append(Entry('ERROR', chain))
+            for comment in sorted(self.rules2ds.keys()):
+               entries.append(Entry('', chain, comment))
+            entries.append(Entry('RETURN', chain))
+      self.entries = entries
+      self.counting = [e for e in entries if e.matches]
+
+   def snapshot_get(self, ts):
+      for e in self.counting:
+         e.counter_bytes += 1500
+         e.counter_packets += 1
+      return Snapshot(self.entries, ts)
+
+
+# ---------------------------------------------------------------- fake event dispatcher
+class NullChild:
+   def __init__(self, input_handler):
+      self.input_handler = input_handler
+      self.buffers_input = {0: ''}
+      self.lines = 0
+      self.bytes = 0
+   def send_data(self, data):
+      self.lines += 1
+      self.bytes += len(data)
+   def ack(self):
+      if not (self.lines):
+         return
+      self.buffers_input[0] += 'OK u:0.00 s:0.00 r:0.00\n' * self.lines
+      self.lines = 0
+      self.input_handler(self, 0)
+
+
+class NullED:
+   def __init__(self):
+      self.children = []
+   def ChildRunnerPopen4(self, cmd, termination_handler, finish=None, input_handler=None):
+      child = NullChild(input_handler)
+      self.children.append(child)
+      return child
+   def acks_deliver(self):
+      for child in self.children:
+         child.ack()
+
+
+# ---------------------------------------------------------------- measurement
+def peak_rss_get():
+   return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def allocs_measure(tc, snapshots):
+   """Feed snapshots to tc under tracemalloc; return (mean peak of memory
+      allocated during a tick, mean memory kept after a tick) in bytes, or
+      None if we can't tell."""
+   if ((tracemalloc is None) or not hasattr(tracemalloc, 'reset_peak')):
+      return None
+   peak_sum = 0
+   tracemalloc.start()
+   try:
+      mem_start = tracemalloc.get_traced_memory()[0]
+      for snapshot in snapshots:
+         mem_tick = tracemalloc.get_traced_memory()[0]
+         tracemalloc.reset_peak()
+         tc.xtp_data_process(None, snapshot)
+         peak_sum += tracemalloc.get_traced_memory()[1] - mem_tick
+      mem_end = tracemalloc.get_traced_memory()[0]
+   finally:
+      tracemalloc.stop()
+   return (float(peak_sum)/len(snapshots),
+      float(mem_end - mem_start)/len(snapshots))
+
+
+def scenario_run(ifaces, rules, foreign, ticks, commit_interval, layout,
+      children):
+   rss_start = peak_rss_get()
+   gen = TableGenerator(ifaces, rules, foreign)
+   ed = NullED()
+   tc = RRDTrafficCounter(ed, '/nonexistent/', gen.rules2ds,
+      gen.chain2diriface, commit_interval, rrd_layout=layout,
+      rrdtool_children=children)
+
+   times_commit = [0.0]
+   commit = tc.rrd_data_commit
+   def commit_timed():
+      t0 = time.time()
+      commit()
+      times_commit[0] += time.time() - t0
+      ed.acks_deliver()
+   tc.rrd_data_commit = commit_timed
+
+   # Warm up: build layout index and buffers.
+   ts = 1000000000
+   for i in range(commit_interval):
+      tc.xtp_data_process(None, gen.snapshot_get(ts))
+      ts += 1
+   times_commit[0] = 0.0
+
+   snapshots = [gen.snapshot_get(ts + i) for i in range(ticks)]
+   gc.collect()
+   gc.disable()
+   gc_count_start = gc.get_count()[0]
+   t0 = time.time()
+   for snapshot in snapshots:
+      tc.xtp_data_process(None, snapshot)
+   elapsed = time.time() - t0
+   gc_count = gc.get_count()[0] - gc_count_start
+   gc.enable()
+   
+   # Tracing slows allocations down, so do it in a separate, untimed run.
+   ts += ticks
+   allocs = allocs_measure(tc, [gen.snapshot_get(ts + i) for i in
+      range(ticks)])
+
+   rules_total = ifaces*2*rules
+   rv = {
+      'ifaces': ifaces,
+      'rules': rules,
+      'foreign': foreign,
+      'entries': len(gen.entries),
+      'ticks': ticks,
+      'commit_interval': commit_interval,
+      'layout': {LAYOUT_PER_RULE: 'per_rule', LAYOUT_MULTI_DS: 'multi_ds'}[layout],
+      'rrdtool_children': children,
+      'seconds': elapsed,
+      'ticks_per_sec': ticks/elapsed,
+      'us_per_rule': elapsed*1e6/(ticks*max(rules_total, 1)),
+      'commit_seconds': times_commit[0],
+      # Net count of gc-tracked objects, i.e. those kept around; objects
+      # freed again don't show up here.
+      'gc_objects_retained_per_tick': float(gc_count)/ticks,
+      'peak_rss_kib': peak_rss_get(),
+      # Growth of peak RSS while building and running the scenario
+      'rss_delta_kib': peak_rss_get() - rss_start,
+   }
+   if not (allocs is None):
+      # Memory allocated and freed again within a tick shows up in the
+      # former, but not the latter.
+      rv['alloc_peak_bytes_per_tick'] = allocs[0]
+      rv['alloc_net_bytes_per_tick'] = allocs[1]
+   return rv
+
+
+def scenario_spawn(**kwargs):
+   """Run scenario in a fresh process; return its result."""
+   p = subprocess.Popen((sys.executable, os.path.abspath(__file__),
+      '--scenario', json.dumps(kwargs)), stdout=subprocess.PIPE)
+   out = p.communicate()[0]
+   if (p.returncode):
+      raise StandardError('Scenario %r failed with rcode %r.' % (kwargs,
+         p.returncode))
+   return json.loads(out)
+
+
+def int_list(s):
+   return [int(x) for x in s.split(',')]
+
+
+def main():
+   op = optparse.OptionParser(usage='%prog [options]')
+   op.add_option('--ifaces', default='4', help='comma-separated list of interface counts', metavar='N[,N...]')
+   op.add_option('--rules', default='10,100', help='comma-separated list of counting rule counts', metavar='N[,N...]')
+   op.add_option('--foreign', default='50', help='comma-separated list of foreign rule counts', metavar='N[,N...]')
+   op.add_option('--ticks', type='int', default=1000, help='number of ticks to measure')
+   op.add_option('--commit-interval', default='4', help='comma-separated list of commit intervals', metavar='N[,N...]')
+   op.add_option('--layout', type='choice', choices=('per_rule', 'multi_ds'), default='per_rule')
+   op.add_option('--children', type='int', default=1, help='number of (null) rrdtool children')
+   op.add_option('-o', '--output', help='file to append results to, instead of printing them', metavar='FILE')
+   op.add_option('--scenario', help=optparse.SUPPRESS_HELP)
+   (options, args) = op.parse_args()
+   logging.basicConfig(level=logging.WARNING)
+   layout = {'per_rule': LAYOUT_PER_RULE, 'multi_ds': LAYOUT_MULTI_DS}[options.layout]
+
+   if not (options.scenario is None):
+      kwargs = {}
+      for (key, val) in json.loads(options.scenario).items():
+         kwargs[str(key)] = val
+      sys.stdout.write(json.dumps(scenario_run(**kwargs)))
+      return
+
+   results = []
+   for ifaces in int_list(options.ifaces):
+      for rules in int_list(options.rules):
+         for foreign in int_list(options.foreign):
+            for ci in int_list(options.commit_interval):
+               results.append(scenario_spawn(ifaces=ifaces, rules=rules,
+                  foreign=foreign, ticks=options.ticks, commit_interval=ci,
+                  layout=layout, children=options.children))
+
+   if (options.output is None):
+      out = sys.stdout
+   else:
+      out = open(options.output, 'a')
+   for result in results:
+      out.write(json.dumps(result, sort_keys=True) + '\n')
+   out.flush()
+
+
+if (__name__ == '__main__'):
+   main()
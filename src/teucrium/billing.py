@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Percentile billing reports, read directly from rrd files
+
+import logging
+import math
+import os.path
+import sys
+import time
+
+try:
+   import multiprocessing
+except ImportError:
+   multiprocessing = None
+
+import numpy
+
+from rrd_fn import RRDFileNamer
+from rrd_reader import RRDFile, RRDFormatError
+from rrd_writer import RRDCachedClient
+
+CF = 'AVERAGE'
+
+logger = logging.getLogger('billing')
+log = logger.log
+
+
+def month_range_get(month=None):
+   """Return (start, end) timestamps of month 'YYYY-MM' in local time; by
+      default, of the last complete month."""
+   if (month is None):
+      (year, mon) = time.localtime()[:2]
+      (year, mon) = divmod(year*12 + mon - 2, 12)
+      mon += 1
+   else:
+      (year, mon) = [int(s) for s in month.split('-')]
+      if not (1 <= mon <= 12):
+         raise ValueError('Invalid month %r.' % (month,))
+   (year_next, mon_next) = divmod(year*12 + mon, 12)
+   start = time.mktime((year, mon, 1, 0, 0, 0, 0, 0, -1))
+   end = time.mktime((year_next, mon_next + 1, 1, 0, 0, 0, 0, 0, -1))
+   return (int(start), int(end))
+
+
+def percentile_nearest_rank(values, p):
+   """Return p-th percentile of 1d array values by the nearest-rank method
+      used for burstable billing: the smallest value that at least p percent
+      of all values are less than or equal to. NaNs are ignored; returns NaN
+      if nothing else is left."""
+   values = numpy.sort(values[~numpy.isnan(values)])
+   if not (len(values)):
+      return numpy.nan
+   return values[max(int(math.ceil(p/100.0*len(values))) - 1, 0)]
+
+
+def archive_choose(rrd, start, interval, cf=CF):
+   """Return the archive of RRDFile rrd to bill from.
+
+   We prefer the coarsest archive of consolidation function cf whose step
+   divides interval and that reaches back to start, then the one of those
+   reaching back furthest; if no step divides interval, the finest one."""
+   archives = [a for a in rrd.archives if (a.cf == cf)]
+   if not (archives):
+      raise RRDFormatError('%r has no %s archive.' % (rrd.fn, cf))
+   fitting = [a for a in archives if (interval % a.step == 0)]
+   if not (fitting):
+      archives.sort(key=lambda a: a.step)
+      return archives[0]
+   covering = [a for a in fitting if (a.start_get() <= start)]
+   if (covering):
+      covering.sort(key=lambda a: -a.step)
+      return covering[0]
+   fitting.sort(key=lambda a: a.start_get())
+   return fitting[0]
+
+
+def billing_job_run(job):
+   """Compute billing percentiles for some DS of one rrd file.
+
+   job: (filename, rrdcached address, [(key, rrd ds name), ...], start, end,
+         interval, p)
+   Rates are averaged over interval-sized buckets of the time range (start,
+   end]; buckets without data are left out.
+   Returns (filename, [(key, bucket count with data, bucket count, p-th
+   percentile), ...], error message or None)."""
+   (fn, rrdcached_address, series, start, end, interval, p) = job
+   try:
+      if not (rrdcached_address is None):
+         rrdcached = RRDCachedClient(rrdcached_address)
+         rrdcached.command_send('FLUSH %s' % (rrdcached.fn_get(fn),))
+      rrd = RRDFile(fn)
+      arc = archive_choose(rrd, start, interval)
+      (ts, values) = arc.range_get(start, end)
+      count = (end - start + interval - 1)//interval
+      idxs = (ts - start - 1)//interval
+      rv = []
+      for (key, ds_name) in series:
+         col = values[:,rrd.ds_index_get(ds_name)]
+         valid = ~numpy.isnan(col)
+         sums = numpy.bincount(idxs[valid], col[valid], count)
+         counts = numpy.bincount(idxs[valid], None, count)
+         means = sums[counts > 0]/counts[counts > 0]
+         rv.append((key, len(means), count, percentile_nearest_rank(means, p)))
+      rrd.close()
+   except (EnvironmentError, RRDFormatError):
+      return (fn, None, str(sys.exc_info()[1]))
+   return (fn, rv, None)
+
+
+def billing_jobs_get(set_idx, targets, start, end, interval, p):
+   """Return billing jobs for targets as returned by RRDQuery.targets_get();
+      keys of the results are (set_idx, iface, dir_, ds) tuples. Targets
+      whose files don't exist are skipped."""
+   fn_series = {}
+   fns = []
+   missing = set()
+   for ((iface, dir_, ct, ds), fn, ds_name, rrdcached_address) in targets:
+      if (fn in missing):
+         continue
+      if not ((fn in fn_series) or os.path.exists(fn)):
+         missing.add(fn)
+         continue
+      if not (fn in fn_series):
+         fns.append((fn, rrdcached_address))
+         fn_series[fn] = []
+      fn_series[fn].append(((set_idx, iface, dir_, ds), ds_name))
+   if (missing):
+      log(30, 'Skipping %d missing rrd files of rule set %d.' % (len(missing),
+         set_idx))
+   return [(fn, rrdcached_address, fn_series[fn], start, end, interval, p)
+      for (fn, rrdcached_address) in fns]
+
+
+def billing_jobs_run(jobs, processes=1):
+   """Run billing jobs, using up to processes worker processes.
+
+   processes=0 means one per cpu. Failing jobs are logged and don't keep the
+   others from being run; returns (list of results sorted by key, set of
+   filenames of failed jobs)."""
+   if ((processes != 1) and (multiprocessing is None)):
+      log(30, 'multiprocessing module not available; reading files serially.')
+      processes = 1
+   if (processes == 0):
+      processes = multiprocessing.cpu_count()
+
+   if ((processes == 1) or (len(jobs) < 2)):
+      results = map(billing_job_run, jobs)
+   else:
+      pool = multiprocessing.Pool(min(processes, len(jobs)))
+      try:
+         results = list(pool.imap_unordered(billing_job_run, jobs, 16))
+      finally:
+         pool.terminate()
+
+   rv = []
+   failed = set()
+   for (fn, series, error) in results:
+      if (error is None):
+         rv.extend(series)
+         continue
+      log(40, 'Failed to read %r: %s' % (fn, error))
+      failed.add(fn)
+   rv.sort(key=lambda r: r[0])
+   return (rv, failed)
+
+
+def billing_csv_write(f, results, p):
+   f.write('set,iface,dir,ds,samples,buckets,p%g_bytes_per_s,p%g_bits_per_s\n'
+      % (p, p))
+   for ((set_idx, iface, dir_, ds), samples, buckets, val) in results:
+      f.write('%d,%s,%s,%s,%d,%d,%r,%r\n' % (set_idx, iface,
+         RRDFileNamer.FN_DIR[dir_], ds, samples, buckets, float(val),
+         float(val)*8))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Feeding recorded samples back through RRDTrafficCounter
+
+import logging
+import time
+
+from sample_log import SampleLogReader
+
+
+def capture_first_ts_get(fn):
+   """Return timestamp of first tick in sample log fn, or None if there is
+      none."""
+   f = open(fn, 'rb')
+   try:
+      for (ts, samples) in SampleLogReader(f):
+         return ts
+   finally:
+      f.close()
+   return None
+
+
+class CaptureReplayer:
+   """Replay a sample log into an RRDTrafficCounter.
+
+   Ticks keep their recorded timestamps; speed determines how fast they are
+   replayed relative to the time between them (e.g. 1000 for 1000 times
+   real time), with 0 meaning as fast as possible. Either way, replaying
+   waits for each commit to be acknowledged by the rrd writer before
+   continuing."""
+   logger = logging.getLogger('CaptureReplayer')
+   log = logger.log
+   def __init__(self, ed, rrdtc, fn, speed, done_handler):
+      self.ed = ed
+      self.rrdtc = rrdtc
+      self.fn = fn
+      self.speed = speed
+      self.done_handler = done_handler
+      self.f = open(fn, 'rb')
+      self.reader = SampleLogReader(self.f)
+      self.ticks = iter(self.reader)
+      self.tick_count = 0
+      self.ts_base = None
+      self.rt_base = None
+      self.tick_next = self.tick_get()
+      self.ed.Timer(0, self.step, self)
+
+   def tick_get(self):
+      try:
+         return next(self.ticks)
+      except StopIteration:
+         return None
+
+   def step_schedule(self):
+      # Barrier callbacks can be called synchronously; don't recurse.
+      self.ed.Timer(0, self.step, self)
+
+   def step(self):
+      now = time.time()
+      while not (self.tick_next is None):
+         (ts, samples) = self.tick_next
+         if (self.ts_base is None):
+            self.ts_base = ts
+            self.rt_base = now
+         if (self.speed):
+            delay = self.rt_base + float(ts - self.ts_base)/self.speed - now
+            if (delay > 0):
+               self.ed.Timer(delay, self.step, self)
+               return
+
+         self.tick_next = self.tick_get()
+         self.tick_count += 1
+         if (self.rrdtc.rrd_tick_replay(ts, samples)):
+            self.rrdtc.writer.barrier(self.step_schedule)
+            return
+
+      self.f.close()
+      if (self.reader.truncated):
+         self.log(30, 'Ignoring truncated record at end of %r.' % (self.fn,))
+      self.log(20, 'Replayed %d ticks from %r.' % (self.tick_count, self.fn))
+      self.rrdtc.shutdown()
+      self.rrdtc.writer.barrier(self.done_handler)
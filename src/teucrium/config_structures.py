@@ -15,15 +15,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import logging
 import os, os.path
+import re
+import socket
+import subprocess
+import sys
+import zlib
 
 from gonium.linux.xtables import XTablesIP, XTablesIP6
 
 from constants import *
 from rrd_tc import RRDTrafficCounter
+from capture_replay import CaptureReplayer, capture_first_ts_get
 from rrd_creator import RRASpec, RRDCreator
 from rrd_grapher import RRDGrapher
+from rrd_migrate import RRDMigrator
+from rrd_writer import RRDCachedWriter
+from ipset import IPSetError, ipset_create
+from nfacct import NFAcct, NFAcctError, NFACCT_NAME_MAX
+from nft import NFTCounters, NFTError, NFT_FAMILY, nft_script_run
 
 POS_LOCAL = 0
 POS_REMOTE = 1
@@ -37,6 +49,8 @@ class LRPort:
    """Abstract baseclass for LocalPort, RemotePort"""
    FMT_SRC = '--sport %s'
    FMT_DST = '--dport %s'
+   NFT_FMT_SRC = 'th sport %s'
+   NFT_FMT_DST = 'th dport %s'
    def __init__(self, port):
       self.port = port
       assert(self.POS in (POS_LOCAL, POS_REMOTE))
@@ -52,6 +66,24 @@ class LRPort:
       if (self.POS == POS_LOCAL):
          return self.FMT_SRC % (self.port,)
       return self.FMT_DST % (self.port,)
+   
+   def nft_port_get(self):
+      ports = [p.replace(':', '-') for p in str(self.port).split(',')]
+      if (len(ports) == 1):
+         return ports[0]
+      return '{ %s }' % (', '.join(ports),)
+   
+   def nft_ms_in(self):
+      """Return nft match expression for incoming traffic"""
+      if (self.POS == POS_LOCAL):
+         return self.NFT_FMT_DST % (self.nft_port_get(),)
+      return self.NFT_FMT_SRC % (self.nft_port_get(),)
+   
+   def nft_ms_out(self):
+      """Return nft match expression for outgoing traffic"""
+      if (self.POS == POS_LOCAL):
+         return self.NFT_FMT_SRC % (self.nft_port_get(),)
+      return self.NFT_FMT_DST % (self.nft_port_get(),)
 
 class LRMultiport:
    FMT_SRC = '--sports %s'
@@ -71,8 +103,27 @@ class RemotePort(LRPort):
 class RemotePorts(LRMultiport, RemotePort):
    pass
 
+class IPSetMatch:
+   """Match packets whose local or remote address is in an ipset"""
+   FMT = '-m set --match-set %s %s'
+   def __init__(self, setname, pos):
+      self.setname = setname
+      self.pos = pos
+      assert(pos in (POS_LOCAL, POS_REMOTE))
+   
+   def xt_ms_in(self):
+      if (self.pos == POS_LOCAL):
+         return self.FMT % (self.setname, 'dst')
+      return self.FMT % (self.setname, 'src')
+   
+   def xt_ms_out(self):
+      if (self.pos == POS_LOCAL):
+         return self.FMT % (self.setname, 'src')
+      return self.FMT % (self.setname, 'dst')
+
 class XTRule:
    XT_ARG_FMT = '%s -m comment --comment %s %s'
+   COMMENT_FMT = '%s:%08x'
    DIRS = {
       DIR_IN: 'xt_ms_in',
       DIR_OUT:'xt_ms_out'
@@ -126,11 +177,55 @@ class XTRule:
          return getattr(match,methname)()
       return str(match)
    
-   def xt_argstring_get(self, chain, dir_):
-      argstring = ' '.join([self.match2string(m, dir_) for m in self.matches])
+   def xt_rulestring_get(self, dir_):
+      rv = ' '.join([self.match2string(m, dir_) for m in self.matches])
       if (self.target):
-         argstring += ' -j %s' % (self.target,)
-      return self.XT_ARG_FMT % (chain, self.id, argstring)
+         rv += ' -j %s' % (self.target,)
+      return rv
+   
+   def xt_comment_get(self):
+      """Return NF comment string identifying this rule.
+      
+      This includes a checksum of the rule's matches and target, so rules
+      whose specification has changed in the config can be told apart from
+      their old instances in the NF table."""
+      spec = '\n'.join([self.xt_rulestring_get(dir_) for dir_ in (DIR_IN, DIR_OUT)])
+      return self.COMMENT_FMT % (self.id, zlib.crc32(spec) & 0xffffffff)
+   
+   def xt_argstring_get(self, chain, dir_, pos=None):
+      if not (pos is None):
+         chain = '%s %d' % (chain, pos)
+      return self.XT_ARG_FMT % (chain, self.xt_comment_get(),
+         self.xt_rulestring_get(dir_))
+
+class IPSetRule(XTRule):
+   """Rule having the kernel count traffic per element of an ipset.
+   
+   The rule itself doesn't have a target, so traffic continues on to the
+   other rules of its chain."""
+   def __init__(self, setname, iface_spec, dir_, pos=POS_LOCAL,
+         settype='hash:ip', id=None, rule_id_get=None):
+      XTRule.__init__(self, setname, (IPSetMatch(setname, pos),), id=id,
+         rule_id_get=rule_id_get, target='')
+      self.setname = setname
+      self.iface_spec = iface_spec
+      self.dir_ = dir_
+      self.settype = settype
+
+class XTGotoRule(XTRule):
+   """Rule sending packets of one protocol on to a sub-chain of a
+      protocol-tree chain layout.
+   
+   This uses '-g' rather than '-j', so a RETURN in the sub-chain (or
+   reaching its end) returns from the chain the rule is in, as it would
+   have without the sub-chain."""
+   ID_FMT = 'teuc_p_%s'
+   def __init__(self, proto, chain):
+      XTRule.__init__(self, proto, ('-p %s' % (proto,),), id=self.ID_FMT %
+         (proto,), target=chain)
+   
+   def xt_rulestring_get(self, dir_):
+      return '%s -g %s' % (' '.join(self.matches), self.target)
 
 class XTCall:
    logger = logging.getLogger('XTCall')
@@ -155,6 +250,102 @@ class XTCall:
          raise StandardError('os.system(%s) failed. rcode: %r' % (cs,rcode))
 
 
+class XTRestore:
+   """Commit a sequence of XTCalls to one table through a single
+      {ip,ip6}tables-restore transaction."""
+   logger = logging.getLogger('XTRestore')
+   log = logger.log
+   def __init__(self, xt_save_binary, xt_restore_binary, tablename, xtcalls):
+      self.xt_save_binary = xt_save_binary
+      self.xt_restore_binary = xt_restore_binary
+      self.tablename = tablename
+      self.xtcalls = xtcalls
+
+   @staticmethod
+   def rulespec_normalize(rulespec):
+      return ' '.join(rulespec.split())
+
+   def xt_state_get(self):
+      """Return (chains, rules) currently present in our table."""
+      cmd = (self.xt_save_binary, '-t', self.tablename)
+      self.log(20, 'Executing %r.' % (' '.join(cmd),))
+      p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+      (data, _) = p.communicate()
+      if (p.returncode):
+         raise StandardError('%r failed. rcode: %r' % (cmd, p.returncode))
+
+      chains = set()
+      rules = set()
+      for line in data.split('\n'):
+         if (line.startswith(':')):
+            chains.add(line[1:].split()[0])
+         elif (line.startswith('-A ')):
+            (chain, rulespec) = (line[3:].split(' ', 1) + [''])[:2]
+            rules.add((chain, self.rulespec_normalize(rulespec)))
+      return (chains, rules)
+
+   def payload_get(self, chains, rules):
+      """Build restore payload from our calls.
+
+      Calls marked errors_ignore are only expected to fail if the chain or rule
+      they refer to is (not) present; since a single failing line would abort
+      the entire transaction, those are dropped here if the tracked table state
+      says they would fail."""
+      chains = set(chains)
+      rules = set(rules)
+      chains_new = []
+      lines = []
+      for xtc in self.xtcalls:
+         (op, arg) = (xtc.argstring.split(' ', 1) + [''])[:2]
+         if (op == '-N'):
+            if (arg in chains):
+               if not (xtc.errors_ignore):
+                  raise StandardError('Chain %r already exists.' % (arg,))
+               continue
+            chains.add(arg)
+            chains_new.append(arg)
+            continue
+
+         (chain, rulespec) = (arg.split(' ', 1) + [''])[:2]
+         if (op == '-F'):
+            for rule in list(rules):
+               if (rule[0] == chain):
+                  rules.remove(rule)
+         elif (op == '-D'):
+            rule = (chain, self.rulespec_normalize(rulespec))
+            if (rule in rules):
+               rules.remove(rule)
+            elif (xtc.errors_ignore):
+               continue
+         elif (op == '-A'):
+            rules.add((chain, self.rulespec_normalize(rulespec)))
+         elif (op == '-I'):
+            (pos, rulespec) = (rulespec.split(' ', 1) + [''])[:2]
+            if not (pos.isdigit()):
+               rulespec = '%s %s' % (pos, rulespec)
+            rules.add((chain, self.rulespec_normalize(rulespec)))
+         lines.append(xtc.argstring)
+
+      rv = ['*%s' % (self.tablename,)]
+      rv.extend([':%s - [0:0]' % (chain,) for chain in chains_new])
+      rv.extend(lines)
+      rv.append('COMMIT')
+      rv.append('')
+      return '\n'.join(rv)
+
+   def xt_call(self):
+      (chains, rules) = self.xt_state_get()
+      payload = self.payload_get(chains, rules)
+      cmd = (self.xt_restore_binary, '--noflush')
+      self.log(20, 'Executing %r with %d payload lines.' % (' '.join(cmd),
+         payload.count('\n')))
+      self.log(10, 'Restore payload: %r' % (payload,))
+      p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+      p.communicate(payload)
+      if (p.returncode):
+         raise StandardError('%r failed. rcode: %r' % (cmd, p.returncode))
+
+
 class XTTrafficRules:
    """Abstract baseclass for *TTrafficRules classes"""
    DIRS = {
@@ -162,8 +353,12 @@ class XTTrafficRules:
       DIR_OUT: ('out', '-o')
    }
    RULE_ID_FMT = 'teuc_%d'
+   RRD_DS_RE = re.compile('^[a-zA-Z0-9_]{1,19}$')
    CHAIN_FMT_BASE = 'teuc_%s'
    CHAIN_FMT = CHAIN_FMT_BASE % ('%s_%s',)
+   CHAIN_LEN_MAX = 28
+   NFACCT_FMT = 'teuc_%s_%s_%s'
+   NFACCT_MATCH_FMT = '-m nfacct --nfacct-name %s'
    
    # Which non-teuc chains to hook into to get traffic
    EXT_CHAINS = {
@@ -188,7 +383,11 @@ class XTTrafficRules:
          graph_img_width=512, graph_img_height=256,
          rrd_heartbeat=None, rrd_max='U',
          rra_specs=None, graph_arguments=(),
-         commit_interval=1):
+         commit_interval=1, rrdcached_address=None,
+         rrd_layout=LAYOUT_PER_RULE, journal_filename=None,
+         journal_sync_interval=16, rrdtool_children=1, rrdtool_inflight_max=32,
+         chain_layout=CHAIN_LAYOUT_FLAT,
+         counter_backend=COUNTER_BACKEND_XTABLES):
       """Initialize instance.
       
       Arguments:
@@ -196,6 +395,20 @@ class XTTrafficRules:
       interface_specs: sequence of interface-strings to match against; e.g. ('eth+', 'ppp0')
       step: RRD step value (in seconds)
       rrddb_base_filename: Filename prefix to use for rrd files
+      rrd_layout: LAYOUT_PER_RULE to keep data of each rule in its own rrd
+            file, or LAYOUT_MULTI_DS to keep the data of all rules for each
+            (interface, direction, counter type) in one file, with one DS per
+            rule; the latter requires ds values to be valid rrd DS names
+      chain_layout: CHAIN_LAYOUT_FLAT to put all rules into one chain per
+            (interface, direction), or CHAIN_LAYOUT_PROTO_TREE to move rules
+            starting with a protocol match ('-p tcp', ...) into one sub-chain
+            per protocol, so packets only walk the rules for their protocol
+            and those without a protocol match; counting results are the same
+      counter_backend: COUNTER_BACKEND_XTABLES to have the daemon read
+            counters from the NF table, or COUNTER_BACKEND_NFACCT to have each
+            rule count into an nfnetlink_acct object per (interface,
+            direction, ds), which can be read with one much smaller netlink
+            dump; the latter requires the xt_nfacct module
       
       # The following parameters are only relevant for graphing mode
       graph_base_filename: filename prefix for generated images
@@ -215,12 +428,34 @@ class XTTrafficRules:
       # The following parameters are only relevant for daemon (data collection) mode
       commit_interval: Number of data points to collect before writing to rrd;
             increase to reduce hd load.
+      journal_filename: Filename prefix for a write-ahead journal of
+            collected data; data not yet written to rrd when the daemon dies
+            is recovered from it on next startup. Must be unique for each
+            instance.
+      journal_sync_interval: Number of data points to collect between
+            fsync() calls on the journal; data points since the last one may
+            be lost if the host crashes
+      rrdtool_children: Number of rrdtool processes to spread rrd file
+            updates over
+      rrdtool_inflight_max: Maximum number of unacknowledged updates per
+            rrdtool process; further updates are held back and merged
+      
+      # The following parameter is relevant for all rrd-accessing modes
+      rrdcached_address: UNIX socket of rrdcached instance to write rrd data
+            through; graphing and rrd db creation will then make rrdcached
+            flush or drop cached data as needed.
       """
       if not (hasattr(self, 'xt_binary')):
          raise StandardError('%r should not be instantiated; use a subclass' % (self.__class__))
       
       if not (tablename in self.EXT_CHAINS):
          raise ValueError("Table %r isn't supported." % (tablename,))
+      if (rrdtool_children < 1):
+         raise ConfigError('rrdtool_children needs to be at least 1; got %r.'
+            % (rrdtool_children,))
+      if (rrdtool_inflight_max < 1):
+         raise ConfigError('rrdtool_inflight_max needs to be at least 1; got '
+            '%r.' % (rrdtool_inflight_max,))
       
       if (rrd_heartbeat is None):
          rrd_heartbeat = step
@@ -228,12 +463,16 @@ class XTTrafficRules:
          rra_specs = []
       
       self.rules = []
+      self.ipsets = []
       self.rule_ids = set()
       self.rule_idnum_last = 0
       self.interface_specs = interface_specs
       self.tablename = tablename
       self.step = step
       self.rrddb_base_filename = rrddb_base_filename
+      self.rrd_layout = rrd_layout
+      self.chain_layout = chain_layout
+      self.counter_backend = counter_backend
       
       self.rrd_heartbeat = rrd_heartbeat
       self.rrd_max = rrd_max
@@ -248,15 +487,47 @@ class XTTrafficRules:
       self.graph_arguments = graph_arguments
       
       self.commit_interval = commit_interval
+      self.journal_filename = journal_filename
+      self.journal_sync_interval = journal_sync_interval
+      self.rrdtool_children = rrdtool_children
+      self.rrdtool_inflight_max = rrdtool_inflight_max
+      self.rrdcached_address = rrdcached_address
 # ---------------------------------------------------------------- configuration interface
    def rule_add(self, *args, **kwargs):
       """Add traffic counting rule to this instance. See XTRule.__init__() for
          list and explanation of arguments."""
       kwargs['rule_id_get'] = self.rule_id_get
       rule = XTRule(*args, **kwargs)
+      if ((self.rrd_layout == LAYOUT_MULTI_DS) and
+         (self.RRD_DS_RE.match(rule.ds) is None)):
+         raise ConfigError('ds %r is not a valid rrd DS name, as required by '
+            'LAYOUT_MULTI_DS.' % (rule.ds,))
       self.rules.append(rule)
       self.rule_ids.add(rule.id)
 
+   def ipset_add(self, setname, iface_spec, dir_, pos=POS_LOCAL,
+         settype='hash:ip', id=None):
+      """Count traffic on interface iface_spec in direction dir_ per element
+         of ipset setname.
+      
+      pos: whether set elements are local (POS_LOCAL) or remote (POS_REMOTE)
+            addresses
+      settype: ipset type to create the set with, if it doesn't exist yet;
+            the set needs to have been created with the 'counters' option
+      
+      Each element's counters are stored in their own rrd files, which are
+      created as elements show up."""
+      if not (iface_spec in self.interface_specs):
+         raise ConfigError('Unknown interface spec %r.' % (iface_spec,))
+      if not (dir_ in self.DIRS):
+         raise ConfigError('Invalid direction %r.' % (dir_,))
+      if (setname in [ips.setname for ips in self.ipsets]):
+         raise ConfigError('ipset %r is already in use.' % (setname,))
+      ips = IPSetRule(setname, iface_spec, dir_, pos, settype, id=id,
+         rule_id_get=self.rule_id_get)
+      self.ipsets.append(ips)
+      self.rule_ids.add(ips.id)
+   
    def rra_add(self, *args, **kwargs):
       """Add RRA spec; this is only relevant for rrdcreate() mode. Arguments
          are as to rrdtool::rrdcreate::RRA. (1.3.1)"""
@@ -291,6 +562,138 @@ class XTTrafficRules:
       return [self.xtcall('-D ' + argstring, True),
       self.xtcall('-A ' + argstring, *args, **kwargs)]
    
+   def nfacct_name_get(self, iface_spec, dir_, ds):
+      rv = self.NFACCT_FMT % (iface_spec, self.get_dirname(dir_), ds)
+      if (len(rv) >= NFACCT_NAME_MAX):
+         raise ConfigError('Accounting object name %r is too long.' % (rv,))
+      return rv
+   
+   def nfacct_rule_get(self, rule, iface_spec, dir_):
+      """Return copy of rule that also counts into its accounting object."""
+      match = self.NFACCT_MATCH_FMT % (self.nfacct_name_get(iface_spec, dir_,
+         rule.ds),)
+      return XTRule(rule.ds, tuple(rule.matches) + (match,), id=rule.id,
+         target=rule.target, color=rule.color, legend=rule.legend)
+   
+   def nfacct_names_get(self):
+      """Return dict mapping names of our accounting objects to (iface_spec,
+         dir_, ds) tuples."""
+      rv = {}
+      for (iface_spec, dir_) in self.xt_dirifaces_get():
+         for rule in self.rules:
+            rv[self.nfacct_name_get(iface_spec, dir_, rule.ds)] = (iface_spec,
+               dir_, rule.ds)
+      return rv
+   
+   def nfacct_create(self):
+      """Create our accounting objects, where they don't exist yet."""
+      if (self.counter_backend != COUNTER_BACKEND_NFACCT):
+         return
+      nfa = NFAcct()
+      try:
+         names_live = set([obj[0] for obj in nfa.dump()])
+         names = list(self.nfacct_names_get().keys())
+         names.sort()
+         for name in names:
+            if not (name in names_live):
+               nfa.obj_add(name)
+      except (NFAcctError, EnvironmentError):
+         raise ConfigError('Unable to create accounting objects: %s' %
+            (sys.exc_info()[1],))
+   
+   def counter_cls_get(self):
+      """Return class to read counters through; see xt_cls."""
+      if (self.counter_backend == COUNTER_BACKEND_NFACCT):
+         return NFAcct
+      return self.xt_cls
+   
+   def xt_chain_rules_get(self, iface_spec, dir_):
+      """Return rules to put into the chain for iface_spec and dir_, in
+         order."""
+      rules = self.rules
+      if (self.counter_backend == COUNTER_BACKEND_NFACCT):
+         rules = [self.nfacct_rule_get(rule, iface_spec, dir_) for rule in rules]
+      return [ips for ips in self.ipsets if ((ips.iface_spec == iface_spec)
+         and (ips.dir_ == dir_))] + rules
+   
+   @staticmethod
+   def rule_proto_get(rule):
+      """Return (name, number) of the protocol rule is restricted to by its
+         leading match, or None if it isn't restricted to one protocol in a
+         way we can tell."""
+      if not (rule.matches):
+         return None
+      match = rule.matches[0]
+      if not (isinstance(match, str)):
+         return None
+      tokens = match.split()
+      if ((len(tokens) != 2) or not (tokens[0] in ('-p', '--protocol'))):
+         return None
+      name = tokens[1].lower()
+      if (name.isdigit()):
+         return (name, int(name))
+      if (name == 'all'):
+         return None
+      try:
+         return (name, socket.getprotobyname(name))
+      except socket.error:
+         return None
+   
+   def xt_chains_get(self, iface_spec, dir_):
+      """Return sequence of (chainname, rules) for iface_spec and dir_, in the
+         order they need to be created in.
+      
+      The last element is the chain jumped to from the direction chain. With
+      CHAIN_LAYOUT_PROTO_TREE, it is preceded by one sub-chain per protocol
+      that any rule is restricted to, holding those rules plus all rules
+      without a protocol restriction in their original order; the main chain
+      holds gotos to them, followed by the rules without a protocol
+      restriction. Each packet thus sees the same sequence of rules that
+      could match it as it would in the flat layout."""
+      chainname = self.CHAIN_FMT % (iface_spec, self.get_dirname(dir_))
+      rules = self.xt_chain_rules_get(iface_spec, dir_)
+      if (self.chain_layout != CHAIN_LAYOUT_PROTO_TREE):
+         return [(chainname, rules)]
+      
+      head = [rule for rule in rules if (rule in self.ipsets)]
+      rules = [rule for rule in rules if not (rule in self.ipsets)]
+      protos = []
+      proto2name = {}
+      rule_protos = []
+      for rule in rules:
+         proto = self.rule_proto_get(rule)
+         if (proto is None):
+            rule_protos.append(None)
+            continue
+         (name, num) = proto
+         if not (num in proto2name):
+            protos.append(num)
+            proto2name[num] = name
+         rule_protos.append(num)
+      
+      rv = []
+      gotos = []
+      for num in protos:
+         name = proto2name[num]
+         sub_chainname = '%s_%s' % (chainname, name)
+         if (len(sub_chainname) > self.CHAIN_LEN_MAX):
+            raise ConfigError('Chain name %r is too long.' % (sub_chainname,))
+         rv.append((sub_chainname, [rule for (rule, rp) in zip(rules,
+            rule_protos) if (rp in (num, None))]))
+         gotos.append(XTGotoRule(name, sub_chainname))
+      rv.append((chainname, head + gotos + [rule for (rule, rp) in zip(rules,
+         rule_protos) if (rp is None)]))
+      return rv
+   
+   def ipsets_create(self):
+      """Create our ipsets, where they don't exist yet."""
+      for ips in self.ipsets:
+         try:
+            ipset_create(ips.setname, ips.settype)
+         except IPSetError:
+            raise ConfigError('Unable to create ipset %r: %s' % (ips.setname,
+               sys.exc_info()[1]))
+   
    def xt_dirifaces_get(self):
       for iface_spec in self.interface_specs:
          for dir_ in self.DIRS:
@@ -303,14 +706,14 @@ class XTTrafficRules:
          rv += self.xt_callstring_chainmake_get(chain, flush=False)
       
       for (iface_spec, dir_) in self.xt_dirifaces_get():
-         chainname = self.CHAIN_FMT % (iface_spec, self.get_dirname(dir_))
-         rv += self.xt_callstring_chainmake_get(chainname)
+         for (chainname, rules) in self.xt_chains_get(iface_spec, dir_):
+            rv += self.xt_callstring_chainmake_get(chainname)
+            for rule in rules:
+               rv += self.xtcall_countrule(rule.xt_argstring_get(chainname, dir_))
+         
          rv += (self.xtcall_countrule('%s %s %s -j %s' % (self.CHAIN_FMT_BASE % (
             self.get_dirname(dir_),), self.get_dirxtmatch(dir_), iface_spec,
             chainname)))
-         
-         for rule in self.rules:
-            rv += self.xtcall_countrule(rule.xt_argstring_get(chainname, dir_))
 
       for dir_ in self.DIRS:
          tgt_chain = self.CHAIN_FMT_BASE % (self.get_dirname(dir_))
@@ -321,56 +724,499 @@ class XTTrafficRules:
       
       return rv
    
-   def xt_call(self):
-      for cmd in self.xt_callstrings_get():
+   def xt_chains_read(self):
+      """Read teucrium chains currently present in our NF table.
+      
+      Returns a dict mapping chain names to lists of the comment strings of
+      their rules, in order; rules without a leading comment match are
+      listed as None."""
+      xtge = self.xt_cls().get_entries(self.tablename)
+      chain_pfx = self.CHAIN_FMT_BASE % ('',)
+      rv = {}
+      comments = None
+      for rule in xtge.entries:
+         if (rule.get_target_str() == 'ERROR'):
+            if (comments):
+               # Last entry of a user-defined chain is its policy.
+               del(comments[-1])
+            chain = rule.get_chain_name()
+            if (chain.startswith(chain_pfx)):
+               comments = rv[chain] = []
+            else:
+               comments = None
+            continue
+         
+         if (comments is None):
+            continue
+         
+         comment = None
+         if (rule.matches and (rule.matches[0].name == 'comment')):
+            comment = rule.matches[0].data_get_str()
+         comments.append(comment)
+      return rv
+   
+   def xt_chaindiff_get(self, chainname, dir_, comments_live, rules):
+      """Return XTCalls turning live chain into the configured one (with
+         rules), keeping as many of the live rules (and their counters) as
+         possible."""
+      comments = [rule.xt_comment_get() for rule in rules]
+      comment2idx = {}
+      for i in range(len(comments)):
+         comment2idx[comments[i]] = i
+      
+      # Longest run of live rules that are already in the configured order
+      tails = []
+      tail_pos = []
+      preds = []
+      for i in range(len(comments_live)):
+         idx = comment2idx.get(comments_live[i])
+         if (idx is None):
+            preds.append(None)
+            continue
+         j = bisect.bisect_left(tails, idx)
+         if (j > 0):
+            preds.append(tail_pos[j-1])
+         else:
+            preds.append(-1)
+         if (j == len(tails)):
+            tails.append(idx)
+            tail_pos.append(i)
+         else:
+            tails[j] = idx
+            tail_pos[j] = i
+      
+      keep = set()
+      if (tails):
+         i = tail_pos[-1]
+         while (i >= 0):
+            keep.add(i)
+            i = preds[i]
+      
+      rv = []
+      for i in range(len(comments_live)-1, -1, -1):
+         if not (i in keep):
+            rv.append(self.xtcall('-D %s %d' % (chainname, i+1)))
+      
+      comments_kept = set([comments_live[i] for i in keep])
+      pos = 0
+      for (rule, comment) in zip(rules, comments):
+         pos += 1
+         if (comment in comments_kept):
+            continue
+         rv.append(self.xtcall('-I ' + rule.xt_argstring_get(chainname, dir_,
+            pos)))
+      return rv
+   
+   def xt_callstrings_incremental_get(self, chains_live):
+      """Like xt_callstrings_get(), but only return the calls needed to
+         transform the teucrium chains in chains_live into their configured
+         state, leaving unchanged rules (and their counters) in place."""
+      rv = []
+      for dir_ in self.DIRS:
+         chain = self.CHAIN_FMT_BASE % (self.get_dirname(dir_))
+         if not (chain in chains_live):
+            rv.append(self.xtcall('-N %s' % (chain,)))
+      
+      for (iface_spec, dir_) in self.xt_dirifaces_get():
+         for (chainname, rules) in self.xt_chains_get(iface_spec, dir_):
+            comments_live = chains_live.get(chainname)
+            if (comments_live is None):
+               rv.append(self.xtcall('-N %s' % (chainname,)))
+               comments_live = []
+            rv += self.xt_chaindiff_get(chainname, dir_, comments_live, rules)
+         
+         if not (chainname in chains_live):
+            # New main chain; it needs a jump rule, too.
+            rv += (self.xtcall_countrule('%s %s %s -j %s' % (self.CHAIN_FMT_BASE % (
+               self.get_dirname(dir_),), self.get_dirxtmatch(dir_), iface_spec,
+               chainname)))
+      
+      for dir_ in self.DIRS:
+         tgt_chain = self.CHAIN_FMT_BASE % (self.get_dirname(dir_))
+         src_chains = self.EXT_CHAINS[self.tablename][dir_]
+         for src_chain in src_chains:
+            rv += [self.xtcall('-D %s -j %s' % (src_chain,tgt_chain), errors_ignore=True),
+               self.xtcall('-I %s 1 -j %s' % (src_chain,tgt_chain))]
+      
+      return rv
+   
+   def xt_calls_get(self, incremental=False):
+      if (incremental):
+         return self.xt_callstrings_incremental_get(self.xt_chains_read())
+      return self.xt_callstrings_get()
+   
+   def xt_call(self, incremental=False):
+      self.ipsets_create()
+      self.nfacct_create()
+      for cmd in self.xt_calls_get(incremental):
          cmd.xt_call()
    
+   def xt_restore(self, incremental=False):
+      """Like xt_call(), but commit all changes in one *tables-restore
+         transaction."""
+      self.ipsets_create()
+      self.nfacct_create()
+      XTRestore(self.xt_save_binary, self.xt_restore_binary, self.tablename,
+         self.xt_calls_get(incremental)).xt_call()
+   
 # ---------------------------------------------------------------- rrd tc output
    def rrdtc_param_get(self):
       rules2ds = {}
+      chain2diriface = {}
+      if (self.counter_backend == COUNTER_BACKEND_NFACCT):
+         # NFAcct presents each object as a chain holding one rule, both
+         # named after the object.
+         for (name, (iface_spec, dir_, ds)) in self.nfacct_names_get().items():
+            rules2ds[name] = ds
+            chain2diriface[name] = (iface_spec, dir_)
+         return (rules2ds, chain2diriface)
+      
       for rule in self.rules:
+         rules2ds[rule.xt_comment_get()] = rule.ds
+         # Rules written by versions before checksummed comments are
+         # commented with just their id; keep counting them until the next
+         # xtsetup replaces them.
          rules2ds[rule.id] = rule.ds
       
-      chain2diriface = {}
-      
       for (iface_spec, dir_) in self.xt_dirifaces_get():
-         chainname = self.CHAIN_FMT % (iface_spec, self.get_dirname(dir_))
-         chain2diriface[chainname] = (iface_spec, dir_)
+         for (chainname, rules) in self.xt_chains_get(iface_spec, dir_):
+            chain2diriface[chainname] = (iface_spec, dir_)
       
       return (rules2ds, chain2diriface)
    
-   def rrdtc_build(self, ed):
+   def ipsets_param_get(self):
+      """Return (ipsets, rrdc) arguments for RRDTrafficCounter."""
+      if not (self.ipsets):
+         return (None, None)
+      ipsets = {}
+      for ips in self.ipsets:
+         ipsets[ips.setname] = (ips.iface_spec, ips.dir_)
+      return (ipsets, self.rrdc_build())
+   
+   def counter_table_get(self):
+      """Return table name to pass to counter_cls_get() instances."""
+      return self.tablename
+   
+   def rrdcached_timeout_get(self):
+      """Return maximum time to block on rrdcached for, well under our step."""
+      return min(self.step/4.0, RRDCachedWriter.timeout)
+   
+   def rrdtc_build(self, ed, pollers=None):
+      """Build RRDTrafficCounter for our rules.
+      
+      pollers: dict of XTablesPollers to share with other rule sets; see
+            RRDTrafficCounter.xtp_get()"""
+      if (pollers is None):
+         pollers = {}
+      (rules2ds, chain2diriface) = self.rrdtc_param_get()
+      (ipsets, rrdc) = self.ipsets_param_get()
+      xtp = RRDTrafficCounter.xtp_get(ed, pollers, self.step,
+         self.counter_cls_get(), self.counter_table_get())
+      return RRDTrafficCounter.build_with_xtp(ed, xtp,
+         self.rrddb_base_filename, rules2ds, chain2diriface,
+         self.commit_interval, self.rrdcached_address, self.rrd_layout,
+         self.journal_filename, self.journal_sync_interval,
+         self.rrdtool_children, self.rrdtool_inflight_max, ipsets, rrdc,
+         self.rrdcached_timeout_get())
+   
+   def rrdtc_key_get(self):
+      """Return value identifying the RRDTrafficCounter settings that
+         rrdtc_update() can't change."""
+      return (self.__class__.__name__, self.counter_cls_get(),
+         self.counter_table_get(), self.step, self.rrddb_base_filename,
+         self.rrd_layout, self.rrdcached_address, self.journal_filename,
+         self.journal_sync_interval, self.rrdtool_children,
+         self.rrdtool_inflight_max)
+   
+   def rrdtc_update(self, rrdtc):
+      """Update RRDTrafficCounter built by an instance with the same
+         rrdtc_key_get() value to our rules."""
       (rules2ds, chain2diriface) = self.rrdtc_param_get()
-      return RRDTrafficCounter.build_with_xtp(ed, self.step, self.xt_cls(),
-         (self.tablename,), self.rrddb_base_filename, rules2ds, chain2diriface,
-         self.commit_interval)
+      (ipsets, rrdc) = self.ipsets_param_get()
+      rrdtc.config_update(rules2ds, chain2diriface, self.commit_interval,
+         ipsets, rrdc)
+   
+   def replayer_build(self, ed, capture_fn, rrd_base_filename, speed,
+         done_handler):
+      """Build CaptureReplayer to feed samples recorded in capture_fn into
+         fresh rrd files with the prefix rrd_base_filename.
+      
+      Returns None if capture_fn doesn't contain any data."""
+      ts_start = capture_first_ts_get(capture_fn)
+      if (ts_start is None):
+         return None
+      rrdc = self.rrdc_build(rrd_base_filename, ts_start - 1)
+      rrdc.create(overwrite=True)
+      (rules2ds, chain2diriface) = self.rrdtc_param_get()
+      ipsets = self.ipsets_param_get()[0]
+      rrdtc = RRDTrafficCounter(ed, rrd_base_filename, rules2ds,
+         chain2diriface, self.commit_interval, self.rrdcached_address,
+         self.rrd_layout, rrdtool_children=self.rrdtool_children,
+         rrdtool_inflight_max=self.rrdtool_inflight_max, ipsets=ipsets,
+         rrdc=rrdc, rrdcached_timeout=self.rrdcached_timeout_get())
+      return CaptureReplayer(ed, rrdtc, capture_fn, speed, done_handler)
+   
+   def collector_rrd_base_get(self, node):
+      """Return rrd filename prefix for data forwarded by node."""
+      (rdir, rprefix) = os.path.split(self.rrddb_base_filename)
+      return os.path.join(rdir, node, rprefix)
+   
+   def collector_rrdtc_build(self, ed, node, ts_start):
+      """Build RRDTrafficCounter to write our rule set's data forwarded by
+         node to, creating missing rrd files with a start time before
+         ts_start."""
+      rrd_base_filename = self.collector_rrd_base_get(node)
+      rrdc = self.rrdc_build(rrd_base_filename, ts_start - 1)
+      rrdc.create()
+      (rules2ds, chain2diriface) = self.rrdtc_param_get()
+      ipsets = self.ipsets_param_get()[0]
+      rrdtc = RRDTrafficCounter(ed, rrd_base_filename, rules2ds,
+         chain2diriface, self.commit_interval, self.rrdcached_address,
+         self.rrd_layout, rrdtool_children=self.rrdtool_children,
+         rrdtool_inflight_max=self.rrdtool_inflight_max, ipsets=ipsets,
+         rrdc=rrdc, rrdcached_timeout=self.rrdcached_timeout_get())
+      ed.Timer(ed.ts_omega, rrdtc.shutdown, rrdtc, ts_relative=False)
+      return rrdtc
    
 # ---------------------------------------------------------------- RRDCreator output
-   def rrdc_build(self):
-      ds_l = [rule.ds for rule in self.rules]
+   def ds_l_get(self):
+      """Return sorted list of our distinct ds values.
+      
+      Several rules can count into the same ds; this needs to match the DS
+      RRDTrafficCounter writes."""
+      ds_l = list(set([rule.ds for rule in self.rules]))
       ds_l.sort()
-      return RRDCreator(self.rrddb_base_filename, self.interface_specs, ds_l,
-         self.rra_specs, self.step, self.rrd_heartbeat, self.rrd_max)
+      return ds_l
+   
+   def rrdc_build(self, rrd_base_filename=None, start=None):
+      if (rrd_base_filename is None):
+         rrd_base_filename = self.rrddb_base_filename
+      return RRDCreator(rrd_base_filename, self.interface_specs,
+         self.ds_l_get(), self.rra_specs, self.step, self.rrd_heartbeat,
+         self.rrd_max, self.rrdcached_address, self.rrd_layout, start)
+   
+   def rrdm_build(self):
+      return RRDMigrator(self.rrddb_base_filename, self.interface_specs,
+         self.ds_l_get(), self.rrdcached_address)
+# ---------------------------------------------------------------- RRDQuery output
+   def rrdq_build(self):
+      # query needs numpy, which nothing else does; only import it on use.
+      from query import RRDQuery
+      return RRDQuery(self.rrddb_base_filename, self.interface_specs,
+         self.ds_l_get(), self.rrdcached_address, self.rrd_layout)
 # ---------------------------------------------------------------- RRDGrapher output
    def rrdg_build(self):
       return RRDGrapher(self.rrddb_base_filename, self.interface_specs,
          self.rules, self.graph_periods, self.graph_base, self.graph_img_width,
          self.graph_img_height, self.graph_counter_types, self.graph_fnprefix,
-         self.graph_arguments)
+         self.graph_arguments, self.rrdcached_address, self.rrd_layout)
 
 
 class IPTTrafficRules(XTTrafficRules):
    xt_binary = 'iptables'
+   xt_save_binary = 'iptables-save'
+   xt_restore_binary = 'iptables-restore'
    xt_cls = XTablesIP
+   family = 'ipv4'
 
 class IP6TTrafficRules(XTTrafficRules):
+   # Accounting objects aren't per address family; keep ours apart from those
+   # of IPTTrafficRules.
+   NFACCT_FMT = 'teuc6_%s_%s_%s'
    xt_binary = 'ip6tables'
+   xt_save_binary = 'ip6tables-save'
+   xt_restore_binary = 'ip6tables-restore'
    xt_cls = XTablesIP6
+   family = 'ipv6'
+
+class NFTTrafficRules(XTTrafficRules):
+   """Traffic counting rules for nftables.
+   
+   Rules of all interfaces and directions live in one inet table, so they
+   count IPv4 and IPv6 traffic together. Each rule counts into a named
+   counter, and the daemon reads all counters of the table with one nft call
+   per step. String matches of the form '-p <protocol>' are translated;
+   others are passed to nft verbatim, so they need to be given in nft
+   syntax."""
+   xt_binary = 'nft'
+   family = NFT_FAMILY
+   # Priorities of our base chains; just before those of the corresponding
+   # iptables tables.
+   NFT_HOOKS = {
+      'filter': (-1, {
+         DIR_IN: ('input', 'forward'),
+         DIR_OUT: ('output', 'forward')
+      }),
+      'mangle': (-151, {
+         DIR_IN: ('prerouting',),
+         DIR_OUT: ('postrouting',)
+      })
+   }
+   NFT_DIRS = {
+      DIR_IN: 'iifname',
+      DIR_OUT: 'oifname'
+   }
+   NFT_MATCH_METHODS = {
+      DIR_IN: 'nft_ms_in',
+      DIR_OUT: 'nft_ms_out'
+   }
+   NFT_VERDICTS = {
+      '': '',
+      'RETURN': 'return',
+      'ACCEPT': 'accept',
+      'DROP': 'drop'
+   }
+   NAME_INVALID_RE = re.compile('[^a-zA-Z0-9_]')
+   def __init__(self, interface_specs, hooks='filter', table='teucrium',
+         **kwargs):
+      """Initialize instance.
+      
+      interface_specs: as for XTTrafficRules
+      hooks: 'filter' to count in the input, forward and output hooks, or
+            'mangle' to count in the prerouting and postrouting hooks
+      table: name of inet table to keep our chains and counters in; must be
+            unique for each instance
+      
+      Other arguments are as for XTTrafficRules, except that chain_layout
+      and counter_backend aren't supported."""
+      if not (hooks in self.NFT_HOOKS):
+         raise ValueError('Hook set %r is not supported.' % (hooks,))
+      if ((kwargs.get('chain_layout', CHAIN_LAYOUT_FLAT) != CHAIN_LAYOUT_FLAT)
+         or (kwargs.get('counter_backend', COUNTER_BACKEND_XTABLES) !=
+         COUNTER_BACKEND_XTABLES)):
+         raise ConfigError('NFTTrafficRules only supports the default '
+            'chain_layout and counter_backend.')
+      XTTrafficRules.__init__(self, hooks, interface_specs, **kwargs)
+      self.nft_table = table
+   
+   def ipset_add(self, *args, **kwargs):
+      raise ConfigError('NFTTrafficRules does not support ipsets.')
+   
+   def counter_cls_get(self):
+      return NFTCounters
+   
+   def counter_table_get(self):
+      return self.nft_table
+   
+   def nft_name_get(self, *parts):
+      return self.NAME_INVALID_RE.sub('_', '_'.join(parts))
+   
+   def nft_chain_get(self, iface_spec, dir_):
+      return self.nft_name_get('teuc', iface_spec, self.get_dirname(dir_))
+   
+   def nft_counters_get(self):
+      """Return dict mapping names of our counters to (iface_spec, dir_, ds)
+         tuples."""
+      rv = {}
+      for (iface_spec, dir_) in self.xt_dirifaces_get():
+         for rule in self.rules:
+            name = self.nft_name_get('teuc', iface_spec, self.get_dirname(dir_),
+               rule.ds)
+            if (rv.get(name, (iface_spec, dir_, rule.ds)) !=
+                (iface_spec, dir_, rule.ds)):
+               raise ConfigError('Counter name %r is ambiguous.' % (name,))
+            rv[name] = (iface_spec, dir_, rule.ds)
+      return rv
+   
+   def nft_match_get(self, match, dir_):
+      methname = self.NFT_MATCH_METHODS[dir_]
+      if (hasattr(match, methname)):
+         return getattr(match, methname)()
+      tokens = str(match).split()
+      if ((len(tokens) == 2) and (tokens[0] in ('-p', '--protocol'))):
+         return 'meta l4proto %s' % (tokens[1],)
+      return str(match)
+   
+   def nft_rule_get(self, rule, iface_spec, dir_):
+      try:
+         verdict = self.NFT_VERDICTS[rule.target]
+      except KeyError:
+         verdict = 'jump %s' % (rule.target,)
+      parts = [self.nft_match_get(m, dir_) for m in rule.matches]
+      parts.append('counter name %s' % (self.nft_name_get('teuc', iface_spec,
+         self.get_dirname(dir_), rule.ds),))
+      if (verdict):
+         parts.append(verdict)
+      parts.append('comment "%s"' % (rule.id,))
+      return ' '.join(parts)
+   
+   def nft_script_get(self, incremental=True):
+      """Return nft script setting up our table.
+      
+      If incremental is true, existing counters are kept; otherwise, the
+      table is deleted and rebuilt from scratch."""
+      tbl = '%s %s' % (NFT_FAMILY, self.nft_table)
+      rv = ['add table %s' % (tbl,)]
+      if not (incremental):
+         rv.append('delete table %s' % (tbl,))
+         rv.append('add table %s' % (tbl,))
+      
+      counters = list(self.nft_counters_get().keys())
+      counters.sort()
+      for name in counters:
+         rv.append('add counter %s %s' % (tbl, name))
+      
+      chains = []
+      for dir_ in self.DIRS:
+         chains.append(self.nft_name_get('teuc', self.get_dirname(dir_)))
+      for (iface_spec, dir_) in self.xt_dirifaces_get():
+         chains.append(self.nft_chain_get(iface_spec, dir_))
+      for chain in chains:
+         rv.append('add chain %s %s' % (tbl, chain))
+      (prio, hooks) = self.NFT_HOOKS[self.tablename]
+      for dir_ in self.DIRS:
+         for hook in hooks[dir_]:
+            chain = self.nft_name_get(hook, self.get_dirname(dir_))
+            rv.append('add chain %s %s { type filter hook %s priority %d ; }'
+               % (tbl, chain, hook, prio))
+            chains.append(chain)
+      for chain in chains:
+         rv.append('flush chain %s %s' % (tbl, chain))
+      
+      for (iface_spec, dir_) in self.xt_dirifaces_get():
+         chain = self.nft_chain_get(iface_spec, dir_)
+         rv.append('add rule %s %s %s "%s" jump %s' % (tbl,
+            self.nft_name_get('teuc', self.get_dirname(dir_)),
+            self.NFT_DIRS[dir_], iface_spec.replace('+', '*'), chain))
+         for rule in self.rules:
+            rv.append('add rule %s %s %s' % (tbl, chain,
+               self.nft_rule_get(rule, iface_spec, dir_)))
+      for dir_ in self.DIRS:
+         for hook in hooks[dir_]:
+            rv.append('add rule %s %s jump %s' % (tbl, self.nft_name_get(hook,
+               self.get_dirname(dir_)), self.nft_name_get('teuc',
+               self.get_dirname(dir_))))
+      rv.append('')
+      return '\n'.join(rv)
+   
+   def xt_call(self, incremental=False):
+      try:
+         nft_script_run(self.nft_script_get(incremental), self.xt_binary)
+      except (NFTError, EnvironmentError):
+         raise ConfigError('Unable to set up nft table %r: %s' %
+            (self.nft_table, sys.exc_info()[1]))
+   
+   # The nft script is applied atomically either way.
+   xt_restore = xt_call
+   
+   def rrdtc_param_get(self):
+      rules2ds = {}
+      chain2diriface = {}
+      # NFTCounters presents each counter as a chain holding one rule, both
+      # named after the counter.
+      for (name, (iface_spec, dir_, ds)) in self.nft_counters_get().items():
+         rules2ds[name] = ds
+         chain2diriface[name] = (iface_spec, dir_)
+      return (rules2ds, chain2diriface)
+
 
 class TeucriumConfig:
    """Teucrium config file reader"""
-   content = ('IPTTrafficRules', 'IP6TTrafficRules', 'LocalPort', 'RemotePort',
-      'LocalPorts', 'RemotePorts', 'CT_BYTES', 'CT_PACKETS')
+   content = ('IPTTrafficRules', 'IP6TTrafficRules', 'NFTTrafficRules',
+      'LocalPort', 'RemotePort', 'LocalPorts', 'RemotePorts', 'CT_BYTES',
+      'CT_PACKETS', 'LAYOUT_PER_RULE', 'LAYOUT_MULTI_DS', 'DIR_IN', 'DIR_OUT',
+      'POS_LOCAL', 'POS_REMOTE', 'CHAIN_LAYOUT_FLAT', 'CHAIN_LAYOUT_PROTO_TREE',
+      'COUNTER_BACKEND_XTABLES', 'COUNTER_BACKEND_NFACCT')
    cfd_global = '/etc/teucrium/'
    cfd_user = '~/.teucrium/'
    cfn_name = 'teucrium.conf'
@@ -421,6 +1267,9 @@ if (__name__ == '__main__'):
    ipttr.rule_add('udp_other', ('-p udp',))
    print('=== XT callstrings: ===')
    pprint.pprint([xtc.callstring_get() for xtc in ipttr.xt_callstrings_get()])
+   ipttr.chain_layout = CHAIN_LAYOUT_PROTO_TREE
+   print('=== XT callstrings (protocol tree layout): ===')
+   pprint.pprint([xtc.callstring_get() for xtc in ipttr.xt_callstrings_get()])
    pprint.pprint(ipttr.rrdc_build())
    print('=== All tests passed. ===')
 
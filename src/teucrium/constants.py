@@ -21,3 +21,9 @@ DIR_IN = 0
 DIR_OUT = 1
 CT_BYTES = 0
 CT_PACKETS = 1
+LAYOUT_PER_RULE = 0
+LAYOUT_MULTI_DS = 1
+CHAIN_LAYOUT_FLAT = 0
+CHAIN_LAYOUT_PROTO_TREE = 1
+COUNTER_BACKEND_XTABLES = 0
+COUNTER_BACKEND_NFACCT = 1
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Shipping collected samples to a central collector
+#
+# Each forwarded rule set gets its own TCP connection. A connection starts
+# with HELLO_MAGIC, len (B) + node name and the rule set index (B), followed by
+# a sample log stream as written by SampleLogWriter.
+
+import logging
+import os.path
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+
+try:
+   import Queue as queue
+   from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+except ImportError:
+   import queue
+   from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+
+from sample_log import SampleJournal, SampleLogError, SampleLogReader, \
+   SampleLogWriter
+
+HELLO_MAGIC = 'TEUCFW01'
+NODE_RE = re.compile('^[a-zA-Z0-9_][a-zA-Z0-9_.-]*$')
+
+
+class ForwardError(StandardError):
+   pass
+
+
+def hello_get(node, idx):
+   return '%s%s%s%s' % (HELLO_MAGIC, struct.pack('!B', len(node)), node,
+      struct.pack('!B', idx))
+
+
+def hello_read(f):
+   """Read hello from file-like f; return (node, rule set index)."""
+   if (f.read(len(HELLO_MAGIC)) != HELLO_MAGIC):
+      raise ForwardError('Invalid hello.')
+   l = f.read(1)
+   if not (l):
+      raise ForwardError('Truncated hello.')
+   node = f.read(ord(l))
+   idx = f.read(1)
+   if ((len(node) != ord(l)) or not (idx)):
+      raise ForwardError('Truncated hello.')
+   if (NODE_RE.match(node) is None):
+      raise ForwardError('Invalid node name %r.' % (node,))
+   return (node, ord(idx))
+
+
+class SendBuffer:
+   def __init__(self):
+      self.data = []
+
+   def write(self, s):
+      self.data.append(s)
+
+   def get(self):
+      rv = ''.join(self.data)
+      self.data = []
+      return rv
+
+
+class SampleForwarder:
+   """Forward ticks of one rule set to a collector.
+
+   tick_write() only queues ticks; a background thread sends them in
+   batches, reconnecting as needed. While the collector is unreachable, ticks
+   are spooled to disk, up to spool_max bytes, and sent ahead of any newer
+   ones once a connection has been established again. A collector that
+   doesn't accept data for SEND_TIMEOUT seconds counts as unreachable.
+   At most QUEUE_MAX ticks are queued; further ones are dropped until the
+   thread catches up."""
+   logger = logging.getLogger('SampleForwarder')
+   log = logger.log
+   CONNECT_TIMEOUT = 10
+   SEND_TIMEOUT = 10
+   # Maximum time for close() to wait for the sending thread
+   CLOSE_TIMEOUT = 15
+   QUEUE_MAX = 4096
+   RECONNECT_INTERVAL_MAX = 60
+   SPOOL_SYNC_INTERVAL = 8
+   def __init__(self, address, node, idx, spool_filename,
+         spool_max=256*1024*1024):
+      if (NODE_RE.match(node) is None):
+         raise ValueError('Invalid node name %r.' % (node,))
+      self.address = address
+      self.node = node
+      self.idx = idx
+      self.spool = SampleJournal(spool_filename, self.SPOOL_SYNC_INTERVAL)
+      self.spool_max = spool_max
+      self.spool_full = False
+      self.queue = queue.Queue()
+      self.queue_full = False
+      self.sock = None
+      self.buf = None
+      self.writer = None
+      self.reconnect_interval = 1
+      self.ts_reconnect = 0
+      self.thread = None
+
+   def start(self):
+      """Start sending thread; call after forking."""
+      self.thread = threading.Thread(target=self.run)
+      self.thread.setDaemon(True)
+      self.thread.start()
+
+   def tick_write(self, ts, samples):
+      if (self.queue.qsize() >= self.QUEUE_MAX):
+         if not (self.queue_full):
+            self.log(40, 'Sending thread is not keeping up; discarding ticks.')
+            self.queue_full = True
+         return
+      self.queue_full = False
+      self.queue.put((ts, samples))
+
+   def flush(self):
+      pass
+
+   def close(self):
+      """Send or spool queued ticks, and stop sending thread.
+      
+      Waits for no more than CLOSE_TIMEOUT seconds; ticks the thread hasn't
+      dealt with by then may be lost."""
+      self.queue.put(None)
+      if (self.thread is None):
+         return
+      self.thread.join(self.CLOSE_TIMEOUT)
+      if (self.thread.is_alive()):
+         self.log(40, 'Sending thread for rule set %d did not finish in time;'
+            ' giving up on it.' % (self.idx,))
+
+   def batch_get(self):
+      """Wait for queued ticks, and return all of them; the list ends with
+         None if we've been closed."""
+      rv = [self.queue.get()]
+      while (rv[-1] is not None):
+         try:
+            rv.append(self.queue.get_nowait())
+         except queue.Empty:
+            break
+      return rv
+
+   def connect(self):
+      self.ts_reconnect = time.time() + self.reconnect_interval
+      try:
+         sock = socket.create_connection(self.address, self.CONNECT_TIMEOUT)
+      except EnvironmentError:
+         self.log(30, 'Unable to connect to collector at %r: %s' % (
+            self.address, sys.exc_info()[1]))
+         self.reconnect_interval = min(self.reconnect_interval*2,
+            self.RECONNECT_INTERVAL_MAX)
+         return
+      self.log(20, 'Connected to collector at %r.' % (self.address,))
+      sock.settimeout(self.SEND_TIMEOUT)
+      self.sock = sock
+      self.buf = SendBuffer()
+      self.writer = SampleLogWriter(self.buf)
+      self.reconnect_interval = 1
+      try:
+         self.send_data(hello_get(self.node, self.idx) + self.buf.get())
+         self.spool_send()
+      except EnvironmentError:
+         self.disconnect()
+
+   def disconnect(self):
+      self.log(30, 'Lost connection to collector at %r: %s' % (self.address,
+         sys.exc_info()[1]))
+      try:
+         self.sock.close()
+      except EnvironmentError:
+         pass
+      self.sock = None
+      self.buf = None
+      self.writer = None
+
+   def send_data(self, data):
+      self.sock.sendall(data)
+
+   def send(self, ticks):
+      for (ts, samples) in ticks:
+         self.writer.tick_write(ts, samples)
+      self.send_data(self.buf.get())
+
+   def spool_send(self):
+      """Send all spooled ticks, releasing spool segments once sent."""
+      self.spool.rotate()
+      for fn in self.spool.segments_get():
+         try:
+            f = open(fn, 'rb')
+            try:
+               self.send(SampleLogReader(f))
+            finally:
+               f.close()
+         except SampleLogError:
+            self.log(40, 'Discarding invalid spool segment %r.' % (fn,))
+         self.spool.segments_release((fn,))
+      self.spool_full = False
+
+   def spool_size_get(self):
+      rv = 0
+      fns = self.spool.segments_get()
+      if not (self.spool.seg_fn is None):
+         fns.append(self.spool.seg_fn)
+      for fn in fns:
+         try:
+            rv += os.path.getsize(fn)
+         except OSError:
+            pass
+      return rv
+
+   def spool_write(self, ticks):
+      if (self.spool_size_get() >= self.spool_max):
+         if not (self.spool_full):
+            self.log(40, 'Spool is full; discarding ticks until the '
+               'collector is reachable again.')
+            self.spool_full = True
+         return
+      try:
+         for (ts, samples) in ticks:
+            self.spool.tick_write(ts, samples)
+      except EnvironmentError:
+         self.log(40, 'Failed to spool ticks: %s' % (sys.exc_info()[1],))
+
+   def run(self):
+      done = False
+      while not (done):
+         ticks = self.batch_get()
+         if (ticks[-1] is None):
+            ticks.pop()
+            done = True
+         # Once closed, don't hold things up by trying to reconnect.
+         if ((self.sock is None) and (time.time() >= self.ts_reconnect) and
+               not done):
+            self.connect()
+         if not (self.sock is None):
+            try:
+               self.send(ticks)
+               continue
+            except EnvironmentError:
+               self.disconnect()
+         self.spool_write(ticks)
+      self.spool.rotate()
+      if not (self.sock is None):
+         self.sock.close()
+         self.sock = None
+
+
+class CollectorRequestHandler(StreamRequestHandler):
+   logger = logging.getLogger('CollectorRequestHandler')
+   log = logger.log
+   def handle(self):
+      try:
+         (node, idx) = hello_read(self.rfile)
+      except ForwardError:
+         self.log(30, 'Rejecting %r: %s' % (self.client_address,
+            sys.exc_info()[1]))
+         return
+      if (idx >= self.server.rule_set_count):
+         self.log(30, 'Rejecting %r: no rule set %d.' % (self.client_address,
+            idx))
+         return
+      self.log(20, 'Receiving rule set %d of node %r from %r.' % (idx, node,
+         self.client_address))
+      try:
+         reader = SampleLogReader(self.rfile)
+         for (ts, samples) in reader:
+            self.server.queue.put((node, idx, ts, samples))
+      except (SampleLogError, EnvironmentError):
+         self.log(30, 'Dropping connection from %r: %s' % (self.client_address,
+            sys.exc_info()[1]))
+         return
+      self.log(20, 'Node %r closed connection for rule set %d.' % (node, idx))
+
+
+class CollectorServer(ThreadingMixIn, TCPServer):
+   """Receive forwarded ticks, and queue (node, rule set index, ts, samples)
+      tuples for processing by Collector."""
+   daemon_threads = True
+   allow_reuse_address = True
+   def __init__(self, address, rule_set_count):
+      TCPServer.__init__(self, address, CollectorRequestHandler)
+      self.rule_set_count = rule_set_count
+      self.queue = queue.Queue()
+
+   def start(self):
+      thread = threading.Thread(target=self.serve_forever)
+      thread.setDaemon(True)
+      thread.start()
+
+
+class Collector:
+   """Feed ticks received by a CollectorServer into per-node
+      RRDTrafficCounters, from the event loop.
+
+   rrdtc_build: callable taking (node, rule set index, timestamp of first
+         tick) and returning the RRDTrafficCounter to use for them
+
+   If rrdtc_build fails for a source, its ticks are dropped for
+   BUILD_RETRY_INTERVAL seconds before we try again."""
+   logger = logging.getLogger('Collector')
+   log = logger.log
+   POLL_INTERVAL = 0.2
+   BUILD_RETRY_INTERVAL = 60
+   def __init__(self, ed, server, rrdtc_build):
+      self.ed = ed
+      self.server = server
+      self.rrdtc_build = rrdtc_build
+      # (node, idx) -> [rrdtc, timestamp of last tick]
+      self.sources = {}
+      # (node, idx) -> time to retry building a failed source at
+      self.sources_failed = {}
+      self.ed.Timer(self.POLL_INTERVAL, self.poll, self)
+
+   def poll(self):
+      q = self.server.queue
+      try:
+         while (True):
+            try:
+               (node, idx, ts, samples) = q.get_nowait()
+            except queue.Empty:
+               break
+            self.tick_process(node, idx, ts, samples)
+      finally:
+         self.ed.Timer(self.POLL_INTERVAL, self.poll, self)
+
+   def source_build(self, node, idx, ts):
+      """Return [rrdtc, 0] for a new source, or None if it can't be built."""
+      key = (node, idx)
+      if (time.time() < self.sources_failed.get(key, 0)):
+         return None
+      self.log(25, 'New source: rule set %d of node %r.' % (idx, node))
+      try:
+         rrdtc = self.rrdtc_build(node, idx, ts)
+      except Exception:
+         self.log(40, 'Failed to set up rule set %d of node %r; dropping its '
+            'data for %d seconds: %s' % (idx, node, self.BUILD_RETRY_INTERVAL,
+            sys.exc_info()[1]))
+         self.sources_failed[key] = time.time() + self.BUILD_RETRY_INTERVAL
+         return None
+      self.sources_failed.pop(key, None)
+      return [rrdtc, 0]
+
+   def tick_process(self, node, idx, ts, samples):
+      try:
+         source = self.sources[(node, idx)]
+      except KeyError:
+         source = self.source_build(node, idx, ts)
+         if (source is None):
+            return
+         self.sources[(node, idx)] = source
+      if (ts <= source[1]):
+         # Resent after a reconnect; rrdtool would reject it.
+         return
+      source[1] = ts
+      source[0].rrd_tick_replay(ts, samples)
+
+
+if (__name__ == '__main__'):
+   # Here there be self-tests, forwarding to a collector on localhost.
+   import shutil
+   import tempfile
+   def ticks_get(ts_start, count, sample_count=2):
+      return [(ts, [(('eth0', 0, 'ds%d' % i, 0), ts*10 + i) for i in
+         range(sample_count)]) for ts in range(ts_start, ts_start + count)]
+   def received_get(server, count):
+      rv = []
+      for i in range(count):
+         rv.append(server.queue.get(True, 10))
+      return rv
+   tmpdir = tempfile.mkdtemp()
+   try:
+      spool_fn = os.path.join(tmpdir, 'spool')
+      server = CollectorServer(('127.0.0.1', 0), 2)
+      server.start()
+      address = server.server_address
+      fwd = SampleForwarder(address, 'node1', 1, spool_fn)
+      fwd.start()
+      ticks = ticks_get(100, 5)
+      for (ts, samples) in ticks:
+         fwd.tick_write(ts, samples)
+      assert(received_get(server, 5) == [('node1', 1, ts, samples) for
+         (ts, samples) in ticks])
+      fwd.close()
+
+      # With the collector gone, ticks are spooled, and sent ahead of newer
+      # ones once it's back.
+      server.shutdown()
+      server.server_close()
+      fwd = SampleForwarder(address, 'node1', 1, spool_fn)
+      fwd.start()
+      for (ts, samples) in ticks_get(105, 3):
+         fwd.tick_write(ts, samples)
+      fwd.close()
+      assert(fwd.spool_size_get() > 0)
+      server = CollectorServer(address, 2)
+      server.start()
+      fwd = SampleForwarder(address, 'node1', 1, spool_fn)
+      fwd.start()
+      for (ts, samples) in ticks_get(108, 2):
+         fwd.tick_write(ts, samples)
+      assert([r[2] for r in received_get(server, 5)] == list(range(105, 110)))
+      fwd.close()
+      assert(fwd.spool_size_get() == 0)
+      server.shutdown()
+      server.server_close()
+
+      # A collector that stops reading mustn't block us indefinitely.
+      s_listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      s_listen.bind(('127.0.0.1', 0))
+      s_listen.listen(1)
+      fwd = SampleForwarder(s_listen.getsockname(), 'node1', 1, spool_fn)
+      fwd.SEND_TIMEOUT = 0.5
+      fwd.start()
+      for (ts, samples) in ticks_get(200, 20, 20000):
+         fwd.tick_write(ts, samples)
+      ts_start = time.time()
+      fwd.close()
+      assert(not fwd.thread.is_alive())
+      assert(time.time() - ts_start < 10), time.time() - ts_start
+      assert(fwd.spool_size_get() > 0)
+      s_listen.close()
+
+      # Failing to set up one source mustn't stop the collector, nor keep
+      # other sources from being processed.
+      class EventDispatcherStub:
+         def __init__(self):
+            self.timers = []
+         def Timer(self, *args):
+            self.timers.append(args)
+      class RRDTCStub:
+         def __init__(self):
+            self.ticks = []
+         def rrd_tick_replay(self, ts, samples):
+            self.ticks.append(ts)
+      class ServerStub:
+         queue = queue.Queue()
+      rrdtcs = {}
+      broken = set(['node2'])
+      def rrdtc_build(node, idx, ts):
+         if (node in broken):
+            raise EnvironmentError(28, 'No space left on device')
+         rrdtc = rrdtcs[node] = RRDTCStub()
+         return rrdtc
+      ed = EventDispatcherStub()
+      collector = Collector(ed, ServerStub, rrdtc_build)
+      for ts in (1, 2):
+         ServerStub.queue.put(('node1', 0, ts, []))
+         ServerStub.queue.put(('node2', 0, ts, []))
+      collector.poll()
+      assert(len(ed.timers) == 2)
+      assert(rrdtcs['node1'].ticks == [1, 2])
+      assert(list(collector.sources.keys()) == [('node1', 0)])
+      # Once the retry interval has passed, we try again.
+      broken.clear()
+      collector.sources_failed[('node2', 0)] = 0
+      ServerStub.queue.put(('node2', 0, 3, []))
+      collector.poll()
+      assert(rrdtcs['node2'].ticks == [3])
+      assert(collector.sources_failed == {})
+   finally:
+      shutil.rmtree(tmpdir)
+   print('=== All tests passed. ===')
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rendering graphs on demand over HTTP
+
+import logging
+import os, os.path
+import re
+import sys
+import tempfile
+import threading
+import time
+
+try:
+   from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+   from SocketServer import ThreadingMixIn
+   from urlparse import urlparse, parse_qs
+except ImportError:
+   from http.server import BaseHTTPRequestHandler, HTTPServer
+   from socketserver import ThreadingMixIn
+   from urllib.parse import urlparse, parse_qs
+
+from collections import OrderedDict
+
+import rrdtool
+
+from constants import CT_BYTES
+
+
+class GraphRequestError(StandardError):
+   pass
+
+
+class GraphRenderError(StandardError):
+   """A valid request couldn't be served because of a problem on our end"""
+   pass
+
+
+class RenderCache:
+   """Byte-size limited LRU cache of rendered images.
+
+   Images are kept in memory, or as files in cache_dir if that is given;
+   files left there by earlier processes are removed on startup. All
+   methods are thread-safe."""
+   FN_RE = re.compile('^[0-9]+_[0-9]+\\.png$')
+   def __init__(self, max_bytes, cache_dir=None):
+      self.max_bytes = max_bytes
+      self.cache_dir = cache_dir
+      # key -> image data, or (filename, size) if kept on disk
+      self.entries = OrderedDict()
+      self.size = 0
+      self.fn_idx = 0
+      self.lock = threading.Lock()
+      if (cache_dir is None):
+         return
+      if not (os.path.exists(cache_dir)):
+         os.makedirs(cache_dir)
+      for fn in os.listdir(cache_dir):
+         if (self.FN_RE.match(fn) is None):
+            continue
+         try:
+            os.remove(os.path.join(cache_dir, fn))
+         except OSError:
+            pass
+
+   def get(self, key):
+      """Return cached image data for key, or None."""
+      self.lock.acquire()
+      try:
+         try:
+            val = self.entries.pop(key)
+         except KeyError:
+            return None
+         self.entries[key] = val
+      finally:
+         self.lock.release()
+      if (self.cache_dir is None):
+         return val
+      try:
+         f = open(val[0], 'rb')
+         try:
+            return f.read()
+         finally:
+            f.close()
+      except EnvironmentError:
+         return None
+
+   def put(self, key, data):
+      if (len(data) > self.max_bytes):
+         return
+      self.lock.acquire()
+      try:
+         self.fn_idx += 1
+         fn_idx = self.fn_idx
+      finally:
+         self.lock.release()
+      if (self.cache_dir is None):
+         val = data
+      else:
+         fn = os.path.join(self.cache_dir, '%d_%d.png' % (os.getpid(), fn_idx))
+         f = open(fn, 'wb')
+         try:
+            f.write(data)
+         finally:
+            f.close()
+         val = (fn, len(data))
+
+      self.lock.acquire()
+      try:
+         old = self.entries.pop(key, None)
+         if not (old is None):
+            self.val_drop(old)
+         self.entries[key] = val
+         self.size += len(data)
+         while (self.size > self.max_bytes):
+            self.val_drop(self.entries.popitem(last=False)[1])
+      finally:
+         self.lock.release()
+
+   def val_drop(self, val):
+      if (self.cache_dir is None):
+         self.size -= len(val)
+         return
+      self.size -= val[1]
+      try:
+         os.remove(val[0])
+      except OSError:
+         pass
+
+
+class GraphRenderer:
+   """Render graphs for RRDGraphers on demand, with caching and coalescing
+      of concurrent identical requests"""
+   logger = logging.getLogger('GraphRenderer')
+   log = logger.log
+   IMG_SIZE_MAX = 4096
+   def __init__(self, rrdgs, cache):
+      self.rrdgs = rrdgs
+      self.cache = cache
+      # key -> [threading.Event, result]
+      self.inflight = {}
+      self.lock = threading.Lock()
+
+   def rrdg_get(self, ifs, rrdg_idx=None):
+      if (rrdg_idx is None):
+         candidates = self.rrdgs
+      else:
+         try:
+            candidates = [self.rrdgs[rrdg_idx]]
+         except IndexError:
+            raise GraphRequestError('Invalid rule set index %r.' % (rrdg_idx,))
+      for rrdg in candidates:
+         if (ifs in rrdg.interface_specs):
+            return rrdg
+      raise GraphRequestError('Unknown interface spec %r.' % (ifs,))
+
+   def ct_get(self, rrdg, ct_str):
+      for (ct, label) in rrdg.CT_LABELS.items():
+         if (label == ct_str):
+            return ct
+      raise GraphRequestError('Invalid counter type %r.' % (ct_str,))
+
+   def request_parse(self, query):
+      """Return (cache key, rrdgraph arguments) for a parsed query string.
+
+      Graphs of relative periods, and of a start time without an end, are
+      rendered for a window ending at the end of the current pixel-sized
+      time bucket, so all requests within one bucket share an image. Images
+      of other windows reaching past now are only shared within one bucket,
+      too."""
+      def arg_get(name, default=None, conv=str):
+         try:
+            val = query[name][0]
+         except KeyError:
+            if (default is None):
+               raise GraphRequestError('Missing parameter %r.' % (name,))
+            return default
+         try:
+            return conv(val)
+         except ValueError:
+            raise GraphRequestError('Invalid value %r for parameter %r.' % (val, name))
+
+      rrdg_idx = arg_get('set', -1, int)
+      if (rrdg_idx < 0):
+         rrdg_idx = None
+      ifs = arg_get('iface')
+      rrdg = self.rrdg_get(ifs, rrdg_idx)
+      ct = self.ct_get(rrdg, arg_get('ct', rrdg.CT_LABELS[CT_BYTES]))
+      width = arg_get('width', rrdg.img_width, int)
+      height = arg_get('height', rrdg.img_height, int)
+      if not ((0 < width <= self.IMG_SIZE_MAX) and (0 < height <= self.IMG_SIZE_MAX)):
+         raise GraphRequestError('Invalid image size %dx%d.' % (width, height))
+
+      now = time.time()
+      if ('start' in query):
+         start = arg_get('start', conv=int)
+         if ('end' in query):
+            end = arg_get('end', conv=int)
+         else:
+            bucket = max(float(now - start)/width, 1)
+            end = int((int(now/bucket) + 1)*bucket)
+      else:
+         period = arg_get('period', rrdg.periods[0], int)
+         if (period <= 0):
+            raise GraphRequestError('Invalid period %r.' % (period,))
+         bucket = max(float(period)/width, 1)
+         end = int((int(now/bucket) + 1)*bucket)
+         start = end - period
+      if (start >= end):
+         raise GraphRequestError('Invalid time range %r..%r.' % (start, end))
+
+      key = (self.rrdgs.index(rrdg), ifs, ct, start, end, width, height)
+      if (end > now):
+         # The image changes as data for the window comes in.
+         bucket = max(float(end - start)/width, 1)
+         key += (int(now/bucket),)
+      args = rrdg.graph_render_args_get(ct, ifs, ('-s', str(start), '-e', str(end)),
+         width, height)
+      return (key, args)
+
+   def render(self, args):
+      (fd, fn) = tempfile.mkstemp(suffix='.png')
+      os.close(fd)
+      try:
+         rrdtool.graph(fn, *args)
+         f = open(fn, 'rb')
+         try:
+            return f.read()
+         finally:
+            f.close()
+      finally:
+         os.remove(fn)
+
+   def image_get(self, query):
+      """Return image data for parsed query string.
+      
+      Raises GraphRequestError for invalid queries, and GraphRenderError if
+      rendering fails."""
+      (key, args) = self.request_parse(query)
+      data = self.cache.get(key)
+      if not (data is None):
+         return data
+
+      self.lock.acquire()
+      try:
+         waiter = self.inflight.get(key)
+         if (waiter is None):
+            waiter = self.inflight[key] = [threading.Event(), None]
+            leader = True
+         else:
+            leader = False
+      finally:
+         self.lock.release()
+
+      if not (leader):
+         waiter[0].wait()
+         if (waiter[1] is None):
+            raise GraphRenderError('Rendering failed.')
+         return waiter[1]
+
+      try:
+         try:
+            data = self.render(args)
+         except (rrdtool.error, EnvironmentError):
+            self.log(40, 'Failed to render %r: %s' % (key, sys.exc_info()[1]))
+            raise GraphRenderError('Rendering failed.')
+         waiter[1] = data
+         try:
+            self.cache.put(key, data)
+         except EnvironmentError:
+            self.log(40, 'Failed to cache %r: %s' % (key, sys.exc_info()[1]))
+         return data
+      finally:
+         self.lock.acquire()
+         try:
+            del(self.inflight[key])
+         finally:
+            self.lock.release()
+         waiter[0].set()
+
+
+class GraphRequestHandler(BaseHTTPRequestHandler):
+   logger = logging.getLogger('GraphRequestHandler')
+   def do_GET(self):
+      url = urlparse(self.path)
+      if (url.path != '/graph'):
+         self.send_error(404)
+         return
+      try:
+         data = self.server.renderer.image_get(parse_qs(url.query))
+      except GraphRequestError:
+         self.send_error(400, str(sys.exc_info()[1]))
+         return
+      except GraphRenderError:
+         self.send_error(500, str(sys.exc_info()[1]))
+         return
+      self.send_response(200)
+      self.send_header('Content-Type', 'image/png')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+   def log_message(self, format, *args):
+      self.logger.log(20, '%s %s' % (self.client_address[0], format % args))
+
+
+class GraphHTTPServer(ThreadingMixIn, HTTPServer):
+   daemon_threads = True
+   def __init__(self, address, renderer):
+      HTTPServer.__init__(self, address, GraphRequestHandler)
+      self.renderer = renderer
+
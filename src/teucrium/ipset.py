@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reading per-element counters of ipsets
+
+import logging
+import subprocess
+
+IPSET_BINARY = 'ipset'
+
+
+class IPSetError(StandardError):
+   pass
+
+
+def ipset_create(setname, settype, binary=IPSET_BINARY):
+   """Create ipset with counters, unless a set of that name exists already."""
+   cmd = (binary, '-exist', 'create', setname, settype, 'counters')
+   IPSetReader.log(20, 'Executing %r.' % (cmd,))
+   rc = subprocess.call(cmd)
+   if (rc):
+      raise IPSetError('%r failed with rcode %r.' % (cmd, rc))
+
+
+def member_ds_get(setname, member):
+   """Return ds name to store counters of ipset element member under."""
+   return '%s_%s' % (setname, member.replace('/', '_').replace(':', '_'))
+
+
+class IPSetReader:
+   """Read element counters of several ipsets in one 'ipset save' call"""
+   logger = logging.getLogger('IPSetReader')
+   log = logger.log
+   def __init__(self, setnames, binary=IPSET_BINARY):
+      self.setnames = set(setnames)
+      self.binary = binary
+
+   def cmd_get(self):
+      if (len(self.setnames) == 1):
+         return (self.binary, 'save', list(self.setnames)[0])
+      return (self.binary, 'save')
+
+   @staticmethod
+   def line_parse(line):
+      """Parse 'add' line of 'ipset save' output.
+
+      Returns (setname, member, bytes, packets), or None if the line doesn't
+      describe an element with counters."""
+      tokens = line.split()
+      if ((len(tokens) < 3) or (tokens[0] != 'add')):
+         return None
+      try:
+         packets = int(tokens[tokens.index('packets', 3) + 1])
+         bytes = int(tokens[tokens.index('bytes', 3) + 1])
+      except (ValueError, IndexError):
+         return None
+      return (tokens[1], tokens[2], bytes, packets)
+
+   def read(self):
+      """Return dict mapping names of our sets to lists of (member, bytes,
+         packets) tuples."""
+      p = subprocess.Popen(self.cmd_get(), stdout=subprocess.PIPE,
+         stderr=subprocess.PIPE)
+      (out, err) = p.communicate()
+      if (p.returncode):
+         raise IPSetError('%r failed with rcode %r: %r' % (self.cmd_get(),
+            p.returncode, err))
+
+      rv = {}
+      for setname in self.setnames:
+         rv[setname] = []
+      for line in out.split('\n'):
+         elem = self.line_parse(line)
+         if ((elem is None) or not (elem[0] in self.setnames)):
+            continue
+         rv[elem[0]].append(elem[1:])
+      return rv
+
+
+if (__name__ == '__main__'):
+   # Here there be self-tests, against a fake ipset binary.
+   import os
+   import shutil
+   import tempfile
+   tmpdir = tempfile.mkdtemp()
+   try:
+      binary = os.path.join(tmpdir, 'ipset')
+      args_fn = os.path.join(tmpdir, 'args')
+      f = open(binary, 'w')
+      f.write('''#!/bin/sh
+echo "$@" >> '%s'
+[ "$1" = save ] || exit 0
+[ "$2" = broken ] && { echo "ipset v7.1: The set with the given name does not exist" >&2; exit 1; }
+cat <<EOT
+create cust hash:ip family inet hashsize 1024 maxelem 65536 counters
+add cust 10.0.0.1 packets 5 bytes 300
+add cust 10.0.0.2 packets 7 bytes 700 comment "bytes 9"
+add cust 10.0.0.3
+create other hash:net family inet6 counters
+add other 2001:db8::/32 packets 1 bytes 2
+create unrelated hash:ip counters
+add unrelated 10.9.9.9 packets 1 bytes 1
+EOT
+''' % (args_fn,))
+      f.close()
+      os.chmod(binary, 0o755)
+
+      reader = IPSetReader(('cust', 'other'), binary)
+      data = reader.read()
+      assert(data == {'cust': [('10.0.0.1', 300, 5), ('10.0.0.2', 700, 7)],
+         'other': [('2001:db8::/32', 2, 1)]}), data
+      assert(IPSetReader(('cust',), binary).read() == {'cust': [
+         ('10.0.0.1', 300, 5), ('10.0.0.2', 700, 7)]})
+      try:
+         IPSetReader(('broken',), binary).read()
+      except IPSetError:
+         pass
+      else:
+         raise AssertionError('Failure of ipset binary went unnoticed.')
+      ipset_create('cust', 'hash:ip', binary)
+      assert(open(args_fn).read().split('\n') == ['save', 'save cust',
+         'save broken', '-exist create cust hash:ip counters', ''])
+      assert(member_ds_get('other', '2001:db8::/32') == 'other_2001_db8___32')
+   finally:
+      shutil.rmtree(tmpdir)
+   print('=== All tests passed. ===')
@@ -18,29 +18,108 @@
 import logging
 import os, os.path
 import optparse
+import signal
+import socket
 import sys
+import time
 
+import rrdtool
 from gonium.fd_management import EventDispatcherSelect as ED
 from gonium import pid_filing, daemon_init
 
 try:
    from teucrium.config_structures import TeucriumConfig
+   from teucrium.rrd_grapher import graph_jobs_run
+   from teucrium.constants import LAYOUT_MULTI_DS
+   from teucrium.stats import Stats
+   from teucrium.metrics_http import MetricsExporter, metrics_server_start
+   from teucrium.graph_server import GraphHTTPServer, GraphRenderer, RenderCache
+   from teucrium.forward import Collector, CollectorServer, SampleForwarder, NODE_RE
 except ImportError:
    from config_structures import TeucriumConfig
+   from rrd_grapher import graph_jobs_run
+   from constants import LAYOUT_MULTI_DS
+   from stats import Stats
+   from metrics_http import MetricsExporter, metrics_server_start
+   from graph_server import GraphHTTPServer, GraphRenderer, RenderCache
+   from forward import Collector, CollectorServer, SampleForwarder, NODE_RE
 
 logger = logging.getLogger()
 log = logger.log
 
+# Capture filename for n-th rule set
+CAPTURE_FN_FMT = '%s%d'
+# Forwarding spool filename for n-th rule set
+SPOOL_FN_FMT = '%s%d'
+# Seconds between checks for pending config reloads
+RELOAD_CHECK_INTERVAL = 1
+
 def op_get():
    op = optparse.OptionParser(usage="teucrium [options] <action>\nactions: " + ' '.join(actions.keys()))
    op.add_option('-c', '--config', dest='cfn', help='config file to read', metavar='FILE')
    
-   og_rrdcreate = optparse.OptionGroup(op, 'rrdcreate options')
+   og_rrdcreate = optparse.OptionGroup(op, 'rrdcreate/rrdmigrate options')
    og_rrdcreate.add_option('--force-overwrite', dest='rc_overwrite', help='Overwrite existing rrd db files (DANGEROUS)', action='store_true', default=False)
+   og_rrdcreate.add_option('--rrdcreate-jobs', dest='rc_jobs', help='number of rrd files to create in parallel; 0 (default) means one per cpu', metavar='N', type='int', default=0)
+   og_rrdcreate.add_option('--dry-run', dest='rc_dry_run', help='only report how many rrd files and bytes rrdcreate would write', action='store_true', default=False)
    op.add_option_group(og_rrdcreate)
    
+   og_xtsetup = optparse.OptionGroup(op, 'xtsetup options')
+   og_xtsetup.add_option('--xtsetup-mode', dest='xs_mode', help='how to write rules: in one *tables-restore transaction (restore; default) or with one *tables call per command (call)', type='choice', choices=('restore', 'call'), default='restore')
+   og_xtsetup.add_option('--xtsetup-full', dest='xs_full', help='flush and rewrite all teucrium chains, instead of only applying the differences to their current state (resets all counters)', action='store_true', default=False)
+   op.add_option_group(og_xtsetup)
+   
+   og_graph = optparse.OptionGroup(op, 'graph options')
+   og_graph.add_option('-j', '--jobs', dest='g_jobs', help='number of graphs to render in parallel; 0 (default) means one per cpu', metavar='N', type='int', default=0)
+   og_graph.add_option('--graph-force', dest='g_force', help='render all graphs, even those whose data and time window have not changed enough to be visible since the last run', action='store_true', default=False)
+   op.add_option_group(og_graph)
+   
+   og_serve = optparse.OptionGroup(op, 'serve options')
+   og_serve.add_option('--serve-listen', dest='sv_addr', help='address to serve graphs on (default: 127.0.0.1:8081)', metavar='ADDRESS:PORT', default='127.0.0.1:8081')
+   og_serve.add_option('--serve-cache-size', dest='sv_cache_size', help='maximum size of rendered graph cache in MiB (default: 64)', metavar='MIB', type='int', default=64)
+   og_serve.add_option('--serve-cache-dir', dest='sv_cache_dir', help='keep rendered graph cache in DIR instead of memory', metavar='DIR', default=None)
+   op.add_option_group(og_serve)
+   
+   og_query = optparse.OptionGroup(op, 'query options')
+   og_query.add_option('--select', dest='q_select', help='series to query or bill, as fnmatch patterns; billing ignores CT (default: */*/*/*)', metavar='IFACE/DIR/CT/DS', default='*/*/*/*')
+   og_query.add_option('--query-start', dest='q_start', help='start of time range as unix timestamp, or seconds relative to now if <= 0 (default: -86400)', metavar='TIME', type='int', default=-86400)
+   og_query.add_option('--query-end', dest='q_end', help='end of time range, as for --query-start (default: 0)', metavar='TIME', type='int', default=0)
+   og_query.add_option('--query-group', dest='q_group', help='comma-separated key fields to keep; series agreeing in them are summed (default: iface,dir,ct,ds)', metavar='FIELDS', default='iface,dir,ct,ds')
+   og_query.add_option('--query-op', dest='q_op', help='reduce each series to its total (sum), mean rate (rate), percentile, or list the largest totals (top); default is to output the series (series)', type='choice', choices=('series', 'sum', 'rate', 'percentile', 'top'), default='series')
+   og_query.add_option('--query-top', dest='q_top', help='number of series to list for top (default: 10)', metavar='N', type='int', default=10)
+   og_query.add_option('--query-percentile', dest='q_percentile', help='percentile to compute for percentile (default: 95)', metavar='P', type='float', default=95)
+   og_query.add_option('--query-output', dest='q_output', help='write results to FILE, in NPZ format if it ends with .npz and as CSV otherwise (default: CSV to stdout)', metavar='FILE', default=None)
+   og_query.add_option('--query-threads', dest='q_threads', help='number of files to fetch in parallel (default: 8)', metavar='N', type='int', default=8)
+   op.add_option_group(og_query)
+   
+   og_billing = optparse.OptionGroup(op, 'billing options')
+   og_billing.add_option('--billing-month', dest='b_month', help='month to bill (default: the last complete one)', metavar='YYYY-MM', default=None)
+   og_billing.add_option('--billing-percentile', dest='b_percentile', help='percentile to bill (default: 95)', metavar='P', type='float', default=95)
+   og_billing.add_option('--billing-interval', dest='b_interval', help='length of the sampling intervals to average rates over (default: 300)', metavar='SECONDS', type='int', default=300)
+   og_billing.add_option('--billing-output', dest='b_output', help='write report to FILE instead of stdout', metavar='FILE', default=None)
+   og_billing.add_option('--billing-jobs', dest='b_jobs', help='number of processes to read files with; 0 (default) means one per cpu', metavar='N', type='int', default=0)
+   op.add_option_group(og_billing)
+   
+   og_collector = optparse.OptionGroup(op, 'collector options')
+   og_collector.add_option('--collector-listen', dest='cl_addr', help='address to accept forwarded data on (default: 127.0.0.1:8082)', metavar='ADDRESS:PORT', default='127.0.0.1:8082')
+   op.add_option_group(og_collector)
+   
+   og_capture = optparse.OptionGroup(op, 'daemon/replay options')
+   og_capture.add_option('--capture', dest='cap_prefix', help='daemon: record collected data of the n-th rule set to PREFIXn; replay: read it from there', metavar='PREFIX', default=None)
+   og_capture.add_option('--replay-speed', dest='rp_speed', help='speed to replay data at, relative to real time; 0 (default) means as fast as possible', metavar='FACTOR', type='float', default=0)
+   og_capture.add_option('--replay-base', dest='rp_base', help='directory to create scratch rrd files for replayed data in (default: replay/)', metavar='DIR', default='replay/')
+   op.add_option_group(og_capture)
+   
    og_daemon = optparse.OptionGroup(op, 'daemon options')
    og_daemon.add_option('-p', '--pid-file', dest='pfn', help='pid file to use', metavar='FILE', default='teucrium.pid')
+   og_daemon.add_option('--metrics-listen', dest='metrics_addr', help='serve current counter values in OpenMetrics format at http://ADDRESS:PORT/metrics', metavar='ADDRESS:PORT', default=None)
+   og_daemon.add_option('--stats-file', dest='stats_fn', help='collect timing metrics, and write them to FILE on SIGUSR1', metavar='FILE', default=None)
+   og_daemon.add_option('--stats-interval', dest='stats_interval', help='also write metrics every SECONDS seconds', metavar='SECONDS', type='float', default=0)
+   og_daemon.add_option('--forward', dest='fw_addr', help='forward collected data to the teucrium collector at ADDRESS:PORT', metavar='ADDRESS:PORT', default=None)
+   og_daemon.add_option('--forward-node', dest='fw_node', help='node name to forward data under (default: hostname)', metavar='NAME', default=socket.gethostname())
+   og_daemon.add_option('--forward-spool', dest='fw_spool', help='spool data of the n-th rule set to PREFIXn while the collector is unreachable (default: spool/forward)', metavar='PREFIX', default='spool/forward')
+   og_daemon.add_option('--forward-only', dest='fw_only', help="don't write forwarded data to local rrd files", action='store_true', default=False)
+   og_daemon.add_option('--reload-rrdcreate', dest='rl_rrdcreate', help='on SIGHUP, create missing rrd files for the reloaded config', action='store_true', default=False)
    og_daemon.add_option('--debug-mode', dest='ddebug', help="don't fork, redirect output or suppress log messages", action='store_true', default=False)
    op.add_option_group(og_daemon)
    
@@ -54,15 +133,63 @@ def error_exit(msg, rcode=255):
    print('FATAL: ' + msg)
    sys.exit(rcode)
 
+def config_load(options):
+   """Read config file as specified by options; return TeucriumConfig."""
+   tc = TeucriumConfig()
+   if (options.cfn is None):
+      tc.config_read()
+   else:
+      os.chdir(os.path.dirname(options.cfn))
+      tc.file_read(options.cfn)
+   return tc
+
+def address_parse(s):
+   """Parse 'ADDRESS:PORT' string into (address, port) tuple."""
+   try:
+      (host, port) = s.rsplit(':', 1)
+      return (host.strip('[]'), int(port))
+   except ValueError:
+      error_exit('Invalid address %r.' % (s,))
+
 def act_rrdcreate(options, xtrs, ls):
+   if (options.rc_dry_run):
+      totals = [0, 0, 0]
+      for xtr in xtrs:
+         plan = xtr.rrdc_build().plan_get(overwrite=options.rc_overwrite)
+         log(20, 'Rule set with rrd prefix %r: %d files, %d bytes, %d templates.'
+            % ((xtr.rrddb_base_filename,) + plan))
+         for i in range(len(totals)):
+            totals[i] += plan[i]
+      log(20, 'Would create %d files totalling about %d bytes from %d templates.'
+         % tuple(totals))
+      sys.exit(0)
+   
+   failures = 0
    for xtr in xtrs:
       rrdc = xtr.rrdc_build()
-      rrdc.create(overwrite=options.rc_overwrite)
+      failures += len(rrdc.create(overwrite=options.rc_overwrite,
+         processes=options.rc_jobs))
+   if (failures):
+      sys.exit(1)
+   sys.exit(0)
+
+def act_rrdmigrate(options, xtrs, ls):
+   failures = 0
+   for xtr in xtrs:
+      if (xtr.rrd_layout != LAYOUT_MULTI_DS):
+         continue
+      failures += xtr.rrdm_build().migrate(overwrite=options.rc_overwrite)
+   if (failures):
+      sys.exit(1)
    sys.exit(0)
 
 def act_xtsetup(options, xtrs, ls):
   for xtr in xtrs:
-     xtr.xt_call()
+     incremental = not options.xs_full
+     if (options.xs_mode == 'restore'):
+        xtr.xt_restore(incremental)
+     else:
+        xtr.xt_call(incremental)
 
 def act_daemon(options, xtrs, ls):
    # Override the following test at your own peril. It's safer to run teucrium with
@@ -71,15 +198,130 @@ def act_daemon(options, xtrs, ls):
    if ((os.getuid() == 0) and not options.tolerateuid0):
       raise StandardError("It is not advised to run this program as root.")
    rrdtcs = []
+   pollers = {}
    ed = ED()
-   for xtr in xtrs:
+   if (options.stats_fn is None):
+      stats = None
+   else:
+      stats = Stats()
+      # daemon_init() may change our working directory.
+      stats_fn = os.path.abspath(options.stats_fn)
+   if (options.metrics_addr is None):
+      exporter = None
+   else:
+      exporter = MetricsExporter()
+      metrics_addr = address_parse(options.metrics_addr)
+   if (options.fw_addr is None):
+      fw_addr = None
+   else:
+      fw_addr = address_parse(options.fw_addr)
+      fw_spool = os.path.abspath(options.fw_spool)
+   # Forwarders started so far; their threads don't survive daemon_init().
+   forwarders = []
+   forwarders_started = [False]
+   def access_check(xtr):
       # Check if the interface works and we have the needed permissions
       try:
-         xtr.xt_cls().get_info(xtr.tablename)
+         xtr.counter_cls_get()().get_info(xtr.counter_table_get())
       except ValueError:
-         error_exit('Attempting to access NF table %r using %r failed.\nCheck if the table is present and you have CAP_NET_ADMIN.' % (xtr.tablename, xtr.xt_cls.__name__))
-      rrdtcs.append(xtr.rrdtc_build(ed))
+         return 'Attempting to access NF table %r using %r failed.\nCheck if the table is present and you have CAP_NET_ADMIN.' % (xtr.counter_table_get(), xtr.counter_cls_get().__name__)
+      return None
+   
+   def rrdtc_setup(xtr, idx):
+      rrdtc = xtr.rrdtc_build(ed, pollers)
+      if not (options.cap_prefix is None):
+         # Numbered by order of creation, so reloads don't reuse files.
+         rrdtc.capture_start(CAPTURE_FN_FMT % (options.cap_prefix, rrdtc_count[0]))
+      rrdtc_count[0] += 1
+      if not (stats is None):
+         rrdtc.stats_start(stats, xtr.step)
+      if not (exporter is None):
+         rrdtc.metrics_start(exporter, xtr.family)
+      if not (fw_addr is None):
+         # Numbered by position in the config, which the collector's config
+         # needs to match.
+         fwd = SampleForwarder(fw_addr, options.fw_node, idx,
+            SPOOL_FN_FMT % (fw_spool, idx))
+         rrdtc.forward_start(fwd, not options.fw_only)
+         ed.Timer(ed.ts_omega, fwd.close, rrdtc, ts_relative=False)
+         forwarders.append(fwd)
+         if (forwarders_started[0]):
+            fwd.start()
+      rrdtcs.append((xtr.rrdtc_key_get(), rrdtc))
+   
+   if ((fw_addr is not None) and (NODE_RE.match(options.fw_node) is None)):
+      error_exit('Invalid node name %r.' % (options.fw_node,))
+   rrdtc_count = [0]
+   for i in range(len(xtrs)):
+      msg = access_check(xtrs[i])
+      if not (msg is None):
+         error_exit(msg)
+      rrdtc_setup(xtrs[i], i)
+   
+   def config_reload():
+      """Apply current config to our rule sets, updating them in place where
+         possible."""
+      log(25, 'Reloading config.')
+      try:
+         xtrs_new = config_load(options).xtrs
+      except StandardError:
+         log(40, 'Failed to read config; keeping old one: %s' % (sys.exc_info()[1],))
+         return
+      for xtr in xtrs_new:
+         msg = access_check(xtr)
+         if not (msg is None):
+            log(40, '%s\nKeeping old config.' % (msg,))
+            return
+      if (options.rl_rrdcreate):
+         for xtr in xtrs_new:
+            try:
+               failed = xtr.rrdc_build().create(processes=options.rc_jobs)
+            except (rrdtool.error, EnvironmentError):
+               log(40, 'Failed to create rrd files for rule set with rrd '
+                  'prefix %r: %s' % (xtr.rrddb_base_filename,
+                  sys.exc_info()[1]))
+               continue
+            for fn in sorted(failed):
+               log(40, 'Failed to create rrd file %r.' % (fn,))
       
+      old = {}
+      for (key, rrdtc) in rrdtcs:
+         old.setdefault(key, []).append(rrdtc)
+      del(rrdtcs[:])
+      for i in range(len(xtrs_new)):
+         xtr = xtrs_new[i]
+         key = xtr.rrdtc_key_get()
+         if (old.get(key)):
+            rrdtc = old[key].pop(0)
+            xtr.rrdtc_update(rrdtc)
+            rrdtcs.append((key, rrdtc))
+         else:
+            rrdtc_setup(xtr, i)
+      for rrdtc_l in old.values():
+         for rrdtc in rrdtc_l:
+            rrdtc.close()
+      # Stop polling tables no rule set is reading anymore.
+      xtps_used = [rrdtc.xtp for (key, rrdtc) in rrdtcs]
+      for (key, xtp) in list(pollers.items()):
+         if not (xtp in xtps_used):
+            xtp.close()
+            del(pollers[key])
+      log(25, 'Reloaded config; now running %d rule sets.' % (len(rrdtcs),))
+   
+   # Reloading from the signal handler itself could interrupt tick
+   # processing; do it from the event loop instead.
+   reload_pending = [False]
+   def reload_request(*args):
+      reload_pending[0] = True
+   def reload_check():
+      try:
+         if (reload_pending[0]):
+            reload_pending[0] = False
+            config_reload()
+      finally:
+         ed.Timer(RELOAD_CHECK_INTERVAL, reload_check, rrdtcs)
+   
+
    if not (options.ddebug):
       if not (os.path.exists('log')):
          os.makedirs('log')
@@ -88,18 +330,190 @@ def act_daemon(options, xtrs, ls):
       pid_filing.release_pid_file(pid_filing.file_pid())
       daemon_init.daemon_init()
       pid_filing.file_pid()
+   
+   if not (exporter is None):
+      # Threads don't survive daemon_init()'s fork, so do this afterwards.
+      try:
+         metrics_server_start(exporter, metrics_addr)
+      except EnvironmentError:
+         error_exit('Unable to listen on %r: %s' % (options.metrics_addr, sys.exc_info()[1]))
+   forwarders_started[0] = True
+   for fwd in forwarders:
+      fwd.start()
+   
+   signal.signal(signal.SIGHUP, reload_request)
+   ed.Timer(RELOAD_CHECK_INTERVAL, reload_check, rrdtcs)
+   
+   if not (stats is None):
+      def stats_dump(*args):
+         stats.dump_file(stats_fn)
+      signal.signal(signal.SIGUSR1, stats_dump)
+      if (options.stats_interval > 0):
+         def stats_dump_periodic():
+            stats_dump()
+            ed.Timer(options.stats_interval, stats_dump_periodic, stats)
+         ed.Timer(options.stats_interval, stats_dump_periodic, stats)
+   ed.event_loop()
+   
+def act_replay(options, xtrs, ls):
+   if (options.cap_prefix is None):
+      error_exit('replay requires --capture.')
+   ed = ED()
+   replayers = []
+   def replayer_done():
+      replayers.pop()
+      if not (replayers):
+         ed.shutdown()
+   
+   for i in range(len(xtrs)):
+      xtr = xtrs[i]
+      fn = CAPTURE_FN_FMT % (options.cap_prefix, i)
+      if not (os.path.exists(fn)):
+         log(30, 'No capture %r for rule set %d; skipping.' % (fn, i))
+         continue
+      rrd_base = os.path.join(options.rp_base, xtr.rrddb_base_filename.lstrip('/'))
+      replayer = xtr.replayer_build(ed, fn, rrd_base, options.rp_speed, replayer_done)
+      if (replayer is None):
+         log(30, 'Capture %r is empty; skipping.' % (fn,))
+         continue
+      replayers.append(replayer)
+   
+   if not (replayers):
+      error_exit('Nothing to replay.')
    ed.event_loop()
    
 def act_graph(options, xtrs, ls):
+   jobs = []
+   rrdgs = []
    for xtr in xtrs:
       rrdg = xtr.rrdg_build()
-      rrdg.data_graph()
+      jobs.extend(rrdg.graph_jobs_get(options.g_force))
+      rrdgs.append(rrdg)
+   fns_failed = graph_jobs_run(jobs, options.g_jobs)
+   for rrdg in rrdgs:
+      rrdg.graph_state_commit(fns_failed)
+   if (fns_failed):
+      sys.exit(1)
+
+def act_serve(options, xtrs, ls):
+   rrdgs = [xtr.rrdg_build() for xtr in xtrs]
+   cache = RenderCache(options.sv_cache_size*1024*1024, options.sv_cache_dir)
+   try:
+      server = GraphHTTPServer(address_parse(options.sv_addr),
+         GraphRenderer(rrdgs, cache))
+   except EnvironmentError:
+      error_exit('Unable to listen on %r: %s' % (options.sv_addr, sys.exc_info()[1]))
+   log(25, 'Serving graphs on %r.' % (options.sv_addr,))
+   server.serve_forever()
+
+def act_query(options, xtrs, ls):
+   # numpy is only needed here.
+   try:
+      try:
+         from teucrium.query import KEY_FIELDS, QueryError, RRDFetcher, selector_parse
+      except ImportError:
+         from query import KEY_FIELDS, QueryError, RRDFetcher, selector_parse
+   except ImportError:
+      error_exit('query requires numpy: %s' % (sys.exc_info()[1],))
+   
+   now = int(time.time())
+   (start, end) = (options.q_start, options.q_end)
+   if (start <= 0):
+      start += now
+   if (end <= 0):
+      end += now
+   fields = [f for f in options.q_group.split(',') if f]
+   for field in fields:
+      if not (field in KEY_FIELDS):
+         error_exit('Invalid key field %r.' % (field,))
+   try:
+      selector = selector_parse(options.q_select)
+      targets = []
+      for xtr in xtrs:
+         targets.extend(xtr.rrdq_build().targets_get(selector))
+      result = RRDFetcher(start, end, threads=options.q_threads).query(targets)
+      result = result.aggregate(fields)
+      if (options.q_op != 'series'):
+         arg = {'top':options.q_top, 'percentile':options.q_percentile}.get(options.q_op)
+         result = result.summary_get(options.q_op, arg)
+   except QueryError:
+      error_exit(str(sys.exc_info()[1]))
+   
+   if (options.q_output is None):
+      result.csv_write(sys.stdout)
+   elif (options.q_output.endswith('.npz')):
+      result.npz_write(options.q_output)
+   else:
+      f = open(options.q_output, 'w')
+      try:
+         result.csv_write(f)
+      finally:
+         f.close()
+
+def act_billing(options, xtrs, ls):
+   # numpy is only needed here.
+   try:
+      try:
+         from teucrium.billing import billing_csv_write, billing_jobs_get, billing_jobs_run, month_range_get
+         from teucrium.query import QueryError, selector_parse
+      except ImportError:
+         from billing import billing_csv_write, billing_jobs_get, billing_jobs_run, month_range_get
+         from query import QueryError, selector_parse
+   except ImportError:
+      error_exit('billing requires numpy: %s' % (sys.exc_info()[1],))
+   
+   if (options.b_interval <= 0):
+      error_exit('Invalid billing interval %r.' % (options.b_interval,))
+   try:
+      (start, end) = month_range_get(options.b_month)
+   except ValueError:
+      error_exit('Invalid month %r.' % (options.b_month,))
+   try:
+      (p_iface, p_dir, p_ct, p_ds) = selector_parse(options.q_select)
+   except QueryError:
+      error_exit(str(sys.exc_info()[1]))
+   jobs = []
+   for i in range(len(xtrs)):
+      targets = xtrs[i].rrdq_build().targets_get((p_iface, p_dir, 'bytes', p_ds))
+      jobs.extend(billing_jobs_get(i, targets, start, end, options.b_interval,
+         options.b_percentile))
+   (results, fns_failed) = billing_jobs_run(jobs, options.b_jobs)
+   
+   if (options.b_output is None):
+      billing_csv_write(sys.stdout, results, options.b_percentile)
+   else:
+      f = open(options.b_output, 'w')
+      try:
+         billing_csv_write(f, results, options.b_percentile)
+      finally:
+         f.close()
+   if (fns_failed):
+      sys.exit(1)
+
+def act_collector(options, xtrs, ls):
+   ed = ED()
+   try:
+      server = CollectorServer(address_parse(options.cl_addr), len(xtrs))
+   except EnvironmentError:
+      error_exit('Unable to listen on %r: %s' % (options.cl_addr, sys.exc_info()[1]))
+   def rrdtc_build(node, idx, ts):
+      return xtrs[idx].collector_rrdtc_build(ed, node, ts)
+   Collector(ed, server, rrdtc_build)
+   server.start()
+   log(25, 'Collecting forwarded data on %r.' % (options.cl_addr,))
+   ed.event_loop()
 
 actions = {
    'rrdcreate':act_rrdcreate,
+   'rrdmigrate':act_rrdmigrate,
    'daemon':act_daemon,
+   'replay':act_replay,
    'xtsetup':act_xtsetup,
-   'graph':act_graph
+   'graph':act_graph,
+   'serve':act_serve,
+   'collector':act_collector,
+   'query':act_query,
+   'billing':act_billing
 }
 
 def main():
@@ -113,7 +527,6 @@ def main():
    def logger_shutdown():
       logger.removeHandler(handler_stderr)
    
-   tc = TeucriumConfig()
    op = op_get()
    (options, args) = op.parse_args()
    if (len(args) < 1):
@@ -125,14 +538,16 @@ def main():
       error_exit('Invalid action %r.' % (action,))
    
    if not (options.cfn is None):
-      cfn = os.path.abspath(options.cfn)
-      try:
-         os.chdir(os.path.dirname(cfn))
-         tc.file_read(cfn)
-      except OSError:
-         error_exit('Unable to read config file %r.' % (fcn,))
-   else:
-      tc.config_read()
+      options.cfn = os.path.abspath(options.cfn)
+   # config_load() changes our working directory.
+   if not (options.q_output is None):
+      options.q_output = os.path.abspath(options.q_output)
+   if not (options.b_output is None):
+      options.b_output = os.path.abspath(options.b_output)
+   try:
+      tc = config_load(options)
+   except OSError:
+      error_exit('Unable to read config file %r.' % (options.cfn,))
    
    act_func(options, tc.xtrs, logger_shutdown)
 
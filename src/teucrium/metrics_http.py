@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Serving current counter values in the OpenMetrics text format
+
+import logging
+import threading
+
+try:
+   from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+   from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from constants import CT_BYTES, CT_PACKETS
+from rrd_fn import RRDFileNamer
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def label_escape(s):
+   return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsExporter:
+   """Hold the latest samples of each RRDTrafficCounter, and render them as
+      OpenMetrics text.
+
+   Sources replace their entire snapshot on each tick; rendering only reads
+   those snapshots, so it can safely be done from another thread."""
+   METRICS = (
+      (CT_BYTES, 'teucrium_bytes', 'Bytes counted by teucrium rules.'),
+      (CT_PACKETS, 'teucrium_packets', 'Packets counted by teucrium rules.')
+   )
+   def __init__(self):
+      # source id -> (label string prefix, snapshot)
+      self.sources = {}
+
+   def source_add(self, family):
+      """Register a new source of samples, and return its id.
+
+      family: address family label value; e.g. 'ipv4'"""
+      source_id = len(self.sources)
+      self.sources[source_id] = ('family="%s"' % (label_escape(family),), ())
+      return source_id
+
+   def snapshot_set(self, source_id, samples):
+      """Replace snapshot of source_id.
+
+      samples: sequence of ((iface, dir_, ds, ct), value) pairs"""
+      self.sources[source_id] = (self.sources[source_id][0], samples)
+
+   def render(self):
+      by_ct = {}
+      for (ct, name, desc) in self.METRICS:
+         by_ct[ct] = []
+      for (family_label, samples) in list(self.sources.values()):
+         for ((iface, dir_, ds, ct), val) in samples:
+            by_ct[ct].append('{iface="%s",direction="%s",ds="%s",%s} %d' % (
+               label_escape(iface), RRDFileNamer.FN_DIR[dir_],
+               label_escape(ds), family_label, val))
+
+      out = []
+      for (ct, name, desc) in self.METRICS:
+         out.append('# TYPE %s counter\n# HELP %s %s\n' % (name, name, desc))
+         lines = by_ct[ct]
+         lines.sort()
+         for line in lines:
+            out.append('%s_total%s\n' % (name, line))
+      out.append('# EOF\n')
+      return ''.join(out)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+   logger = logging.getLogger('MetricsRequestHandler')
+   def do_GET(self):
+      if (self.path.split('?', 1)[0] != '/metrics'):
+         self.send_error(404)
+         return
+      body = self.server.exporter.render().encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', CONTENT_TYPE)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+      self.logger.log(20, '%s %s' % (self.client_address[0], format % args))
+
+
+def metrics_server_start(exporter, address):
+   """Serve /metrics from exporter on address ((host, port)) in a
+      background thread; return the HTTPServer."""
+   server = HTTPServer(address, MetricsRequestHandler)
+   server.exporter = exporter
+   thread = threading.Thread(target=server.serve_forever)
+   thread.setDaemon(True)
+   thread.start()
+   return server
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reading and creating nfnetlink_acct accounting objects
+
+import logging
+import os
+import socket
+import struct
+import sys
+
+NETLINK_NETFILTER = 12
+NFNL_SUBSYS_ACCT = 7
+NFNL_MSG_ACCT_NEW = 0
+NFNL_MSG_ACCT_GET = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_CREATE = 0x400
+NFACCT_NAME = 1
+NFACCT_PKTS = 2
+NFACCT_BYTES = 3
+NLA_TYPE_MASK = 0x3fff
+# Including the terminating NUL byte
+NFACCT_NAME_MAX = 32
+
+NLMSGHDR = struct.Struct('=IHHII')
+NFGENMSG = struct.Struct('=BBH')
+NLATTR = struct.Struct('=HH')
+NLMSGERR = struct.Struct('=i')
+U64_BE = struct.Struct('>Q')
+
+
+class NFAcctError(StandardError):
+   pass
+
+
+def nl_align(l):
+   return (l + 3) & ~3
+
+
+def nfacct_msg_build(msg_type, flags, seq, attrs=()):
+   """Build nfnetlink_acct message; attrs is a sequence of (type, data)
+      pairs."""
+   payload = [NFGENMSG.pack(socket.AF_UNSPEC, 0, 0)]
+   for (attr_type, data) in attrs:
+      alen = NLATTR.size + len(data)
+      payload.append(NLATTR.pack(alen, attr_type) + data +
+         '\x00'*(nl_align(alen) - alen))
+   payload = ''.join(payload)
+   return NLMSGHDR.pack(NLMSGHDR.size + len(payload),
+      (NFNL_SUBSYS_ACCT << 8) | msg_type, flags, seq, 0) + payload
+
+
+def nl_msgs_parse(data):
+   """Split datagram into (type, flags, seq, payload) tuples."""
+   rv = []
+   off = 0
+   while (off + NLMSGHDR.size <= len(data)):
+      (mlen, mtype, flags, seq, pid) = NLMSGHDR.unpack_from(data, off)
+      if ((mlen < NLMSGHDR.size) or (off + mlen > len(data))):
+         raise NFAcctError('Invalid netlink message length %d at offset %d.'
+            % (mlen, off))
+      rv.append((mtype, flags, seq, data[off+NLMSGHDR.size:off+mlen]))
+      off += nl_align(mlen)
+   return rv
+
+
+def nfacct_obj_parse(payload):
+   """Return (name, bytes, packets) from payload of NFNL_MSG_ACCT_NEW
+      message."""
+   attrs = {}
+   off = NFGENMSG.size
+   while (off + NLATTR.size <= len(payload)):
+      (alen, atype) = NLATTR.unpack_from(payload, off)
+      if (alen < NLATTR.size):
+         raise NFAcctError('Invalid attribute length %d.' % (alen,))
+      attrs[atype & NLA_TYPE_MASK] = payload[off+NLATTR.size:off+alen]
+      off += nl_align(alen)
+   try:
+      return (attrs[NFACCT_NAME].split('\x00', 1)[0],
+         U64_BE.unpack(attrs[NFACCT_BYTES])[0],
+         U64_BE.unpack(attrs[NFACCT_PKTS])[0])
+   except (KeyError, struct.error):
+      raise NFAcctError('Incomplete accounting object: %r' % (payload,))
+
+
+class NFAcctEntry:
+   """Table-entry lookalike for one accounting object.
+
+   Entry lists built from these describe each object as a chain of its own
+   name, holding one rule with a comment of the same name, so they can be
+   processed like the get_entries() results of XTablesIP."""
+   def __init__(self, target, chain=None, comment=None, counter_bytes=0,
+         counter_packets=0):
+      self.target = target
+      self.chain = chain
+      if (comment is None):
+         self.matches = ()
+      else:
+         self.matches = (NFAcctCommentMatch(comment),)
+      self.counter_bytes = counter_bytes
+      self.counter_packets = counter_packets
+
+   def get_target_str(self):
+      return self.target
+
+   def get_chain_name(self):
+      return self.chain
+
+
+class NFAcctCommentMatch:
+   name = 'comment'
+   def __init__(self, comment):
+      self.comment = comment
+
+   def data_get_str(self):
+      return self.comment
+
+
+class NFAcctEntries:
+   """valid: False if the counters couldn't be read, and entries is empty
+         because of that"""
+   def __init__(self, entries, valid=True):
+      self.entries = entries
+      self.valid = valid
+
+
+def counter_entries_get(objs):
+   """Return NFAcctEntries for sequence of (name, bytes, packets) tuples of
+      named counters."""
+   entries = []
+   for (name, cbytes, cpackets) in objs:
+      entries.append(NFAcctEntry('ERROR', name))
+      entries.append(NFAcctEntry('', comment=name, counter_bytes=cbytes,
+         counter_packets=cpackets))
+   return NFAcctEntries(entries)
+
+
+class NFAcct:
+   """Access nfnetlink_acct objects; can be used in place of XTablesIP for
+      polling counters.
+
+   Accounting objects aren't bound to any table or address family, so the
+   tablename arguments are ignored."""
+   logger = logging.getLogger('NFAcct')
+   log = logger.log
+   BUFSIZE = 65536
+   def __init__(self, sock=None):
+      """sock: connected netlink socket to use; by default, one is opened for
+            each request"""
+      self.sock = sock
+      self.seq = 0
+
+   def sock_get(self):
+      if not (self.sock is None):
+         return self.sock
+      sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+         NETLINK_NETFILTER)
+      sock.bind((0, 0))
+      return sock
+
+   def request(self, msg_type, flags, attrs=()):
+      """Send request, and return payloads of all non-error messages of the
+         reply."""
+      self.seq += 1
+      seq = self.seq
+      sock = self.sock_get()
+      try:
+         sock.send(nfacct_msg_build(msg_type, NLM_F_REQUEST | flags, seq,
+            attrs))
+         rv = []
+         while (True):
+            data = sock.recv(self.BUFSIZE)
+            if not (data):
+               raise NFAcctError('Netlink socket closed.')
+            for (mtype, mflags, mseq, payload) in nl_msgs_parse(data):
+               if (mseq != seq):
+                  continue
+               if (mtype == NLMSG_DONE):
+                  return rv
+               if (mtype == NLMSG_ERROR):
+                  err = -NLMSGERR.unpack_from(payload)[0]
+                  if (err):
+                     raise NFAcctError('Netlink request failed: %s' %
+                        (os.strerror(err),))
+                  return rv
+               rv.append(payload)
+               if not (mflags & NLM_F_MULTI):
+                  return rv
+      finally:
+         if (self.sock is None):
+            sock.close()
+
+   def dump(self):
+      """Return list of (name, bytes, packets) tuples for all accounting
+         objects."""
+      return [nfacct_obj_parse(p) for p in
+         self.request(NFNL_MSG_ACCT_GET, NLM_F_DUMP)]
+
+   def obj_add(self, name):
+      """Create accounting object name, unless it exists already."""
+      if (len(name) >= NFACCT_NAME_MAX):
+         raise ValueError('Accounting object name %r is too long.' % (name,))
+      self.log(20, 'Creating accounting object %r.' % (name,))
+      self.request(NFNL_MSG_ACCT_NEW, NLM_F_CREATE | NLM_F_ACK,
+         ((NFACCT_NAME, name + '\x00'),))
+
+   def get_info(self, tablename):
+      """Check that accounting objects can be read; raises ValueError
+         otherwise."""
+      try:
+         self.dump()
+      except (NFAcctError, EnvironmentError):
+         raise ValueError('Unable to read accounting objects: %s' %
+            (sys.exc_info()[1],))
+
+   def get_entries(self, tablename):
+      return counter_entries_get(self.dump())
+
+
+if (__name__ == '__main__'):
+   # Here there be self-tests, against a fake netlink responder.
+   import threading
+   objs = (('teuc_eth+_in_web', 12345, 67), ('teuc_eth+_out_web', 2**40, 1))
+   (s_client, s_server) = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+   def responder():
+      (mtype, flags, seq, payload) = nl_msgs_parse(s_server.recv(4096))[0]
+      assert(mtype == (NFNL_SUBSYS_ACCT << 8) | NFNL_MSG_ACCT_GET)
+      assert(flags & NLM_F_DUMP)
+      data = ''.join([nfacct_msg_build(NFNL_MSG_ACCT_NEW, NLM_F_MULTI, seq,
+         ((NFACCT_NAME, name + '\x00'), (NFACCT_PKTS, U64_BE.pack(p)),
+          (NFACCT_BYTES, U64_BE.pack(b)))) for (name, b, p) in objs])
+      s_server.send(data)
+      s_server.send(NLMSGHDR.pack(NLMSGHDR.size + 4, NLMSG_DONE, NLM_F_MULTI,
+         seq, 0) + '\x00'*4)
+   thread = threading.Thread(target=responder)
+   thread.start()
+   nfa = NFAcct(s_client)
+   dump = nfa.dump()
+   thread.join()
+   assert(dump == list(objs)), dump
+   print('=== All tests passed. ===')
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Setting up nftables rules, and reading their named counters
+
+import json
+import logging
+import subprocess
+import sys
+
+from nfacct import NFAcctEntries, counter_entries_get
+
+NFT_BINARY = 'nft'
+NFT_FAMILY = 'inet'
+
+
+class NFTError(StandardError):
+   pass
+
+
+def nft_script_run(script, binary=NFT_BINARY):
+   """Apply nft script in one transaction."""
+   cmd = (binary, '-f', '-')
+   NFTCounters.log(20, 'Executing %r with %d script lines.' % (' '.join(cmd),
+      script.count('\n')))
+   NFTCounters.log(10, 'nft script: %r' % (script,))
+   p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+   p.communicate(script)
+   if (p.returncode):
+      raise NFTError('%r failed. rcode: %r' % (cmd, p.returncode))
+
+
+def nft_counters_parse(data, tablename):
+   """Return list of (name, bytes, packets) tuples for the counters of table
+      tablename in 'nft -j list counters' output data."""
+   try:
+      items = json.loads(data)['nftables']
+   except (ValueError, KeyError, TypeError):
+      raise NFTError('Invalid nft output: %r' % (data[:256],))
+   rv = []
+   for item in items:
+      try:
+         counter = item['counter']
+      except (KeyError, TypeError):
+         continue
+      if ((counter.get('family') != NFT_FAMILY) or
+          (counter.get('table') != tablename)):
+         continue
+      try:
+         rv.append((str(counter['name']), int(counter['bytes']),
+            int(counter['packets'])))
+      except (KeyError, ValueError, TypeError):
+         raise NFTError('Invalid counter description %r.' % (counter,))
+   return rv
+
+
+class NFTCounters:
+   """Read all named counters of an inet table with one nft call; can be used
+      in place of XTablesIP for polling counters.
+
+   The table's counters are presented as in NFAcct.get_entries()."""
+   logger = logging.getLogger('NFTCounters')
+   log = logger.log
+   binary = NFT_BINARY
+
+   def counters_get(self, tablename):
+      cmd = (self.binary, '-j', 'list', 'counters', 'table', NFT_FAMILY,
+         tablename)
+      p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      (out, err) = p.communicate()
+      if (p.returncode):
+         raise NFTError('%r failed with rcode %r: %r' % (cmd, p.returncode,
+            err))
+      return nft_counters_parse(out, tablename)
+
+   def get_info(self, tablename):
+      """Check that our counters can be read; raises ValueError otherwise."""
+      try:
+         self.counters_get(tablename)
+      except (NFTError, EnvironmentError):
+         raise ValueError('Unable to read counters of nft table %r: %s' %
+            (tablename, sys.exc_info()[1]))
+
+   def get_entries(self, tablename):
+      try:
+         counters = self.counters_get(tablename)
+      except (NFTError, EnvironmentError):
+         self.log(40, 'Failed to read counters: %s' % (sys.exc_info()[1],))
+         return NFAcctEntries([], valid=False)
+      return counter_entries_get(counters)
+
+
+if (__name__ == '__main__'):
+   # Here there be self-tests, against a fake nft binary.
+   import os
+   import shutil
+   import tempfile
+   tmpdir = tempfile.mkdtemp()
+   try:
+      binary = os.path.join(tmpdir, 'nft')
+      script_fn = os.path.join(tmpdir, 'script')
+      f = open(binary, 'w')
+      f.write('''#!/bin/sh
+if [ "$1" = -f ]; then
+   cat > '%s'
+   exit 0
+fi
+[ "$*" = "-j list counters table inet teuc" ] || {
+   echo "Error: No such file or directory" >&2; exit 1; }
+cat <<EOT
+{"nftables": [{"metainfo": {"version": "1.0.6", "json_schema_version": 1}},
+ {"counter": {"family": "inet", "name": "teuc_eth0_in_web", "table": "teuc",
+  "handle": 1, "packets": 67, "bytes": 12345}},
+ {"counter": {"family": "inet", "name": "teuc_eth0_out_web", "table": "teuc",
+  "handle": 2, "packets": 1, "bytes": 1099511627776}},
+ {"counter": {"family": "ip", "name": "other", "table": "teuc",
+  "handle": 3, "packets": 1, "bytes": 1}}]}
+EOT
+''' % (script_fn,))
+      f.close()
+      os.chmod(binary, 0o755)
+
+      nftc = NFTCounters()
+      nftc.binary = binary
+      counters = nftc.counters_get('teuc')
+      assert(counters == [('teuc_eth0_in_web', 12345, 67),
+         ('teuc_eth0_out_web', 2**40, 1)]), counters
+      entries = nftc.get_entries('teuc')
+      assert(entries.valid)
+      assert([(e.get_target_str(), e.get_chain_name()) for e in
+         entries.entries[::2]] == [('ERROR', 'teuc_eth0_in_web'),
+         ('ERROR', 'teuc_eth0_out_web')])
+      rule = entries.entries[1]
+      assert(rule.matches[0].data_get_str() == 'teuc_eth0_in_web')
+      assert((rule.counter_bytes, rule.counter_packets) == (12345, 67))
+      nftc.get_info('teuc')
+
+      # A failed read must not look like an empty table.
+      entries = nftc.get_entries('missing')
+      assert(not entries.valid and (entries.entries == []))
+      try:
+         nftc.get_info('missing')
+      except ValueError:
+         pass
+      else:
+         raise AssertionError('Failure of nft binary went unnoticed.')
+      for data in ('', '{"nftables": [{"counter": {"family": "inet", '
+            '"table": "teuc", "name": "x", "bytes": "many"}}]}'):
+         try:
+            nft_counters_parse(data, 'teuc')
+         except NFTError:
+            pass
+         else:
+            raise AssertionError('Accepted invalid nft output %r.' % (data,))
+
+      script = 'add table inet teuc\nadd counter inet teuc x\n'
+      nft_script_run(script, binary)
+      assert(open(script_fn).read() == script)
+   finally:
+      shutil.rmtree(tmpdir)
+   print('=== All tests passed. ===')
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Bulk queries over rrd files, into numpy arrays
+
+import fnmatch
+import logging
+import os.path
+import sys
+from multiprocessing.pool import ThreadPool
+
+import numpy
+import rrdtool
+
+from constants import *
+from rrd_fn import RRDFileNamer
+from rrd_writer import RRDCachedClient
+
+CF_DEFAULT = 'AVERAGE'
+# Names of the fields of series keys, in order
+KEY_FIELDS = ('iface', 'dir', 'ct', 'ds')
+
+
+class QueryError(StandardError):
+   pass
+
+
+def selector_parse(s):
+   """Parse 'IFACE/DIR/CT/DS' string of fnmatch patterns into a tuple."""
+   rv = tuple(s.split('/'))
+   if (len(rv) != len(KEY_FIELDS)):
+      raise QueryError('Invalid selector %r; expected %s.' % (s,
+         '/'.join([f.upper() for f in KEY_FIELDS])))
+   return rv
+
+
+def key_label_get(key):
+   """Return 'iface/dir/ct/ds' label for series key; fields that have been
+      aggregated over are shown as '*'."""
+   (iface, dir_, ct, ds) = key
+   rv = [iface, RRDFileNamer.FN_DIR.get(dir_), RRDFileNamer.FN_CT.get(ct), ds]
+   for i in range(len(rv)):
+      if (rv[i] is None):
+         rv[i] = '*'
+   return '/'.join(rv)
+
+
+def percentiles_get(values, q):
+   """Return q-th percentiles of the rows of 2d array values, ignoring NaNs,
+      with linear interpolation between data points. Rows without any data
+      get NaN."""
+   values = numpy.sort(values, axis=1)
+   counts = (~numpy.isnan(values)).sum(axis=1)
+   rows = numpy.arange(values.shape[0])
+   pos = (q/100.0)*numpy.maximum(counts - 1, 0)
+   lo = numpy.floor(pos).astype(int)
+   hi = numpy.ceil(pos).astype(int)
+   frac = pos - lo
+   rv = values[rows, lo]*(1 - frac) + values[rows, hi]*frac
+   rv[counts == 0] = numpy.nan
+   return rv
+
+
+def nan_sum(values, axis):
+   """Sum values along axis, ignoring NaNs; all-NaN slices give NaN."""
+   valid = ~numpy.isnan(values)
+   rv = numpy.where(valid, values, 0).sum(axis=axis)
+   rv[~valid.any(axis=axis)] = numpy.nan
+   return rv
+
+
+class QueryResult:
+   """Series aligned on a common time axis.
+
+   keys: list of (iface, dir_, ct, ds) tuples
+   ts: array of end times of the time axis' buckets
+   step: length of each bucket in seconds
+   values: 2d array of per-second rates, one row per key; NaN where unknown"""
+   def __init__(self, keys, ts, step, values):
+      self.keys = keys
+      self.ts = ts
+      self.step = step
+      self.values = values
+
+   def labels_get(self):
+      return [key_label_get(key) for key in self.keys]
+
+   def totals_get(self):
+      """Return total of each series over the whole time axis."""
+      return numpy.where(numpy.isnan(self.values), 0, self.values).sum(axis=1)*self.step
+
+   def rates_get(self):
+      """Return mean rate of each series, ignoring unknown values."""
+      counts = (~numpy.isnan(self.values)).sum(axis=1)
+      sums = numpy.where(numpy.isnan(self.values), 0, self.values).sum(axis=1)
+      rv = sums/numpy.maximum(counts, 1)
+      rv[counts == 0] = numpy.nan
+      return rv
+
+   def percentiles_get(self, q):
+      return percentiles_get(self.values, q)
+
+   def aggregate(self, fields):
+      """Return QueryResult with the sums of all series that agree in all of
+         the named key fields."""
+      groups = {}
+      for i in range(len(self.keys)):
+         key = []
+         for (field, val) in zip(KEY_FIELDS, self.keys[i]):
+            if not (field in fields):
+               val = None
+            key.append(val)
+         key = tuple(key)
+         groups.setdefault(key, []).append(i)
+      keys = list(groups.keys())
+      keys.sort(key=key_label_get)
+      values = numpy.empty((len(keys), len(self.ts)))
+      for i in range(len(keys)):
+         values[i] = nan_sum(self.values[groups[keys[i]]], 0)
+      return QueryResult(keys, self.ts, self.step, values)
+
+   def summary_get(self, op, arg=None):
+      """Reduce each series to one value; op is one of 'sum', 'rate', 'top'
+         (sums of the arg largest series) or 'percentile' (arg-th
+         percentile)."""
+      if (op == 'sum'):
+         return QuerySummary(self.keys, self.totals_get(), 'sum')
+      if (op == 'rate'):
+         return QuerySummary(self.keys, self.rates_get(), 'rate')
+      if (op == 'percentile'):
+         return QuerySummary(self.keys, self.percentiles_get(arg),
+            'p%g' % (arg,))
+      if (op == 'top'):
+         totals = self.totals_get()
+         idxs = numpy.argsort(-totals, kind='mergesort')[:arg]
+         return QuerySummary([self.keys[i] for i in idxs], totals[idxs], 'sum')
+      raise QueryError('Unknown operator %r.' % (op,))
+
+   def csv_write(self, f):
+      f.write(','.join(['ts'] + self.labels_get()) + '\n')
+      for i in range(len(self.ts)):
+         f.write(','.join(['%d' % self.ts[i]] +
+            [repr(float(v)) for v in self.values[:,i]]) + '\n')
+
+   def npz_write(self, f):
+      numpy.savez_compressed(f, ts=self.ts, step=self.step,
+         keys=numpy.array(self.labels_get()), values=self.values)
+
+
+class QuerySummary:
+   """One value for each of a list of series"""
+   def __init__(self, keys, values, name):
+      self.keys = keys
+      self.values = values
+      self.name = name
+
+   def labels_get(self):
+      return [key_label_get(key) for key in self.keys]
+
+   def csv_write(self, f):
+      f.write('series,%s\n' % (self.name,))
+      for (label, val) in zip(self.labels_get(), self.values):
+         f.write('%s,%r\n' % (label, float(val)))
+
+   def npz_write(self, f):
+      numpy.savez_compressed(f, keys=numpy.array(self.labels_get()),
+         values=self.values)
+
+
+class RRDQuery(RRDFileNamer):
+   """Resolve series selectors to the rrd files of one rule set"""
+   def __init__(self, rrd_base_filename, iface_specs, ds_l,
+         rrdcached_address=None, rrd_layout=LAYOUT_PER_RULE):
+      self.rrd_base_filename = rrd_base_filename
+      self.iface_specs = iface_specs
+      self.ds_l = ds_l
+      self.rrdcached_address = rrdcached_address
+      self.rrd_layout = rrd_layout
+
+   def targets_get(self, selector):
+      """Return list of ((iface, dir_, ct, ds), filename, rrd ds name,
+         rrdcached address) tuples for all our series matched by selector."""
+      (p_iface, p_dir, p_ct, p_ds) = selector
+      rv = []
+      for iface in self.iface_specs:
+         if not (fnmatch.fnmatchcase(iface, p_iface)):
+            continue
+         for (dir_, dir_s) in self.FN_DIR.items():
+            if not (fnmatch.fnmatchcase(dir_s, p_dir)):
+               continue
+            for (ct, ct_s) in self.FN_CT.items():
+               if not (fnmatch.fnmatchcase(ct_s, p_ct)):
+                  continue
+               for ds in self.ds_l:
+                  if not (fnmatch.fnmatchcase(ds, p_ds)):
+                     continue
+                  (fn, ds_name) = self.rrd_target_get(iface, dir_, ct, ds)
+                  rv.append(((iface, dir_, ct, ds), fn, ds_name,
+                     self.rrdcached_address))
+      return rv
+
+
+class RRDFetcher:
+   """Fetch series of many rrd files in parallel, and align them on a common
+      time axis"""
+   logger = logging.getLogger('RRDFetcher')
+   log = logger.log
+   def __init__(self, start, end, cf=CF_DEFAULT, resolution=None, threads=8):
+      self.start = start
+      self.end = end
+      self.cf = cf
+      self.resolution = resolution
+      self.threads = threads
+
+   def fetch(self, fn_spec):
+      """Return (start, step, ds names, values array with one column per ds)
+         for one file, or None on failure."""
+      (fn, rrdcached_address) = fn_spec
+      args = [fn, self.cf, '-s', str(self.start), '-e', str(self.end)]
+      if not (self.resolution is None):
+         args.extend(('-r', str(self.resolution)))
+      if not (rrdcached_address is None):
+         args.extend(('--daemon',
+            RRDCachedClient(rrdcached_address).rrdtool_address_get()))
+      try:
+         ((start, end, step), names, rows) = rrdtool.fetch(*args)
+      except rrdtool.error:
+         self.log(30, 'Failed to fetch data from %r: %s' % (fn,
+            sys.exc_info()[1]))
+         return None
+      values = numpy.array(rows, dtype=float).reshape((len(rows), len(names)))
+      return (start, step, list(names), values)
+
+   def query(self, targets):
+      """Return QueryResult for targets as returned by RRDQuery.targets_get().
+
+      Series with different steps are averaged into buckets of the largest
+      step among them. Targets whose files don't exist are skipped."""
+      fn_specs = []
+      seen = set()
+      for (key, fn, ds_name, rrdcached_address) in targets:
+         fn_spec = (fn, rrdcached_address)
+         if (fn_spec in seen):
+            continue
+         seen.add(fn_spec)
+         if not (os.path.exists(fn)):
+            continue
+         fn_specs.append(fn_spec)
+      if (self.threads > 1):
+         pool = ThreadPool(self.threads)
+         try:
+            fetched = pool.map(self.fetch, fn_specs)
+         finally:
+            pool.close()
+      else:
+         fetched = [self.fetch(fn_spec) for fn_spec in fn_specs]
+      fetched = dict([(fn_spec[0], data) for (fn_spec, data) in
+         zip(fn_specs, fetched) if not (data is None)])
+      if not (fetched):
+         raise QueryError('No data found.')
+
+      step = max([data[1] for data in fetched.values()])
+      t0 = (min([data[0] for data in fetched.values()])//step)*step
+      t1 = max([data[0] + data[1]*len(data[3]) for data in fetched.values()])
+      count = (t1 - t0 + step - 1)//step
+      ts = t0 + step*numpy.arange(1, count + 1, dtype=numpy.int64)
+
+      # Bucket sums and sample counts of each column of each file
+      binned = {}
+      for (fn, (start, fstep, names, values)) in fetched.items():
+         if not (len(values)):
+            continue
+         tss_end = start + fstep*numpy.arange(1, len(values) + 1)
+         idxs = (tss_end - t0 - 1)//step
+         idxs = (idxs[:,numpy.newaxis] + count*numpy.arange(len(names))).ravel()
+         vals = values.ravel()
+         valid = ~numpy.isnan(vals)
+         shape = (len(names), count)
+         sums = numpy.bincount(idxs[valid], vals[valid], count*len(names))
+         counts = numpy.bincount(idxs[valid], None, count*len(names))
+         binned[fn] = (names, sums.reshape(shape), counts.reshape(shape))
+
+      keys = []
+      rows = []
+      for (key, fn, ds_name, rrdcached_address) in targets:
+         try:
+            (names, sums, counts) = binned[fn]
+            col = names.index(ds_name)
+         except (KeyError, ValueError):
+            continue
+         row = sums[col]/numpy.maximum(counts[col], 1)
+         row[counts[col] == 0] = numpy.nan
+         keys.append(key)
+         rows.append(row)
+      if not (keys):
+         raise QueryError('No data found.')
+      return QueryResult(keys, ts, step, numpy.array(rows))
@@ -17,12 +17,131 @@
 
 # Classes for executing rrdcreate commands
 
+import fcntl
 import logging
 import os, os.path
+import sys
+import tempfile
+
+try:
+   import multiprocessing
+except ImportError:
+   multiprocessing = None
 
 import rrdtool
 
+from constants import LAYOUT_PER_RULE, LAYOUT_MULTI_DS
 from rrd_fn import RRDFileNamer
+from rrd_writer import RRDCachedClient
+
+
+# ioctl for sharing all extents of a file with another one; linux/fs.h
+FICLONE = 0x40049409
+CLONE_BUFSIZE = 1048576
+
+# On-disk sizes of rrd (version 0003) structures on 64bit platforms
+RRD_SIZE_STAT_HEAD = 128
+RRD_SIZE_DS_DEF = 120
+RRD_SIZE_RRA_DEF = 120
+RRD_SIZE_LIVE_HEAD = 16
+RRD_SIZE_PDP_PREP = 112
+RRD_SIZE_CDP_PREP = 80
+RRD_SIZE_RRA_PTR = 8
+RRD_SIZE_VALUE = 8
+
+
+def file_clone(src, dst):
+   """Copy file src to new file dst.
+   
+   Where the filesystem supports it, dst shares all of its extents with src.
+   Otherwise, the data is copied, within the kernel if os.copy_file_range()
+   or os.sendfile() are available. rrd archives start out filled with NaN,
+   so there are no zero blocks worth skipping."""
+   fd_src = os.open(src, os.O_RDONLY)
+   try:
+      fd_dst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+      try:
+         try:
+            fcntl.ioctl(fd_dst, FICLONE, fd_src)
+            return
+         except IOError:
+            pass
+         # Either of these may not be supported for the files at hand;
+         # that's fine as long as they fail before copying anything.
+         if (hasattr(os, 'copy_file_range')):
+            try:
+               while (os.copy_file_range(fd_src, fd_dst, CLONE_BUFSIZE)):
+                  pass
+               return
+            except OSError:
+               if (os.lseek(fd_dst, 0, os.SEEK_CUR)):
+                  raise
+         if (hasattr(os, 'sendfile')):
+            try:
+               while (os.sendfile(fd_dst, fd_src, None, CLONE_BUFSIZE)):
+                  pass
+               return
+            except OSError:
+               if (os.lseek(fd_dst, 0, os.SEEK_CUR)):
+                  raise
+         while (True):
+            data = os.read(fd_src, CLONE_BUFSIZE)
+            if not (data):
+               break
+            while (data):
+               data = data[os.write(fd_dst, data):]
+      finally:
+         os.close(fd_dst)
+   finally:
+      os.close(fd_src)
+
+
+def clone_job_run(job):
+   """Clone template file to target file, replacing the latter atomically.
+   
+   Returns (filename, error message or None)."""
+   (template_fn, fn) = job
+   fn_tmp = '%s.tmp.%d' % (fn, os.getpid())
+   RRDCreator.log(20, 'Creating %r.' % (os.path.abspath(fn),))
+   try:
+      file_clone(template_fn, fn_tmp)
+      os.rename(fn_tmp, fn)
+   except EnvironmentError:
+      try:
+         os.remove(fn_tmp)
+      except OSError:
+         pass
+      return (fn, str(sys.exc_info()[1]))
+   return (fn, None)
+
+
+def clone_jobs_run(jobs, processes=1):
+   """Run clone jobs, using up to processes worker processes.
+   
+   processes=0 means one per cpu. Failing jobs are logged and don't keep the
+   others from being run; returns set of filenames of failed jobs."""
+   if ((processes != 1) and (multiprocessing is None)):
+      RRDCreator.log(30, 'multiprocessing module not available; creating files serially.')
+      processes = 1
+   if (processes == 0):
+      processes = multiprocessing.cpu_count()
+   
+   if ((processes == 1) or (len(jobs) < 2)):
+      results = map(clone_job_run, jobs)
+   else:
+      pool = multiprocessing.Pool(min(processes, len(jobs)))
+      try:
+         results = list(pool.imap_unordered(clone_job_run, jobs, 16))
+      finally:
+         pool.terminate()
+   
+   rv = set()
+   for (fn, error) in results:
+      if (error is None):
+         continue
+      RRDCreator.log(40, 'Failed to create file %r: %s' % (fn, error))
+      rv.add(fn)
+   return rv
 
 
 class RRASpec:
@@ -43,7 +162,8 @@ class RRDCreator(RRDFileNamer):
    DST = 'DERIVE'
    min = 0
    def __init__(self, rrd_base_filename, iface_specs, ds_l, rra_specs, step,
-         heartbeat, rrd_max):
+         heartbeat, rrd_max, rrdcached_address=None,
+         rrd_layout=LAYOUT_PER_RULE, start=None):
       self.rrd_base_filename = rrd_base_filename
       self.iface_specs = iface_specs
       self.ds_l = ds_l
@@ -51,21 +171,113 @@ class RRDCreator(RRDFileNamer):
       self.step = step
       self.heartbeat = heartbeat
       self.max = rrd_max
+      self.rrd_layout = rrd_layout
+      self.start = start
+      if (rrdcached_address is None):
+         self.rrdcached = None
+      else:
+         self.rrdcached = RRDCachedClient(rrdcached_address)
    
-   def create(self, overwrite=False):
+   def rrd_specs_iter(self):
+      """Yield (filename, rrd ds names) for all files we're responsible for"""
+      if (self.rrd_layout == LAYOUT_MULTI_DS):
+         for rrd_filename in self.rrd_fn_iter_multi(self.iface_specs):
+            yield (rrd_filename, self.ds_l)
+         return
       for rrd_filename in self.rrd_fn_iter_allbyifaceandds(self.iface_specs, self.ds_l):
-         rfn_abs = os.path.abspath(rrd_filename)
-         rdir = os.path.dirname(rrd_filename)
-         if not (os.path.exists(rdir)):
-            os.makedirs(rdir)
+         yield (rrd_filename, (self.DS_RAW,))
+   
+   def create_args_get(self, ds_names, start=None):
+      """Return rrdcreate arguments (not including filename) for a file
+         with the specified DS"""
+      if (start is None):
+         start = self.start
+      args = ['-s', str(int(self.step))]
+      if not (start is None):
+         args.extend(('-b', str(int(start))))
+      for ds in ds_names:
+         args.append('DS:%s:%s:%d:%s:%s' % (ds, self.DST, self.heartbeat,
+            self.min, self.max))
+      args.extend([rra.rrdcs_str() for rra in self.rra_specs])
+      return args
+   
+   def file_size_get(self, ds_count):
+      """Return estimated size of an rrd file with ds_count DS."""
+      rra_count = len(self.rra_specs)
+      rows = sum([rra.rows for rra in self.rra_specs])
+      return (RRD_SIZE_STAT_HEAD + ds_count*RRD_SIZE_DS_DEF +
+         rra_count*RRD_SIZE_RRA_DEF + RRD_SIZE_LIVE_HEAD +
+         ds_count*RRD_SIZE_PDP_PREP + rra_count*ds_count*RRD_SIZE_CDP_PREP +
+         rra_count*RRD_SIZE_RRA_PTR + rows*ds_count*RRD_SIZE_VALUE)
+   
+   def create_jobs_get(self, overwrite=False):
+      """Return list of (rrd filename, ds names) for the files create() would
+         write."""
+      rv = []
+      for (rrd_filename, ds_names) in self.rrd_specs_iter():
          if ((not overwrite) and os.path.exists(rrd_filename)):
-            self.log(20, 'Not replacing existing file %r.' % (rfn_abs,))
+            self.log(20, 'Not replacing existing file %r.' % (os.path.abspath(rrd_filename),))
             continue
-         
-         self.log(20, 'Creating %r.' % (rfn_abs,))
-         args = [rrd_filename, '-s', str(int(self.step)),
-            'DS:%s:%s:%d:%s:%s' % (self.DS_RAW, self.DST,
-            self.heartbeat,self.min,self.max)]
-         args.extend([rra.rrdcs_str() for rra in self.rra_specs])
-         rrdtool.create(*args)
+         rv.append((rrd_filename, ds_names))
+      return rv
+   
+   def plan_get(self, overwrite=False):
+      """Return (file count, estimated byte count, template count) for a
+         create() call with the same arguments."""
+      jobs = self.create_jobs_get(overwrite)
+      ds_sets = set([tuple(ds_names) for (fn, ds_names) in jobs])
+      return (len(jobs), sum([self.file_size_get(len(ds_names)) for
+         (fn, ds_names) in jobs]), len(ds_sets))
+   
+   def template_create(self, ds_names, start=None):
+      """Create template rrd file with the specified DS next to our files,
+         to be cloned with clone_job_run(); return its filename.
+      
+      The caller is responsible for removing it."""
+      tdir = os.path.dirname(self.rrd_base_filename) or '.'
+      if not (os.path.exists(tdir)):
+         os.makedirs(tdir)
+      (fd, template_fn) = tempfile.mkstemp(suffix='.rrd', prefix='.template_',
+         dir=tdir)
+      os.close(fd)
+      try:
+         rrdtool.create(template_fn, *self.create_args_get(ds_names, start))
+      except:
+         os.remove(template_fn)
+         raise
+      return template_fn
+   
+   def create(self, overwrite=False, processes=1):
+      """Create our rrd files.
+      
+      Only one file is built by rrdtool for each distinct set of DS; the
+      others are cloned from it, by up to processes worker processes
+      (0 meaning one per cpu). Returns set of filenames of files that
+      couldn't be created."""
+      by_ds = {}
+      for (rrd_filename, ds_names) in self.create_jobs_get(overwrite):
+         by_ds.setdefault(tuple(ds_names), []).append(rrd_filename)
+         rdir = os.path.dirname(rrd_filename)
+         if (rdir and not os.path.exists(rdir)):
+            os.makedirs(rdir)
+         if (os.path.exists(rrd_filename) and self.rrdcached):
+            # Don't let rrdcached write stale updates into the new file.
+            self.rrdcached.forget(rrd_filename)
+      
+      templates = []
+      jobs = []
+      try:
+         for (ds_names, fns) in by_ds.items():
+            template_fn = self.template_create(ds_names)
+            templates.append(template_fn)
+            self.log(20, 'Creating template %r for %d files.' % (template_fn,
+               len(fns)))
+            jobs.extend([(template_fn, fn) for fn in fns])
+         return clone_jobs_run(jobs, processes)
+      finally:
+         for template_fn in templates:
+            try:
+               os.remove(template_fn)
+            except OSError:
+               pass
 
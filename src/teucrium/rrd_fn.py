@@ -21,6 +21,7 @@ from constants import *
 
 class RRDFileNamer:
    RRD_FN_FMT = '%s%s_%s_%s/%s.rrd'
+   RRD_FN_MULTI_FMT = '%s%s_%s_%s.rrd'
    FN_DIR = {
       DIR_IN:'in',
       DIR_OUT:'out'
@@ -30,6 +31,7 @@ class RRDFileNamer:
       CT_PACKETS:'packets'
    }
    DS_RAW = 'data'
+   rrd_layout = LAYOUT_PER_RULE
    def rrd_fn_get(self, iface, dir_, counter_type, ds):
       return self.RRD_FN_FMT % (self.rrd_base_filename, iface, self.FN_DIR[dir_], self.FN_CT[counter_type], ds)
 
@@ -38,4 +40,20 @@ class RRDFileNamer:
          for dirstring in self.FN_DIR.values():
             for cts in self.FN_CT.values():
                for ds in ds_s:
-                  yield self.RRD_FN_FMT % (self.rrd_base_filename, iface_spec, dirstring, cts, ds)
\ No newline at end of file
+                  yield self.RRD_FN_FMT % (self.rrd_base_filename, iface_spec, dirstring, cts, ds)
+
+   def rrd_fn_multi_get(self, iface, dir_, counter_type):
+      return self.RRD_FN_MULTI_FMT % (self.rrd_base_filename, iface, self.FN_DIR[dir_], self.FN_CT[counter_type])
+
+   def rrd_fn_iter_multi(self, iface_specs):
+      for iface_spec in iface_specs:
+         for dir_ in self.FN_DIR:
+            for ct in self.FN_CT:
+               yield self.rrd_fn_multi_get(iface_spec, dir_, ct)
+
+   def rrd_target_get(self, iface, dir_, counter_type, ds):
+      """Return (filename, rrd ds name) to store data for ds in, according
+         to our rrd_layout."""
+      if (self.rrd_layout == LAYOUT_MULTI_DS):
+         return (self.rrd_fn_multi_get(iface, dir_, counter_type), ds)
+      return (self.rrd_fn_get(iface, dir_, counter_type, ds), self.DS_RAW)
@@ -18,10 +18,25 @@
 # Classes for rrd data graphing
 
 import logging
+import os
+import sys
+import time
+import zlib
+
+try:
+   import cPickle as pickle
+except ImportError:
+   import pickle
+
+try:
+   import multiprocessing
+except ImportError:
+   multiprocessing = None
 
 import rrdtool
 
 from rrd_fn import RRDFileNamer
+from rrd_writer import RRDCachedClient
 from constants import *
 
 class RRDGrapher(RRDFileNamer):
@@ -30,13 +45,15 @@ class RRDGrapher(RRDFileNamer):
    IMG_FMT = 'PNG'
    TITLE_FMT = '%(ct_str)s on %(ifs)s'
    FN_FMT = '%s%s_%s_%s.png'
+   STATE_FN_FMT = '%sgraph_state.pickle'
    CT_LABELS = {
       CT_BYTES:'bytes',
       CT_PACKETS:'packets'
    }
    CF = 'AVERAGE'
    def __init__(self, rrd_base_filename, interface_specs, rules, periods, base,
-         img_width, img_height, counter_types, ifn_prefix, extra_arguments):
+         img_width, img_height, counter_types, ifn_prefix, extra_arguments,
+         rrdcached_address=None, rrd_layout=LAYOUT_PER_RULE):
       self.rrd_base_filename = rrd_base_filename
       self.interface_specs = interface_specs
       self.rules = rules[:]
@@ -48,54 +65,235 @@ class RRDGrapher(RRDFileNamer):
       self.img_height = img_height
       self.ifn_prefix = ifn_prefix	# prefix for imge files to write
       self.extra_arguments = extra_arguments
+      self.rrdcached_address = rrdcached_address
+      self.rrd_layout = rrd_layout
+      self.state_fn = self.STATE_FN_FMT % (ifn_prefix,)
+      self.state_pending = {}
    
-   def data_graph(self):
+   def graph_args_get(self, img_width=None, img_height=None):
+      """Return rrdgraph arguments shared by all our graphs"""
+      if (img_width is None):
+         img_width = self.img_width
+      if (img_height is None):
+         img_height = self.img_height
       graph_args = [
          '-z',
          '-a', self.IMG_FMT,
          '-b', str(self.base),
-         '-w', str(self.img_width),
-         '-h', str(self.img_height),
+         '-w', str(img_width),
+         '-h', str(img_height),
       ] 
+      if not (self.rrdcached_address is None):
+         # Have rrdcached flush pending updates for our files before reading them
+         graph_args.extend(('--daemon', RRDCachedClient(
+            self.rrdcached_address).rrdtool_address_get()))
       graph_args.extend(self.extra_arguments)
+      return graph_args
+   
+   def graph_defs_get(self, ct, ifs):
+      """Return (defs, graph_cmds, rrd filenames) for graphing counter type ct
+         on ifs"""
+      defs = []
+      graph_cmds = []
+      rrd_fns = []
+      for (dir_, dir_str) in self.FN_DIR.items():
+         stackstr = ''
+         for rule in self.rules:
+            (rrd_fn, rrd_ds) = self.rrd_target_get(ifs, dir_, ct, rule.ds)
+            rrd_fns.append(rrd_fn)
+            vname = '%s_%s_%s' % (ifs,dir_str,rule.ds)
+            vname = vname.replace('+','_')
+            defs.append('DEF:%s=%s:%s:%s' % (vname, rrd_fn, rrd_ds, self.CF))
+            if (dir_ == DIR_OUT):
+               # Invert sign for outgoing traffic to graph it below x-axis
+               vname2 = vname + '_'
+               defs.append('CDEF:%s=%s,-1,*' % (vname2,vname))
+               vname = vname2
+            
+            # mask unknowns so as not to break stacking
+            vname2 = vname + '_'
+            defs.append('CDEF:%s=%s,UN,0,%s,IF' % (vname2,vname,vname))
+            vname = vname2
+            
+            graph_legend = ''
+            if (rule.legend and rule.color and (dir_ == DIR_IN)):
+               graph_legend += '%s' % (rule.legend,)
+            
+            graph_cmd = 'AREA:%s%s:%s:%s' % (vname,rule.color,graph_legend,stackstr)
+            graph_cmds.append(graph_cmd)
+            if (stackstr == ''):
+               stackstr = 'STACK'
+      return (defs, graph_cmds, rrd_fns)
+   
+   def graph_render_args_get(self, ct, ifs, time_args, img_width=None,
+         img_height=None, graph_args=None, defs=None):
+      """Return rrdgraph arguments for graphing counter type ct on ifs.
+      
+      time_args: rrdgraph arguments specifying the time window
+      graph_args, defs: results of graph_args_get() and graph_defs_get(), if
+            already known"""
+      if (graph_args is None):
+         graph_args = self.graph_args_get(img_width, img_height)
+      if (defs is None):
+         defs = self.graph_defs_get(ct, ifs)
+      ct_str = self.CT_LABELS[ct]
+      return (['-t', (self.TITLE_FMT % locals())] + list(time_args) +
+         graph_args + defs[0] + defs[1])
+   
+   def graph_state_read(self):
+      """Return {image filename: (args checksum, render time, inputs mtime)}
+         as recorded by graph_state_commit()."""
+      try:
+         f = open(self.state_fn, 'rb')
+      except IOError:
+         return {}
+      try:
+         try:
+            return pickle.load(f)
+         except (pickle.UnpicklingError, EOFError, ValueError):
+            self.log(30, 'Ignoring invalid graph state file %r.' % (self.state_fn,))
+            return {}
+      finally:
+         f.close()
+   
+   def graph_state_commit(self, fns_failed=()):
+      """Record state of the graphs returned by our last graph_jobs_get()
+         call, except for those whose rendering failed."""
+      state = self.graph_state_read()
+      for (fn, staterec) in self.state_pending.items():
+         if (fn in fns_failed):
+            state.pop(fn, None)
+         else:
+            state[fn] = staterec
+      self.state_pending = {}
+      
+      fn_tmp = '%s.tmp.%d' % (self.state_fn, os.getpid())
+      f = open(fn_tmp, 'wb')
+      try:
+         pickle.dump(state, f, 2)
+      finally:
+         f.close()
+      os.rename(fn_tmp, self.state_fn)
+   
+   def graph_stale(self, fn, period, staterec, staterec_old):
+      """Determine whether image fn needs to be re-rendered.
+      
+      Images are only worth re-rendering once the graphed time window has
+      moved by at least one pixel; even then, we skip them until their input
+      files have changed, or the entire window has moved on."""
+      if ((staterec_old is None) or (staterec[0] != staterec_old[0]) or
+         not os.path.exists(fn)):
+         return True
+      elapsed = staterec[1] - staterec_old[1]
+      if (elapsed >= period):
+         return True
+      return ((elapsed >= float(period)/self.img_width) and
+         (staterec[2] != staterec_old[2]))
+   
+   def inputs_mtime_get(self, rrd_fns):
+      """Return latest mtime of rrd files rrd_fns.
+      
+      With rrdcached, updates may sit in its cache for a long time without
+      touching the files, so we have it flush them first."""
+      rrd_fns = sorted(set(rrd_fns))
+      if not (self.rrdcached_address is None):
+         rrdcached = RRDCachedClient(self.rrdcached_address)
+         try:
+            rrdcached.commands_send(['FLUSH %s' % (rrdcached.fn_get(fn),)
+               for fn in rrd_fns])
+         except (EnvironmentError, ValueError):
+            self.log(30, 'Failed to FLUSH rrd files through rrdcached: %s' %
+               (sys.exc_info()[1],))
+         rrdcached.close()
+      rv = 0
+      for fn in rrd_fns:
+         try:
+            rv = max(rv, os.stat(fn).st_mtime)
+         except OSError:
+            pass
+      return rv
+   
+   def graph_jobs_get(self, force=False):
+      """Return sequence of (filename, rrdgraph arguments) for our graphs.
       
+      Unless force is specified, only return jobs for graphs that are
+      outdated according to graph_stale(). Call graph_state_commit() after
+      executing the jobs."""
+      graph_args = self.graph_args_get()
+      state = self.graph_state_read()
+      now = time.time()
+      rv = []
       for ct in self.ct_s:
+         ct_str = self.CT_LABELS[ct]
          for ifs in self.interface_specs:
+            defs = self.graph_defs_get(ct, ifs)
+            inputs_mtime = self.inputs_mtime_get(defs[2])
             for period in self.periods:
-               defs = []
-               graph_cmds = []
-               for (dir_, dir_str) in self.FN_DIR.items():
-                  stackstr = ''
-                  for rule in self.rules:
-                     rrd_fn = self.rrd_fn_get(ifs, dir_, ct, rule.ds)
-                     vname = '%s_%s_%s' % (ifs,dir_str,rule.ds)
-                     vname = vname.replace('+','_')
-                     defs.append('DEF:%s=%s:%s:%s' % (vname, rrd_fn, self.DS_RAW, self.CF))
-                     if (dir_ == DIR_OUT):
-                        # Invert sign for outgoing traffic to graph it below x-axis
-                        vname2 = vname + '_'
-                        defs.append('CDEF:%s=%s,-1,*' % (vname2,vname))
-                        vname = vname2
-                     
-                     # mask unknowns so as not to break stacking
-                     vname2 = vname + '_'
-                     defs.append('CDEF:%s=%s,UN,0,%s,IF' % (vname2,vname,vname))
-                     vname = vname2
-                     
-                     graph_legend = ''
-                     if (rule.legend and rule.color and (dir_ == DIR_IN)):
-                        graph_legend += '%s' % (rule.legend,)
-                     
-                     graph_cmd = 'AREA:%s%s:%s:%s' % (vname,rule.color,graph_legend,stackstr)
-                     graph_cmds.append(graph_cmd)
-                     if (stackstr == ''):
-                        stackstr = 'STACK'
-         
-               ct_str = self.CT_LABELS[ct]
                fn = self.FN_FMT % (self.ifn_prefix, ifs, ct_str, period)
-               self.log(20, 'Updating file %r.' % (fn,))
-               rrdtool.graph(fn, 
-                  '-t', (self.TITLE_FMT % locals()),
-                  '-s', str(-1*period),
-                  *(graph_args + defs + graph_cmds))
+               args = self.graph_render_args_get(ct, ifs, ('-s', str(-1*period)),
+                  graph_args=graph_args, defs=defs)
+               staterec = (zlib.crc32('\0'.join(args)), now, inputs_mtime)
+               if not (force or self.graph_stale(fn, period, staterec,
+                     state.get(fn))):
+                  self.log(10, 'Skipping up-to-date file %r.' % (fn,))
+                  continue
+               self.state_pending[fn] = staterec
+               rv.append((fn, args))
+      return rv
+   
+   def data_graph(self, force=False):
+      fns_failed = graph_jobs_run(self.graph_jobs_get(force))
+      self.graph_state_commit(fns_failed)
+      return fns_failed
+
 
+def graph_job_run(job):
+   """Render one graph job, replacing its target file atomically.
+   
+   Returns (filename, error message or None); any failure is returned
+   rather than raised, so one broken job can't keep the others from being
+   rendered."""
+   (fn, args) = job
+   fn_tmp = '%s.tmp.%d' % (fn, os.getpid())
+   RRDGrapher.log(20, 'Updating file %r.' % (fn,))
+   try:
+      rrdtool.graph(fn_tmp, *args)
+      os.rename(fn_tmp, fn)
+   except Exception:
+      (exc_type, exc) = sys.exc_info()[:2]
+      try:
+         os.remove(fn_tmp)
+      except OSError:
+         pass
+      if (isinstance(exc, (rrdtool.error, EnvironmentError))):
+         return (fn, str(exc))
+      return (fn, '%s: %s' % (exc_type.__name__, exc))
+   return (fn, None)
+
+def graph_jobs_run(jobs, processes=1):
+   """Render graph jobs, using up to processes worker processes.
+   
+   processes=0 means one per cpu. Failing jobs are logged and don't keep the
+   others from being rendered; returns set of filenames of failed jobs."""
+   if ((processes != 1) and (multiprocessing is None)):
+      RRDGrapher.log(30, 'multiprocessing module not available; rendering graphs serially.')
+      processes = 1
+   if (processes == 0):
+      processes = multiprocessing.cpu_count()
+   
+   if (processes == 1):
+      results = map(graph_job_run, jobs)
+   else:
+      pool = multiprocessing.Pool(processes)
+      try:
+         results = list(pool.imap_unordered(graph_job_run, jobs))
+      finally:
+         pool.terminate()
+   
+   rv = set()
+   for (fn, error) in results:
+      if (error is None):
+         continue
+      RRDGrapher.log(40, 'Failed to update file %r: %s' % (fn, error))
+      rv.add(fn)
+   return rv
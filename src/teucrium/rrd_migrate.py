@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Classes for converting rrd db files between storage layouts
+
+import copy
+import logging
+import os, os.path
+import subprocess
+import sys
+
+try:
+   import xml.etree.cElementTree as ElementTree
+except ImportError:
+   import xml.etree.ElementTree as ElementTree
+
+from constants import *
+from rrd_fn import RRDFileNamer
+from rrd_writer import RRDCachedClient
+
+
+class RRDMigrationError(StandardError):
+   pass
+
+
+class RRDMigrator(RRDFileNamer):
+   """Merge per-rule rrd files into one multi-DS file per (iface, dir, ct).
+
+   Merging is done on the rrddump XML representation, so all RRAs are
+   carried over as they are; this requires all per-rule files of one target
+   to share their RRA layout and last update time, which is the case for
+   files created by RRDCreator and fed by the same daemon. Existing
+   multi-DS files get blank DS added for any ds they lack."""
+   logger = logging.getLogger('RRDMigrator')
+   log = logger.log
+   NAN = 'NaN'
+   def __init__(self, rrd_base_filename, iface_specs, ds_l,
+         rrdcached_address=None):
+      self.rrd_base_filename = rrd_base_filename
+      self.iface_specs = iface_specs
+      self.ds_l = ds_l
+      if (rrdcached_address is None):
+         self.rrdcached = None
+      else:
+         self.rrdcached = RRDCachedClient(rrdcached_address)
+
+   def rrd_dump(self, fn):
+      if (self.rrdcached):
+         try:
+            self.rrdcached.command_send('FLUSH %s' % (self.rrdcached.fn_get(fn),))
+         except (EnvironmentError, ValueError):
+            raise RRDMigrationError('Failed to FLUSH %r through rrdcached: %s'
+               % (fn, sys.exc_info()[1]))
+      p = subprocess.Popen(('rrdtool', 'dump', fn), stdout=subprocess.PIPE)
+      (data, _) = p.communicate()
+      if (p.returncode):
+         raise RRDMigrationError('rrdtool dump %r failed. rcode: %r' % (fn, p.returncode))
+      return ElementTree.fromstring(data)
+
+   def rrd_restore(self, tree, fn):
+      fn_xml = '%s.xml.tmp.%d' % (fn, os.getpid())
+      fn_tmp = '%s.tmp.%d' % (fn, os.getpid())
+      ElementTree.ElementTree(tree).write(fn_xml)
+      try:
+         rcode = subprocess.call(('rrdtool', 'restore', fn_xml, fn_tmp))
+      finally:
+         os.remove(fn_xml)
+      if (rcode):
+         raise RRDMigrationError('rrdtool restore into %r failed. rcode: %r' % (fn, rcode))
+      os.rename(fn_tmp, fn)
+
+   @staticmethod
+   def ds_name_set(ds_elem, name):
+      ds_elem.find('name').text = ' %s ' % (name,)
+
+   def ds_blank(self, ds_elem, name):
+      """Return copy of ds_elem with all state reset to unknown."""
+      rv = copy.deepcopy(ds_elem)
+      self.ds_name_set(rv, name)
+      rv.find('last_ds').text = 'U'
+      rv.find('value').text = self.NAN
+      return rv
+
+   def cdp_blank(self, cdp_elem):
+      """Return copy of RRA cdp_prep ds element cdp_elem with all values
+         reset to unknown."""
+      rv = copy.deepcopy(cdp_elem)
+      for sub in rv:
+         if (sub.tag != 'unknown_datapoints'):
+            sub.text = self.NAN
+      return rv
+
+   @staticmethod
+   def ds_names_get(tree):
+      return [elem.find('name').text.strip() for elem in tree.findall('ds')]
+
+   def ds_missing_add(self, fn):
+      """Add blank DS to multi-DS file fn for any of our ds it lacks; return
+         list of the ones added."""
+      tree = self.rrd_dump(fn)
+      missing = [ds for ds in self.ds_l if not (ds in self.ds_names_get(tree))]
+      if not (missing):
+         return missing
+      ds_elems = tree.findall('ds')
+      idx_ds = list(tree).index(ds_elems[-1]) + 1
+      for ds in missing:
+         tree.insert(idx_ds, self.ds_blank(ds_elems[0], ds))
+         idx_ds += 1
+      for rra in tree.findall('rra'):
+         cdp_prep = rra.find('cdp_prep')
+         cdp_base = cdp_prep.find('ds')
+         for ds in missing:
+            cdp_prep.append(self.cdp_blank(cdp_base))
+         for row in rra.find('database'):
+            for ds in missing:
+               ElementTree.SubElement(row, 'v').text = self.NAN
+      self.rrd_restore(tree, fn)
+      return missing
+
+   def trees_merge(self, trees):
+      """Merge single-DS dump trees into one multi-DS tree.
+
+      trees: sequence of (ds, tree or None), ordered by ds"""
+      base = None
+      for (ds, tree) in trees:
+         if not (tree is None):
+            base = tree
+            break
+
+      lastupdate = base.find('lastupdate').text
+      rra_shapes = [len(rra.find('database')) for rra in base.findall('rra')]
+      for (ds, tree) in trees:
+         if (tree is None):
+            continue
+         if (tree.find('lastupdate').text != lastupdate):
+            raise RRDMigrationError('Last update time of ds %r (%s) differs from'
+               ' %s.' % (ds, tree.find('lastupdate').text, lastupdate))
+         if ([len(rra.find('database')) for rra in tree.findall('rra')] != rra_shapes):
+            raise RRDMigrationError('RRA layout of ds %r differs.' % (ds,))
+
+      rv = copy.deepcopy(base)
+      ds_base = rv.find('ds')
+      idx_ds = list(rv).index(ds_base)
+      for elem in rv.findall('ds'):
+         rv.remove(elem)
+      for (ds, tree) in trees:
+         if (tree is None):
+            ds_elem = self.ds_blank(ds_base, ds)
+         else:
+            ds_elem = tree.find('ds')
+            self.ds_name_set(ds_elem, ds)
+         rv.insert(idx_ds, ds_elem)
+         idx_ds += 1
+
+      rras_src = []
+      for (ds, tree) in trees:
+         if (tree is None):
+            rras_src.append(None)
+         else:
+            rras_src.append(tree.findall('rra'))
+
+      for i in range(len(rra_shapes)):
+         rra = rv.findall('rra')[i]
+         cdp_prep = rra.find('cdp_prep')
+         cdp_base = cdp_prep.find('ds')
+         cdp_prep.remove(cdp_base)
+         rows = list(rra.find('database'))
+         for row in rows:
+            for v in list(row):
+               row.remove(v)
+         for rras in rras_src:
+            if (rras is None):
+               cdp_prep.append(self.cdp_blank(cdp_base))
+               for row in rows:
+                  v = ElementTree.SubElement(row, 'v')
+                  v.text = self.NAN
+               continue
+            rra_src = rras[i]
+            cdp_prep.append(rra_src.find('cdp_prep').find('ds'))
+            for (row, row_src) in zip(rows, rra_src.find('database')):
+               row.append(row_src.find('v'))
+      return rv
+
+   def migrate(self, overwrite=False):
+      """Build multi-DS files from per-rule ones, and add missing DS to
+         existing ones; returns number of failures."""
+      failures = 0
+      for iface_spec in self.iface_specs:
+         for dir_ in self.FN_DIR:
+            for ct in self.FN_CT:
+               fn = self.rrd_fn_multi_get(iface_spec, dir_, ct)
+               if ((not overwrite) and os.path.exists(fn)):
+                  self.log(20, 'Not replacing existing file %r.' % (fn,))
+                  try:
+                     added = self.ds_missing_add(fn)
+                  except (RRDMigrationError, EnvironmentError):
+                     self.log(40, 'Failed to add DS to %r: %s' % (fn,
+                        sys.exc_info()[1]))
+                     failures += 1
+                     continue
+                  if (added):
+                     self.log(20, 'Added DS %s to %r.' % (', '.join(added),
+                        fn))
+                  continue
+               fns_src = []
+               for ds in self.ds_l:
+                  fn_src = self.rrd_fn_get(iface_spec, dir_, ct, ds)
+                  if (os.path.exists(fn_src)):
+                     fns_src.append((ds, fn_src))
+                  else:
+                     self.log(30, 'Missing %r; data for ds %r will be unknown.' % (fn_src, ds))
+                     fns_src.append((ds, None))
+
+               if not ([fn_src for (ds, fn_src) in fns_src if fn_src]):
+                  self.log(30, 'No per-rule files for %r; skipping.' % (fn,))
+                  continue
+
+               self.log(20, 'Merging %d per-rule files into %r.' % (len(fns_src), fn))
+               try:
+                  trees = []
+                  for (ds, fn_src) in fns_src:
+                     if (fn_src is None):
+                        trees.append((ds, None))
+                     else:
+                        trees.append((ds, self.rrd_dump(fn_src)))
+                  self.rrd_restore(self.trees_merge(trees), fn)
+               except (RRDMigrationError, EnvironmentError):
+                  self.log(40, 'Failed to build %r: %s' % (fn, sys.exc_info()[1]))
+                  failures += 1
+      return failures
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reading rrd files directly, without going through rrdtool
+#
+# rrd files are stored in the native layout of the C structures in rrdtool's
+# rrd_format.h, so they can only be read on the kind of platform that wrote
+# them. The file is made up of:
+#  stat_head, ds_cnt * ds_def, rra_cnt * rra_def, live_head,
+#  ds_cnt * pdp_prep, rra_cnt * ds_cnt * cdp_prep, rra_cnt * rra_ptr,
+#  then for each rra, row_cnt rows of ds_cnt doubles.
+# Each rra is a ring buffer; rra_ptr holds the index of its newest row.
+
+import mmap
+import os
+import struct
+
+import numpy
+
+RRD_COOKIE = 'RRD\x00'
+FLOAT_COOKIE = 8.642135E130
+RRD_VERSIONS = ('0001', '0002', '0003', '0004')
+
+# unival par[10] is read as doubles; we don't need any of the integer ones.
+STAT_HEAD = struct.Struct('@4s5sdLLL10d')
+DS_DEF = struct.Struct('@20s20s10d')
+RRA_DEF = struct.Struct('@20sLL10d')
+LIVE_HEAD = struct.Struct('@ll')
+LIVE_HEAD_V1 = struct.Struct('@l')
+PDP_PREP = struct.Struct('@30s10d')
+CDP_PREP = struct.Struct('@10d')
+RRA_PTR = struct.Struct('@L')
+VALUE_SIZE = 8
+
+
+class RRDFormatError(StandardError):
+   pass
+
+
+def cstr_get(s):
+   return s.split('\x00', 1)[0]
+
+
+class RRDArchive:
+   """One RRA of an rrd file.
+
+   data is the ring buffer as stored in the file: a (row_cnt, ds_cnt) array
+   view on the file's data, without any copying. Rows are in chronological
+   order starting after cur_row, wrapping around at the end."""
+   def __init__(self, cf, pdp_cnt, xff, step, end, cur_row, data):
+      self.cf = cf
+      self.pdp_cnt = pdp_cnt
+      self.xff = xff
+      # Seconds covered by each row
+      self.step = step
+      # End of the time covered by the newest row
+      self.end = end
+      self.cur_row = cur_row
+      self.data = data
+      self.row_cnt = data.shape[0]
+
+   def start_get(self):
+      """Return beginning of the time covered by the oldest row."""
+      return self.end - self.step*self.row_cnt
+
+   def parts_get(self):
+      """Return (older, newer) views of our rows, which together hold all of
+         them in chronological order."""
+      return (self.data[self.cur_row+1:], self.data[:self.cur_row+1])
+
+   def ts_get(self):
+      """Return array of the end times of all rows, in chronological order."""
+      return self.end - self.step*numpy.arange(self.row_cnt - 1, -1, -1,
+         dtype=numpy.int64)
+
+   def range_get(self, start, end):
+      """Return (end times, values) of the rows ending in (start, end], in
+         chronological order.
+
+      values is a view on the file's data if those rows don't wrap around
+      the end of the ring buffer, and a copy otherwise."""
+      first = max((start - self.start_get())//self.step, 0)
+      last = min((end - self.start_get())//self.step, self.row_cnt)
+      if (first >= last):
+         return (numpy.empty(0, dtype=numpy.int64), self.data[:0])
+      ts = self.start_get() + self.step*numpy.arange(first + 1, last + 1,
+         dtype=numpy.int64)
+      # Ring indices of chronological rows first and last-1
+      i0 = (self.cur_row + 1 + first) % self.row_cnt
+      i1 = (self.cur_row + last) % self.row_cnt
+      if (i0 <= i1):
+         return (ts, self.data[i0:i1+1])
+      return (ts, numpy.concatenate((self.data[i0:], self.data[:i1+1])))
+
+
+class RRDFile:
+   """Read-only access to an rrd file through mmap.
+
+   Archive data is a view on the mapped file, which stays mapped for as
+   long as any such views are referenced."""
+   def __init__(self, fn):
+      self.fn = fn
+      f = open(fn, 'rb')
+      try:
+         size = os.fstat(f.fileno()).st_size
+         if (size < STAT_HEAD.size):
+            raise RRDFormatError('%r is too short to be an rrd file.' % (fn,))
+         self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+      finally:
+         f.close()
+      self.parse(size)
+
+   def parse(self, size):
+      hdr = STAT_HEAD.unpack_from(self.map, 0)
+      (cookie, version, float_cookie, ds_cnt, rra_cnt, step) = hdr[:6]
+      version = cstr_get(version)
+      if ((cookie != RRD_COOKIE) or not (version in RRD_VERSIONS)):
+         raise RRDFormatError('%r is not an rrd file we understand.' %
+            (self.fn,))
+      if (float_cookie != FLOAT_COOKIE):
+         raise RRDFormatError('%r was written on an incompatible platform.'
+            % (self.fn,))
+      self.step = step
+      off = STAT_HEAD.size
+
+      self.ds_names = []
+      self.ds_types = []
+      for i in range(ds_cnt):
+         ds_def = DS_DEF.unpack_from(self.map, off)
+         self.ds_names.append(cstr_get(ds_def[0]))
+         self.ds_types.append(cstr_get(ds_def[1]))
+         off += DS_DEF.size
+
+      rra_defs = []
+      for i in range(rra_cnt):
+         rra_defs.append(RRA_DEF.unpack_from(self.map, off))
+         off += RRA_DEF.size
+
+      if (version < '0003'):
+         self.last_update = LIVE_HEAD_V1.unpack_from(self.map, off)[0]
+         off += LIVE_HEAD_V1.size
+      else:
+         self.last_update = LIVE_HEAD.unpack_from(self.map, off)[0]
+         off += LIVE_HEAD.size
+      off += ds_cnt*PDP_PREP.size + rra_cnt*ds_cnt*CDP_PREP.size
+
+      cur_rows = []
+      for i in range(rra_cnt):
+         cur_rows.append(RRA_PTR.unpack_from(self.map, off)[0])
+         off += RRA_PTR.size
+
+      size_expected = off + sum([r[1] for r in rra_defs])*ds_cnt*VALUE_SIZE
+      if (size != size_expected):
+         raise RRDFormatError('Size of %r is %d bytes; expected %d.' %
+            (self.fn, size, size_expected))
+
+      self.archives = []
+      for ((cf, row_cnt, pdp_cnt, xff), cur_row) in zip(
+            [r[:4] for r in rra_defs], cur_rows):
+         if (cur_row >= row_cnt):
+            raise RRDFormatError('Invalid rra pointer in %r.' % (self.fn,))
+         data = numpy.frombuffer(self.map, numpy.float64, row_cnt*ds_cnt,
+            off).reshape((row_cnt, ds_cnt))
+         off += row_cnt*ds_cnt*VALUE_SIZE
+         rra_step = pdp_cnt*step
+         end = self.last_update - self.last_update % rra_step
+         self.archives.append(RRDArchive(cstr_get(cf), pdp_cnt, xff,
+            rra_step, end, cur_row, data))
+
+   def ds_index_get(self, ds_name):
+      try:
+         return self.ds_names.index(ds_name)
+      except ValueError:
+         raise RRDFormatError('%r has no ds %r.' % (self.fn, ds_name))
+
+   def close(self):
+      """Drop our references to the mapped file; it's unmapped once no more
+         views on it are left."""
+      self.archives = []
+      self.map = None
+
+
+if (__name__ == '__main__'):
+   # Here there be self-tests, comparing our view of a freshly written file
+   # to rrdtool's.
+   import shutil
+   import tempfile
+   import rrdtool
+   tmpdir = tempfile.mkdtemp()
+   try:
+      fn = os.path.join(tmpdir, 'test.rrd')
+      t0 = 1200000000
+      rrdtool.create(fn, '-b', str(t0), '-s', '10', 'DS:a:GAUGE:30:0:U',
+         'DS:b:COUNTER:30:0:U', 'RRA:AVERAGE:0.5:1:50', 'RRA:AVERAGE:0.5:6:20',
+         'RRA:MAX:0.5:6:20')
+      # Wrap around the first rra several times, with a gap of unknowns.
+      for i in range(1, 200):
+         if (80 <= i < 90):
+            continue
+         rrdtool.update(fn, '%d:%d:%d' % (t0 + i*10, i % 17, i*i*10))
+      rrd = RRDFile(fn)
+      assert(rrd.ds_names == ['a', 'b']), rrd.ds_names
+      assert(rrd.last_update == t0 + 1990), rrd.last_update
+      for (arc, cf) in zip(rrd.archives, ('AVERAGE', 'AVERAGE', 'MAX')):
+         assert(arc.cf == cf)
+         start = arc.start_get()
+         ((f_start, f_end, f_step), names, rows) = rrdtool.fetch(fn, cf,
+            '-r', str(arc.step), '-s', str(start), '-e', str(arc.end))
+         assert(f_step == arc.step), (f_step, arc.step)
+         expected = numpy.array(rows, dtype=float).reshape((len(rows), 2))
+         (ts, values) = arc.range_get(f_start, f_start + f_step*len(rows))
+         # rrdtool may pad its result with unknowns beyond the rra's range.
+         idxs = (ts - f_start)//f_step - 1
+         assert(len(ts) == arc.row_cnt), (len(ts), arc.row_cnt)
+         assert(numpy.allclose(values, expected[idxs], equal_nan=True,
+            rtol=1e-12))
+         (older, newer) = arc.parts_get()
+         assert(numpy.shares_memory(newer, arc.data))
+      rrd.close()
+   finally:
+      shutil.rmtree(tmpdir)
+   print('=== All tests passed. ===')
@@ -17,109 +17,578 @@
 
 import logging
 import os
+import sys
+import time
+from array import array
 
+import rrdtool
 try:
    from gonium.linux.xtables import XTablesPoller
 except ImportError:
    pass
 
-from gonium.fd_management import CHILD_REACT_KILL
-
-from constants import CT_BYTES, CT_PACKETS
+from constants import CT_BYTES, CT_PACKETS, LAYOUT_PER_RULE, LAYOUT_MULTI_DS
 from rrd_fn import RRDFileNamer
+from ipset import IPSetError, IPSetReader, member_ds_get
+from rrd_creator import clone_job_run
+from rrd_writer import RRDToolShardedWriter, RRDCachedWriter, \
+   rrd_ds_names_get
+from sample_log import SampleJournal, SampleLogError, SampleLogWriter, \
+   sample_log_read
+
+# Array typecode for storing counter values, and placeholder for missing
+# samples
+try:
+   array('Q')
+except ValueError:
+   # Python 2 doesn't have 'Q'; 'L' is 64 bits on LP64 platforms.
+   SAMPLE_TC = 'L'
+else:
+   SAMPLE_TC = 'Q'
+SAMPLE_NONE = 2**(8*array(SAMPLE_TC).itemsize) - 1
 
 class RRDTrafficCounter(RRDFileNamer):
    logger = logging.getLogger('RRDTrafficCounter')
    log = logger.log
-   def __init__(self, ed, rrd_base_filename, rules2ds, chain2diriface, commit_interval):
+   # Number of ticks after which to rescan the NF table for our rules even if
+   # its layout looks unchanged
+   LAYOUT_AGE_MAX = 256
+   # Maximum number of rrd files to create for new ipset elements per commit
+   IPSET_CREATES_MAX = 16
+   def __init__(self, ed, rrd_base_filename, rules2ds, chain2diriface,
+         commit_interval, rrdcached_address=None, rrd_layout=LAYOUT_PER_RULE,
+         journal_filename=None, journal_sync_interval=16, rrdtool_children=1,
+         rrdtool_inflight_max=32, ipsets=None, rrdc=None,
+         rrdcached_timeout=None):
+      """ipsets: dict mapping names of ipsets to read element counters from
+            to (iface, dir_) to store them under
+         rrdc: RRDCreator to create rrd files for ipset elements with
+         rrdcached_timeout: maximum time to block waiting for rrdcached, in
+            seconds; defaults to RRDCachedWriter.timeout"""
       self.ed = ed
       self.rrd_base_filename = rrd_base_filename
+      self.commit_interval = commit_interval
+      self.commit_index = 0
+      self.rrd_layout = rrd_layout
+      self.ipset_template = None
+      self.ipset_creates_left = 0
+      self.rules_set(rules2ds, chain2diriface, ipsets, rrdc)
+      self.active = True
+      # Timestamps of buffered ticks
+      self.output_tss = array('L')
+      # Sample columns, aligned with output_tss. They may be shorter than
+      # output_tss, and contain SAMPLE_NONE for ticks without a sample.
+      self.output_cache = {}
+      if (rrdcached_address is None):
+         self.writer = RRDToolShardedWriter(ed, rrdtool_children,
+            loss_handler=self.writer_loss_process,
+            inflight_max=rrdtool_inflight_max)
+      else:
+         self.writer = RRDCachedWriter(rrdcached_address, rrdcached_timeout)
+      if (journal_filename is None):
+         self.journal = None
+      else:
+         self.journal = SampleJournal(journal_filename, journal_sync_interval)
+      self.journal_recover = False
+      self.capture = None
+      self.forward = None
+      self.forward_only = False
+      self.xtp = None
+      self.xtp_listener = None
+      self.metrics = None
+      self.stats = None
+      self.ts_prev = None
+   
+   def rules_set(self, rules2ds, chain2diriface, ipsets=None, rrdc=None):
+      """Set the rules and ipsets to collect data from; see __init__()."""
       self.rules2ds = rules2ds
       self.chain2diriface = chain2diriface
+      ds_l = list(set(rules2ds.values()))
+      ds_l.sort()
+      self.ds_l = ds_l
+      self.ds_set = set(ds_l)
+      self.ipsets = ipsets
+      if (ipsets):
+         self.ipset_reader = IPSetReader(ipsets.keys())
+      else:
+         self.ipset_reader = None
+      self.ipset_template_drop()
+      self.rrdc = rrdc
+      # rrd files for ipset elements known to exist
+      self.rrd_fns_known = set()
+      # Multi-DS rrd filename -> (inode, DS names or None)
+      self.rrd_ds_files = {}
+      self.layout = None
+      self.layout_heads = None
+      self.layout_rules = None
+      self.layout_len = None
+      self.layout_age = 0
+   
+   def config_update(self, rules2ds, chain2diriface, commit_interval,
+         ipsets=None, rrdc=None):
+      """Switch to a new rule set in place.
+      
+      Buffered samples are committed first, so none of them are lost for
+      series that are going away; our writer and its child processes are
+      kept."""
+      if (self.output_tss):
+         self.rrd_data_commit()
       self.commit_interval = commit_interval
       self.commit_index = 0
+      self.rules_set(rules2ds, chain2diriface, ipsets, rrdc)
+   
+   def close(self):
+      """Commit buffered samples, stop processing further ticks, and release
+         our resources.
+      
+      Our rrdtool children exit once they have written everything committed
+      so far; journal segments are still released as they do."""
+      if not (self.active):
+         return
+      self.rrd_data_commit()
+      self.active = False
+      if not (self.xtp_listener is None):
+         self.xtp_listener.close()
+         self.xtp_listener = None
+      self.xtp = None
+      self.ipset_template_drop()
+      if not (self.journal is None):
+         self.journal_rotate()
+      self.writer.close()
+      if not (self.capture is None):
+         try:
+            self.capture.close()
+         except EnvironmentError:
+            self.log(40, 'Failed to close capture: %s' % (sys.exc_info()[1],))
+         self.capture = None
+      if not (self.forward is None):
+         self.forward.close()
+      if not (self.metrics is None):
+         self.metrics.snapshot_set(self.metrics_id, ())
+   
+   @staticmethod
+   def xtp_get(ed, pollers, interval, xt_cls, tablename):
+      """Return XTablesPoller for (xt_cls, tablename, interval) from dict
+         pollers, building and adding it first if needed.
+         
+      This allows sharing one poller between all counters reading from the
+      same table at the same interval."""
+      key = (xt_cls, tablename, interval)
+      try:
+         return pollers[key]
+      except KeyError:
+         pass
+      xtp = pollers[key] = XTablesPoller(ed, interval, xt_cls(), (tablename,))
+      return xtp
+   
+   @classmethod
+   def build_with_xtp(cls, ed, xtp, *args, **kwargs):
+      self = cls(ed, *args, **kwargs)
+      self.xtp = xtp
+      if (self.journal):
+         self.journal_replay(self.journal.segments_get())
+      self.xtp_listener = xtp.em_xtentries.EventListener(self.xtp_data_process)
+      ed.Timer(ed.ts_omega, self.shutdown, self, ts_relative=False)
+      return self
+   
+   def shutdown(self):
+      """Write buffered data and remove temporary files; call on exit."""
+      self.rrd_data_commit()
+      self.ipset_template_drop()
+   
+   def stats_start(self, stats, step):
+      """Start recording metrics to Stats instance stats; step is the
+         expected time between ticks."""
+      self.stats = stats
+      self.step = step
+      # Time between poll and the start of our processing of its results
+      self.h_poll = stats.hist_get('poll_latency_seconds')
+      self.h_late = stats.hist_get('tick_lateness_seconds')
+      self.h_parse = stats.hist_get('parse_seconds')
+      self.h_queue = stats.hist_get('queue_seconds')
+      self.h_samples = stats.hist_get('samples_queued', 1)
+      self.h_commit = stats.hist_get('commit_seconds')
+      self.h_commit_size = stats.hist_get('commit_samples', 1)
+      self.h_cache_keys = stats.hist_get('output_cache_keys', 1)
+      self.writer.stats_start(stats)
+   
+   def metrics_start(self, exporter, family):
+      """Publish each tick's samples to MetricsExporter exporter, labeled with
+         address family family."""
+      self.metrics = exporter
+      self.metrics_id = exporter.source_add(family)
+   
+   def capture_start(self, fn):
+      """Start recording all collected samples to sample log fn."""
+      rdir = os.path.dirname(fn)
+      if (rdir and not os.path.exists(rdir)):
+         os.makedirs(rdir)
+      self.capture = SampleLogWriter(open(fn, 'wb'))
+   
+   def forward_start(self, fwd, local=True):
+      """Pass each tick's samples to SampleForwarder fwd; if local is False,
+         stop writing to our own rrd files and journal."""
+      self.forward = fwd
+      self.forward_only = not local
+      if (self.forward_only and self.journal):
+         self.journal.rotate()
+         self.journal = None
+   
+   def writer_loss_process(self):
+      if (self.journal):
+         self.journal_recover = True
+   
+   def journal_replay(self, fns):
+      """Write samples from closed journal segments fns to rrd files.
+      
+      Samples not newer than the last update of their target file are
+      skipped, so segments that have been partially written already can be
+      replayed safely. Samples for files that don't exist are dropped. If
+      the last update of any other target file can't be determined, the
+      segments are kept to be replayed again later."""
+      if not (fns):
+         return
+      self.log(25, 'Replaying %d journal segments.' % (len(fns),))
+      tss_saved = self.output_tss
+      cache_saved = self.output_cache
+      self.output_tss = array('L')
       self.output_cache = {}
-      self.rrd_child = None
-      self.rrd_line_cache = []
-   
-   def rrd_child_spawn(self):
-      if not (self.rrd_child is None):
-         raise StandardError('I already have an active rrd_child: %r' % self.rrd_child)
-      self.rrd_child = self.ed.ChildRunnerPopen4(('rrdtool', '-'),
-         self.child_termination_process, finish=CHILD_REACT_KILL,
-         input_handler=self.child_input_process)
-   
-   def child_input_process(self, child, fd):
-      lines = child.buffers_input[fd].split('\n')
-      child.buffers_input[fd] = lines[-1]
-      del(lines[-1])
-      idx_start = 0
-      for i in range(len(lines)):
-         line = lines[i]
-         if (line.startswith('OK')):
-            if (self.rrd_line_cache):
-               del(self.rrd_line_cache[:])
-            idx_start = i+1
-            self.log(20, 'Sucessfully executed rrd command: %r' % (line,))
+      last_updates = {}
+      fns_missing = set()
+      fns_unknown = set()
+      for fn in fns:
+         try:
+            ticks = sample_log_read(fn)
+         except (EnvironmentError, SampleLogError):
+            self.log(40, 'Failed to read journal segment %r: %s' % (fn, sys.exc_info()[1]))
+            continue
+         for (ts, samples) in ticks:
+            self.rrd_tick_start(ts)
+            for (key, val) in samples:
+               (iface, dir_, ds, ct) = key
+               fn_rrd = self.rrd_sample_fn_get(iface, dir_, ct, ds)
+               if (fn_rrd in fns_missing):
+                  continue
+               try:
+                  ts_last = last_updates[fn_rrd]
+               except KeyError:
+                  if not (os.path.exists(fn_rrd)):
+                     fns_missing.add(fn_rrd)
+                     continue
+                  ts_last = last_updates[fn_rrd] = self.writer.last_update_get(fn_rrd)
+               if (ts_last is None):
+                  fns_unknown.add(fn_rrd)
+                  continue
+               if (ts <= ts_last):
+                  continue
+               self.rrd_sample_queue(key, val)
+      
+      self.rrd_data_write()
+      self.writer.flush()
+      if (fns_missing):
+         self.log(30, 'Dropped journaled samples for %d missing rrd files, '
+            'including %r.' % (len(fns_missing), min(fns_missing)))
+      if (fns_unknown):
+         self.log(40, 'Unable to determine last update of %d rrd files, '
+            'including %r; keeping journal segments for another replay.' %
+            (len(fns_unknown), min(fns_unknown)))
+      else:
+         journal = self.journal
+         self.writer.barrier(lambda: journal.segments_release(fns))
+      self.output_tss = tss_saved
+      self.output_cache = cache_saved
+   
+   def rrd_data_commit(self):
+      if not (self.active):
+         return
+      if not (self.capture is None):
+         try:
+            self.capture.flush()
+         except EnvironmentError:
+            self.log(40, 'Failed to write to capture: %s' % (sys.exc_info()[1],))
+      if (self.journal is None):
+         self.rrd_data_write()
+         self.writer.flush()
+         return
+      
+      if (self.journal_recover):
+         # Our writer lost updates; everything not acknowledged yet needs to
+         # be rewritten. The journal holds our buffered ticks too, so they're
+         # written as part of that.
+         self.journal_recover = False
+         self.journal.rotate()
+         self.rrd_data_clear()
+         self.journal_replay(self.journal.segments_get())
+         return
+      
+      self.rrd_data_write()
+      self.writer.flush()
+      if (self.journal.rotate_due()):
+         self.journal_rotate()
+   
+   def journal_rotate(self):
+      """Close current journal segment, and release it once all updates
+         queued so far have been written."""
+      seg = self.journal.rotate()
+      if not (seg is None):
+         journal = self.journal
+         self.writer.barrier(lambda: journal.segments_release((seg,)))
+   
+   def rrd_data_write(self):
+      """Pass buffered data to our writer, and clear buffers."""
+      tss_l = ['%d' % ts for ts in self.output_tss]
+      self.ipset_creates_left = self.IPSET_CREATES_MAX
+      if (self.rrd_layout == LAYOUT_MULTI_DS):
+         self.rrd_data_commit_multi(tss_l)
+      else:
+         self.rrd_data_write_single(tss_l, self.output_cache.items())
+      self.rrd_data_clear()
+   
+   def rrd_data_clear(self):
+      """Clear buffers."""
+      del(self.output_tss[:])
+      for col in self.output_cache.values():
+         del(col[:])
+      if not (self.ipset_reader is None):
+         # Don't keep columns for ipset elements that may have gone away.
+         for key in [key for key in self.output_cache if not (key[2] in self.ds_set)]:
+            del(self.output_cache[key])
+   
+   def rrd_sample_fn_get(self, iface, dir_, ct, ds):
+      """Return name of rrd file to store samples for ds in."""
+      if (ds in self.ds_set):
+         return self.rrd_target_get(iface, dir_, ct, ds)[0]
+      # ipset element; these always get their own files.
+      return self.rrd_fn_get(iface, dir_, ct, ds)
+   
+   def rrd_file_ensure(self, fn):
+      """Create rrd file for ipset element if it doesn't exist yet; return
+         True iff it exists afterwards.
+      
+      Files are cloned from a template built on first use, and no more than
+      IPSET_CREATES_MAX of them per commit, so a burst of new elements is
+      spread over several commits; samples of elements still waiting for
+      their file are dropped."""
+      if (fn in self.rrd_fns_known):
+         return True
+      if not (os.path.exists(fn)):
+         if ((self.rrdc is None) or (self.ipset_creates_left <= 0)):
+            return False
+         self.ipset_creates_left -= 1
+         try:
+            if (self.ipset_template is None):
+               self.ipset_template = self.rrdc.template_create((self.DS_RAW,),
+                  self.output_tss[0] - 1)
+            rdir = os.path.dirname(fn)
+            if (rdir and not os.path.exists(rdir)):
+               os.makedirs(rdir)
+         except (rrdtool.error, EnvironmentError):
+            self.log(40, 'Failed to create %r: %s' % (fn, sys.exc_info()[1]))
+            return False
+         error = clone_job_run((self.ipset_template, fn))[1]
+         if not (error is None):
+            self.log(40, 'Failed to create %r: %s' % (fn, error))
+            return False
+      self.rrd_fns_known.add(fn)
+      return True
+   
+   def rrd_ds_get(self, fn):
+      """Return names of the DS of multi-DS rrd file fn in file order, or
+         None if it can't be read.
+      
+      They're read again whenever the file is replaced, e.g. by rrdmigrate
+      adding DS to it. Any of our ds missing from the file are logged once."""
+      try:
+         ino = os.stat(fn).st_ino
+      except OSError:
+         ino = None
+      entry = self.rrd_ds_files.get(fn)
+      if (entry and (entry[0] == ino)):
+         return entry[1]
+      
+      if (ino is None):
+         self.log(40, 'Missing rrd file %r; not writing its data.' % (fn,))
+         ds_names = None
+      else:
+         ds_names = rrd_ds_names_get(fn)
+      if not (ds_names is None):
+         missing = [ds for ds in self.ds_l if not (ds in ds_names)]
+         if (missing):
+            self.log(40, 'rrd file %r lacks DS %s; not writing their data. '
+               'Run rrdmigrate to add them.' % (fn, ', '.join(missing)))
+      self.rrd_ds_files[fn] = (ino, ds_names)
+      return ds_names
+   
+   def ipset_template_drop(self):
+      if (self.ipset_template is None):
+         return
+      try:
+         os.remove(self.ipset_template)
+      except OSError:
+         pass
+      self.ipset_template = None
+   
+   def rrd_data_write_single(self, tss_l, items):
+      """Write buffered data with one update per (iface, dir, ct, ds) file."""
+      for ((iface, dir_, ds, ct), col) in items:
+         vals = ['%s:%d' % sample for sample in zip(tss_l, col)
+            if (sample[1] != SAMPLE_NONE)]
+         if not (vals):
             continue
-         if (line.startswith('ERROR')):
-            error_lines = self.rrd_line_cache + lines[idx_start:i+1]
-            self.log(38, 'rrdtool error: %r' % '\n'.join(error_lines))
-            idx_start = i+1
-            if (self.rrd_line_cache):
-               del(self.rrd_line_cache[:])
+         fn = self.rrd_fn_get(iface, dir_, ct, ds)
+         if (not (ds in self.ds_set)) and (not self.rrd_file_ensure(fn)):
             continue
-         if (line.startswith('For more information read the RRD manpages')):
-            self.log(40, 'Noticed rrdtool syntax error!')
+         self.writer.update(fn, self.DS_RAW, vals)
+   
+   def rrd_data_commit_multi(self, tss_l):
+      """Write buffered data with one update per (iface, dir, ct) file,
+         containing all of its DS."""
+      files = {}
+      items_single = []
+      for ((iface, dir_, ds, ct), col) in self.output_cache.items():
+         if not (ds in self.ds_set):
+            items_single.append(((iface, dir_, ds, ct), col))
+            continue
+         fn = self.rrd_fn_multi_get(iface, dir_, ct)
+         try:
+            files[fn][ds] = col
+         except KeyError:
+            files[fn] = {ds: col}
       
-      self.rrd_line_cache.extend(lines[idx_start:])
+      # rrdcached doesn't do templates, so always update all DS of the file,
+      # in order; those we don't have data for are left unknown.
+      for (fn, ds2col) in files.items():
+         ds_names = self.rrd_ds_get(fn)
+         if (ds_names is None):
+            continue
+         template = ':'.join(ds_names)
+         cols = [ds2col.get(ds, ()) for ds in ds_names]
+         vals = []
+         for i in range(len(tss_l)):
+            row = [tss_l[i]]
+            valid = False
+            for col in cols:
+               if ((i < len(col)) and (col[i] != SAMPLE_NONE)):
+                  row.append('%d' % col[i])
+                  valid = True
+               else:
+                  row.append('U')
+            if (valid):
+               vals.append(':'.join(row))
+         if (vals):
+            self.writer.update(fn, template, vals)
+      self.rrd_data_write_single(tss_l, items_single)
    
-   def child_termination_process(self, child, return_code, exit_status):
-      self.log(26, '%r notes termination of rrdtool child process RC: %r ES:'
-         '%r output: %r.' % (self,return_code, exit_status))
-      self.rrd_child = None
-      self.rrd_line_cache = []
+   def rrd_tick_start(self, ts):
+      """Start buffering samples for a new tick with timestamp ts."""
+      self.output_tss.append(int(ts))
    
-   def rrdfiles_update(self, fn, val_seq):
-      if (self.rrd_child is None):
-         self.rrd_child_spawn()
+   def rrd_tick_end(self):
+      """Finish current tick, journaling, recording and publishing its
+         samples if configured to, and commit buffered data if it's time to.
+      
+      Returns True iff data was committed."""
+      if not ((self.journal is None) and (self.capture is None) and
+            (self.forward is None) and (self.metrics is None)):
+         tick_count = len(self.output_tss)
+         samples = [(key, col[-1]) for (key, col) in self.output_cache.items()
+            if (len(col) == tick_count)]
+         ts = self.output_tss[-1]
+         for (out, name) in ((self.journal, 'journal'), (self.capture, 'capture'),
+               (self.forward, 'forward')):
+            if (out is None):
+               continue
+            try:
+               out.tick_write(ts, samples)
+            except EnvironmentError:
+               self.log(40, 'Failed to write to %s: %s' % (name, sys.exc_info()[1]))
+         if not (self.metrics is None):
+            self.metrics.snapshot_set(self.metrics_id, samples)
       
-      # Using full python string escape sequences isn't *exactly* correct, but
-      # as long as people don't try to deliberately mess up their own setup,
-      # it shouldn't cause any problems.
-      self.rrd_child.send_data('update %r -t %r %s\n' % (fn, self.DS_RAW,
-         ' '.join('%s:%s' % (tss, val) for (tss,val) in val_seq)))
+      if (self.forward_only):
+         self.rrd_data_clear()
+         return False
+      
+      self.commit_index = (self.commit_index + 1) % self.commit_interval
+      if (self.commit_index):
+         return False
+      if (self.stats is None):
+         self.rrd_data_commit()
+         return True
+      
+      self.h_commit_size.add(len(self.output_tss)*len(self.output_cache))
+      self.h_cache_keys.add(len(self.output_cache))
+      ts_start = time.time()
+      self.rrd_data_commit()
+      self.h_commit.add(time.time() - ts_start)
+      return True
    
-   @classmethod
-   def build_with_xtp(cls, ed, interval, xt, tables, *args, **kwargs):
-      xtp = XTablesPoller(ed, interval, xt, tables)
-      self = cls(ed, *args, **kwargs)
-      self.xtp = xtp
-      xtp.em_xtentries.EventListener(self.xtp_data_process)
-      # Write buffered data on shutdown
-      ed.Timer(ed.ts_omega, self.rrd_data_commit, self, ts_relative=False)
+   def rrd_tick_replay(self, ts, samples):
+      """Process one tick of recorded samples; see rrd_tick_end() for return
+         value."""
+      self.rrd_tick_start(ts)
+      for (key, val) in samples:
+         self.rrd_sample_queue(key, val)
+      return self.rrd_tick_end()
    
-   def rrd_data_commit(self):
-      for ((iface, dir_, ds, ct), val_list) in self.output_cache.items():
-         target_fn = self.rrd_fn_get(iface, dir_, ct, ds)
-         self.rrdfiles_update(target_fn, val_list)
-         del(val_list[:])
+   def rrd_sample_queue(self, key, c):
+      """Buffer one sample for the current tick; key is (iface, dir_, ds,
+         ct)."""
+      tick_count = len(self.output_tss)
+      col = self.output_cache.get(key, None)
+      if (col is None):
+         col = self.output_cache[key] = array(SAMPLE_TC)
+      if (len(col) < tick_count - 1):
+         # Fill in ticks we didn't get samples for
+         col.extend(array(SAMPLE_TC, [SAMPLE_NONE]) * (tick_count - 1 - len(col)))
+      col.append(c)
    
-   def rrd_data_queue(self, iface, dir_, ds_l, tss, cbytes_l, cpackets_l):
+   def rrd_data_queue(self, iface, dir_, ds_l, cbytes_l, cpackets_l):
+      """Buffer samples for the current tick; see rrd_tick_start()."""
+      tick_count = len(self.output_tss)
       for (ds, bc, pc) in zip(ds_l, cbytes_l, cpackets_l):
          for (c, ct) in ((bc, CT_BYTES), (pc, CT_PACKETS)):
-            val_list = self.output_cache.get((iface, dir_, ds, ct),None)
-            if (val_list is None):
-               val_list = self.output_cache[(iface, dir_, ds, ct)] = []
-            val_list.append((tss, c))
+            col = self.output_cache.get((iface, dir_, ds, ct),None)
+            if (col is None):
+               col = self.output_cache[(iface, dir_, ds, ct)] = array(SAMPLE_TC)
+            if (len(col) < tick_count - 1):
+               # Fill in ticks we didn't get samples for
+               col.extend(array(SAMPLE_TC, [SAMPLE_NONE]) * (tick_count - 1 - len(col)))
+            col.append(c)
+   
+   def ipset_data_queue(self):
+      """Buffer samples for the current tick from our ipsets' element
+         counters."""
+      try:
+         data = self.ipset_reader.read()
+      except (IPSetError, EnvironmentError):
+         self.log(40, 'Failed to read ipset counters: %s' % (sys.exc_info()[1],))
+         return
+      for (setname, elems) in data.items():
+         (iface, dir_) = self.ipsets[setname]
+         for (member, cbytes, cpackets) in elems:
+            ds = member_ds_get(setname, member)
+            self.rrd_sample_queue((iface, dir_, ds, CT_BYTES), cbytes)
+            self.rrd_sample_queue((iface, dir_, ds, CT_PACKETS), cpackets)
+   
+   def xtp_layout_build(self, entries):
+      """Locate our counting rules in sequence of NF table entries.
       
-   def xtp_data_process(self, event_listener, xtgec):
+      Sets self.layout to a sequence of (iface, dir_, ds_l, positions, extra)
+      tuples, self.layout_heads to the (position, name) of each of our
+      chains, and self.layout_rules to the (position, comment) of each
+      counting rule we found. Several chains can map to the same (iface,
+      dir_), and a ds can have several counting rules among them; positions
+      holds the first rule for each ds, and extra (ds index, position) pairs
+      for any further ones, whose counters are added to those of the first."""
+      layout = []
+      diriface2layout = {}
+      heads = []
+      rules = []
       chain_valid = False
-      tss = str(int(xtgec.ts_get()))
-      for rule in xtgec.xtge.entries:
+      for i in range(len(entries)):
+         rule = entries[i]
          if (rule.get_target_str() == 'ERROR'):
-            if ((chain_valid is True) and ds_l):
-               self.rrd_data_queue(iface, dir_, ds_l, tss, cbytes_l, cpackets_l)
             chain = rule.get_chain_name()
             try:
                (iface, dir_) = self.chain2diriface[chain]
@@ -127,9 +596,13 @@ class RRDTrafficCounter(RRDFileNamer):
                chain_valid = False
                continue
             chain_valid = True
-            ds_l = []
-            cbytes_l = []
-            cpackets_l = []
+            heads.append((i, chain))
+            try:
+               (ds2idx, ds_l, positions, extra) = diriface2layout[(iface, dir_)]
+            except KeyError:
+               (ds2idx, ds_l, positions, extra) = \
+                  diriface2layout[(iface, dir_)] = ({}, [], [], [])
+               layout.append((iface, dir_, ds_l, positions, extra))
          
          if (chain_valid is False):
             # Not a teucrium counting chain
@@ -144,19 +617,106 @@ class RRDTrafficCounter(RRDFileNamer):
          if (match.name != 'comment'):
             continue
 
+         comment = match.data_get_str()
          try:
-            ds = self.rules2ds[match.data_get_str()]
+            ds = self.rules2ds[comment]
          except KeyError:
             continue
          
+         rules.append((i, comment))
+         j = ds2idx.get(ds)
+         if not (j is None):
+            extra.append((j, i))
+            continue
+         ds2idx[ds] = len(ds_l)
          ds_l.append(ds)
-         cbytes_l.append(rule.counter_bytes)
-         cpackets_l.append(rule.counter_packets)
+         positions.append(i)
+      
+      self.layout = [l for l in layout if l[2]]
+      self.layout_heads = heads
+      self.layout_rules = rules
+      self.layout_len = len(entries)
+      self.layout_age = 0
+      self.log(20, 'Found %d counting rules in %d chains among %d NF table entries.'
+         % (sum([len(l[3]) + len(l[4]) for l in self.layout]), len(heads),
+         len(entries)))
+   
+   def xtp_layout_valid(self, entries):
+      """Cheaply check whether our layout index still matches entries.
+      
+      Besides the chain heads, this compares the comment of each indexed
+      counting rule, so rules that have been reordered or replaced in place
+      (as by deleting and inserting them) are noticed immediately."""
+      if ((self.layout is None) or (len(entries) != self.layout_len) or
+         (self.layout_age >= self.LAYOUT_AGE_MAX)):
+         return False
+      for (i, chain) in self.layout_heads:
+         rule = entries[i]
+         if ((rule.get_target_str() != 'ERROR') or
+             (rule.get_chain_name() != chain)):
+            return False
+      for (i, comment) in self.layout_rules:
+         try:
+            match = entries[i].matches[0]
+         except IndexError:
+            return False
+         if ((match.name != 'comment') or (match.data_get_str() != comment)):
+            return False
+      return True
+   
+   @staticmethod
+   def xtp_counters_get(entries, positions, extra):
+      """Return (bytes, packets) counter lists for one layout element."""
+      rules = [entries[i] for i in positions]
+      cbytes_l = [rule.counter_bytes for rule in rules]
+      cpackets_l = [rule.counter_packets for rule in rules]
+      for (j, i) in extra:
+         rule = entries[i]
+         cbytes_l[j] += rule.counter_bytes
+         cpackets_l[j] += rule.counter_packets
+      return (cbytes_l, cpackets_l)
+   
+   def xtp_data_process(self, event_listener, xtgec):
+      if not (self.active):
+         return
+      if not (getattr(xtgec.xtge, 'valid', True)):
+         # Counters couldn't be read this time; an empty table would make
+         # us rebuild our layout and write nothing, so skip the tick instead.
+         return
+      ts = xtgec.ts_get()
+      if not (self.stats is None):
+         ts_start = time.time()
+         self.h_poll.add(max(ts_start - ts, 0))
+         if not (self.ts_prev is None):
+            self.h_late.add(max(ts - self.ts_prev - self.step, 0))
+         self.ts_prev = ts
       
-      if ((chain_valid is True) and ds_l):
-         self.rrd_data_queue(iface, dir_, ds_l, tss, cbytes_l, cpackets_l)
+      self.rrd_tick_start(ts)
+      entries = xtgec.xtge.entries
+      if (self.xtp_layout_valid(entries)):
+         self.layout_age += 1
+      else:
+         self.xtp_layout_build(entries)
       
-      self.commit_index = (self.commit_index + 1) % self.commit_interval
-      if (not self.commit_index):
-         self.rrd_data_commit()
-
+      if (self.stats is None):
+         for (iface, dir_, ds_l, positions, extra) in self.layout:
+            (cbytes_l, cpackets_l) = self.xtp_counters_get(entries, positions,
+               extra)
+            self.rrd_data_queue(iface, dir_, ds_l, cbytes_l, cpackets_l)
+      else:
+         data = []
+         for (iface, dir_, ds_l, positions, extra) in self.layout:
+            (cbytes_l, cpackets_l) = self.xtp_counters_get(entries, positions,
+               extra)
+            data.append((iface, dir_, ds_l, cbytes_l, cpackets_l))
+         ts_parsed = time.time()
+         self.h_parse.add(ts_parsed - ts_start)
+         samples = 0
+         for args in data:
+            self.rrd_data_queue(*args)
+            samples += 2*len(args[2])
+         self.h_queue.add(time.time() - ts_parsed)
+         self.h_samples.add(samples)
+      if not (self.ipset_reader is None):
+         self.ipset_data_queue()
+      self.rrd_tick_end()
@@ -0,0 +1,633 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Classes for writing data to rrd files
+
+import logging
+import os.path
+import socket
+import sys
+import time
+import zlib
+from collections import deque
+
+import rrdtool
+from gonium.fd_management import CHILD_REACT_KILL
+
+
+def rrd_last_get(fn):
+   """Return time of last update of rrd file fn, or None if it can't be read."""
+   try:
+      return rrdtool.last(fn)
+   except rrdtool.error:
+      logging.getLogger('rrd_writer').log(30,
+         'Failed to read last update time of %r: %s' % (fn, sys.exc_info()[1]))
+      return None
+
+
+def rrd_ds_names_get(fn):
+   """Return names of the DS of rrd file fn in file order, or None if it
+      can't be read."""
+   try:
+      info = rrdtool.info(fn)
+   except rrdtool.error:
+      logging.getLogger('rrd_writer').log(30,
+         'Failed to read DS of %r: %s' % (fn, sys.exc_info()[1]))
+      return None
+   if ('ds' in info):
+      # Older bindings return nested dicts.
+      ds_l = [(ds_info['index'], name) for (name, ds_info) in
+         info['ds'].items()]
+   else:
+      ds_l = [(val, key[3:-len('].index')]) for (key, val) in info.items()
+         if (key.startswith('ds[') and key.endswith('].index'))]
+   ds_l.sort()
+   return [name for (idx, name) in ds_l]
+
+
+class RRDToolWriter:
+   """Write rrd updates through a 'rrdtool -' child process.
+
+   At most inflight_max update commands are kept unacknowledged by the child
+   at any time; further updates are held back, with updates to the same file
+   coalesced into one command, until the child catches up."""
+   logger = logging.getLogger('RRDToolWriter')
+   log = logger.log
+   # Maximum number of values to pass in a single update command
+   vals_per_cmd = 256
+   # Maximum delay before respawning a child that keeps dying, in seconds
+   respawn_delay_max = 64
+   def __init__(self, ed, loss_handler=None, inflight_max=32, pending_max=65536):
+      """loss_handler: callable to call when our child dies while some
+            updates are still unacknowledged
+         inflight_max: maximum number of unacknowledged update commands
+         pending_max: maximum number of values to hold back"""
+      self.ed = ed
+      self.rrd_child = None
+      self.rrd_line_cache = []
+      self.loss_handler = loss_handler
+      self.inflight_max = inflight_max
+      self.pending_max = pending_max
+      # (fn, template) -> list of vals, in order of first update
+      self.pending = {}
+      self.pending_order = []
+      self.pending_count = 0
+      self.barriers_pending = []
+      self.barriers_reset()
+      self.stats = None
+      # Send times of unacknowledged commands; only kept with stats enabled
+      self.cmd_tss = deque()
+      self.respawn_delay = 0
+      self.respawn_waiting = False
+      self.closing = False
+
+   def stats_start(self, stats):
+      """Start recording metrics to Stats instance stats."""
+      self.stats = stats
+      self.h_rtt = stats.hist_get('rrdtool_rtt_seconds')
+      self.h_cmd_vals = stats.hist_get('rrdtool_cmd_values', 1)
+
+   def barriers_reset(self):
+      self.cmds_sent = 0
+      self.cmds_done = 0
+      self.barriers = []
+
+   def barrier(self, callback):
+      """Call callback once all updates queued so far have been processed."""
+      if (self.pending):
+         self.barriers_pending.append(callback)
+         return
+      if (self.cmds_done >= self.cmds_sent):
+         callback()
+         return
+      self.barriers.append((self.cmds_sent, callback))
+
+   def barriers_check(self):
+      while (self.barriers and (self.barriers[0][0] <= self.cmds_done)):
+         callback = self.barriers.pop(0)[1]
+         callback()
+
+   def inflight_get(self):
+      """Return number of unacknowledged update commands."""
+      return self.cmds_sent - self.cmds_done
+
+   def rrd_child_spawn(self):
+      if not (self.rrd_child is None):
+         raise StandardError('I already have an active rrd_child: %r' % self.rrd_child)
+      self.rrd_child = self.ed.ChildRunnerPopen4(('rrdtool', '-'),
+         self.child_termination_process, finish=CHILD_REACT_KILL,
+         input_handler=self.child_input_process)
+
+   def child_input_process(self, child, fd):
+      lines = child.buffers_input[fd].split('\n')
+      child.buffers_input[fd] = lines[-1]
+      del(lines[-1])
+      idx_start = 0
+      for i in range(len(lines)):
+         line = lines[i]
+         if (line.startswith('OK')):
+            if (self.rrd_line_cache):
+               del(self.rrd_line_cache[:])
+            idx_start = i+1
+            self.respawn_delay = 0
+            self.reply_note('rrdtool_ok')
+            self.log(20, 'Sucessfully executed rrd command: %r' % (line,))
+            continue
+         if (line.startswith('ERROR')):
+            error_lines = self.rrd_line_cache + lines[idx_start:i+1]
+            self.log(38, 'rrdtool error: %r' % '\n'.join(error_lines))
+            idx_start = i+1
+            self.reply_note('rrdtool_error')
+            if (self.rrd_line_cache):
+               del(self.rrd_line_cache[:])
+            continue
+         if (line.startswith('For more information read the RRD manpages')):
+            self.log(40, 'Noticed rrdtool syntax error!')
+
+      self.rrd_line_cache.extend(lines[idx_start:])
+      self.pending_send()
+      self.barriers_check()
+
+   def reply_note(self, counter_name):
+      self.cmds_done += 1
+      if (self.stats is None):
+         return
+      self.stats.count(counter_name)
+      if (self.cmd_tss):
+         self.h_rtt.add(time.time() - self.cmd_tss.popleft())
+
+   def child_termination_process(self, child, return_code, exit_status):
+      self.log(26, '%r notes termination of rrdtool child process RC: %r ES:'
+         '%r.' % (self,return_code, exit_status))
+      self.rrd_child = None
+      self.rrd_line_cache = []
+      lost = (self.cmds_done < self.cmds_sent)
+      self.barriers_reset()
+      self.cmd_tss.clear()
+      if (lost and self.loss_handler):
+         self.log(30, 'rrdtool child died with unacknowledged updates.')
+         self.loss_handler()
+      # Respawn to write held back updates, if any; if children keep dying
+      # without getting anything done, wait a while before each new one.
+      if (self.respawn_delay):
+         self.log(30, 'Waiting %d seconds before respawning rrdtool child.'
+            % (self.respawn_delay,))
+         self.respawn_waiting = True
+         self.ed.Timer(self.respawn_delay, self.respawn_timer_process, self)
+      self.respawn_delay = min(max(self.respawn_delay*2, 1),
+         self.respawn_delay_max)
+      self.pending_send()
+      if (self.closing):
+         self.barrier(self.child_quit)
+
+   def respawn_timer_process(self):
+      self.respawn_waiting = False
+      self.pending_send()
+
+   def cmd_send(self, fn, template, vals):
+      if (self.rrd_child is None):
+         self.rrd_child_spawn()
+
+      # Using full python string escape sequences isn't *exactly* correct, but
+      # as long as people don't try to deliberately mess up their own setup,
+      # it shouldn't cause any problems.
+      self.rrd_child.send_data('update %r -t %r %s\n' % (fn, template,
+         ' '.join(vals)))
+      self.cmds_sent += 1
+      if not (self.stats is None):
+         self.cmd_tss.append(time.time())
+         self.h_cmd_vals.add(len(vals))
+
+   def pending_send(self):
+      """Send held back updates, as far as our in-flight limit allows."""
+      if (self.respawn_waiting):
+         return
+      while (self.pending_order and (self.inflight_get() < self.inflight_max)):
+         key = self.pending_order.pop(0)
+         vals = self.pending.pop(key)
+         self.pending_count -= len(vals)
+         (fn, template) = key
+         for i in range(0, len(vals), self.vals_per_cmd):
+            self.cmd_send(fn, template, vals[i:i+self.vals_per_cmd])
+
+      if (self.barriers_pending and not self.pending):
+         for callback in self.barriers_pending:
+            self.barriers.append((self.cmds_sent, callback))
+         self.barriers_pending = []
+         self.barriers_check()
+
+   def pending_trim(self):
+      """Discard oldest held back values beyond pending_max.
+
+      This doesn't count as a loss: newer values for the same files stay
+      queued, and once those are written rrdtool would reject the discarded
+      ones anyway, so replaying them would only add to the backlog."""
+      excess = self.pending_count - self.pending_max
+      if (excess <= 0):
+         return
+      self.log(40, 'rrdtool child is not keeping up; discarding %d held back'
+         ' values.' % (excess,))
+      for key in self.pending_order:
+         vals = self.pending[key]
+         # Remove proportionally from each file, rounding up.
+         count = min(len(vals), (len(vals)*excess + self.pending_count - 1)
+            // self.pending_count)
+         del(vals[:count])
+      self.pending_order = [key for key in self.pending_order if self.pending[key]]
+      for key in list(self.pending.keys()):
+         if not (self.pending[key]):
+            del(self.pending[key])
+      self.pending_count = sum([len(vals) for vals in self.pending.values()])
+      if not (self.stats is None):
+         self.stats.count('rrdtool_values_discarded', excess)
+
+   def update(self, fn, template, vals):
+      """Queue update of rrd file fn.
+
+      template: rrdupdate template string, e.g. 'ds0:ds1'
+      vals: sequence of rrdupdate value strings, e.g. '1230000000:42:23'"""
+      key = (fn, template)
+      if (key in self.pending):
+         self.pending[key].extend(vals)
+      elif ((self.inflight_get() < self.inflight_max) and
+            not self.respawn_waiting):
+         for i in range(0, len(vals), self.vals_per_cmd):
+            self.cmd_send(fn, template, vals[i:i+self.vals_per_cmd])
+         return
+      else:
+         self.pending[key] = list(vals)
+         self.pending_order.append(key)
+      self.pending_count += len(vals)
+      self.pending_trim()
+
+   def flush(self):
+      """Push out all queued updates."""
+      pass
+
+   def close(self):
+      """Let our child exit once all queued updates have been processed."""
+      self.closing = True
+      self.barrier(self.child_quit)
+
+   def child_quit(self):
+      if not (self.rrd_child is None):
+         self.rrd_child.send_data('quit\n')
+
+   def last_update_get(self, fn):
+      """Return time of last update written to rrd file fn or held back for
+         it, or None if it can't be determined."""
+      rv = rrd_last_get(fn)
+      if (rv is None):
+         return None
+      for ((fn_p, template), vals) in self.pending.items():
+         if ((fn_p == fn) and vals):
+            rv = max(rv, int(vals[-1].split(':', 1)[0]))
+      return rv
+
+
+class RRDToolShardedWriter:
+   """Write rrd updates through several 'rrdtool -' child processes.
+
+   Each rrd file is always written through the same child, chosen by a hash
+   of its filename, so updates to one file stay ordered."""
+   def __init__(self, ed, children=1, loss_handler=None, **kwargs):
+      """children: number of rrdtool children to use
+
+      Other arguments are passed on to RRDToolWriter."""
+      self.shards = []
+      for i in range(children):
+         self.shards.append(RRDToolWriter(ed, loss_handler=loss_handler, **kwargs))
+
+   def shard_get(self, fn):
+      return self.shards[(zlib.crc32(fn) & 0xffffffff) % len(self.shards)]
+
+   def update(self, fn, template, vals):
+      """Queue update of rrd file fn. See RRDToolWriter.update()."""
+      self.shard_get(fn).update(fn, template, vals)
+
+   def flush(self):
+      for shard in self.shards:
+         shard.flush()
+
+   def stats_start(self, stats):
+      for shard in self.shards:
+         shard.stats_start(stats)
+
+   def close(self):
+      for shard in self.shards:
+         shard.close()
+
+   def barrier(self, callback):
+      """Call callback once all updates queued so far have been processed by
+         all children."""
+      count = [len(self.shards)]
+      def shard_done():
+         count[0] -= 1
+         if (count[0] == 0):
+            callback()
+      for shard in self.shards:
+         shard.barrier(shard_done)
+
+   def last_update_get(self, fn):
+      return self.shard_get(fn).last_update_get(fn)
+
+
+class RRDCachedClient:
+   """Synchronous client for the rrdcached(1) protocol"""
+   logger = logging.getLogger('RRDCachedClient')
+   log = logger.log
+   ADDR_PFX_UNIX = 'unix:'
+   timeout = 30
+   def __init__(self, address, timeout=None):
+      """address: path of rrdcached UNIX socket, optionally prefixed with
+            'unix:'
+         timeout: maximum time to wait for rrdcached on each socket
+            operation, in seconds"""
+      if (address.startswith(self.ADDR_PFX_UNIX)):
+         address = address[len(self.ADDR_PFX_UNIX):]
+      self.address = address
+      if not (timeout is None):
+         self.timeout = timeout
+      self.sock = None
+      self.sock_file = None
+
+   def rrdtool_address_get(self):
+      """Return address in the format expected by rrdtool's --daemon option"""
+      return self.ADDR_PFX_UNIX + self.address
+
+   @staticmethod
+   def fn_get(fn):
+      # rrdcached interprets relative filenames relative to its own base
+      # directory, not ours.
+      return os.path.abspath(fn)
+
+   def connect(self):
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      sock.settimeout(self.timeout)
+      try:
+         sock.connect(self.address)
+      except:
+         sock.close()
+         raise
+      self.sock = sock
+      self.sock_file = sock.makefile('rb')
+
+   def close(self):
+      if not (self.sock is None):
+         self.sock_file.close()
+         self.sock.close()
+      self.sock = None
+      self.sock_file = None
+
+   def response_read(self):
+      """Read response; return (status, message, extra lines)"""
+      line = self.sock_file.readline()
+      if not (line.endswith('\n')):
+         raise EnvironmentError('Connection to rrdcached at %r lost.' % (self.address,))
+      (status, msg) = (line.rstrip('\n').split(' ', 1) + [''])[:2]
+      status = int(status)
+      extra = []
+      for i in range(max(status, 0)):
+         extra.append(self.sock_file.readline().rstrip('\n'))
+      return (status, msg, extra)
+
+   def commands_send(self, lines, batch=False):
+      """Send commands and return responses.
+
+      In batch mode, a single (status, message, error lines) triple is
+      returned for all lines."""
+      if (self.sock is None):
+         self.connect()
+      try:
+         if (batch):
+            self.sock.sendall('BATCH\n%s\n.\n' % ('\n'.join(lines),))
+            (status, msg, extra) = self.response_read()
+            if (status != 0):
+               raise EnvironmentError('rrdcached refused BATCH: %r' % (msg,))
+            return self.response_read()
+
+         self.sock.sendall(''.join([line + '\n' for line in lines]))
+         return [self.response_read() for line in lines]
+      except (EnvironmentError, ValueError):
+         self.close()
+         raise
+
+   def command_send(self, line):
+      return self.commands_send((line,))[0]
+
+   def forget(self, fn):
+      """Drop any cached updates for file fn."""
+      (status, msg, extra) = self.command_send('FORGET %s' % (self.fn_get(fn),))
+      # -ENOENT just means there's nothing cached for this file.
+      if ((status < 0) and (status != -2)):
+         self.log(30, 'rrdcached FORGET %r failed: %r' % (fn, msg))
+
+
+class RRDCachedWriter(RRDCachedClient):
+   """Write rrd updates through rrdcached, sending one BATCH per commit.
+
+   This runs in the event loop, so we wait for rrdcached for no more than
+   a few seconds, and after a failure don't contact it again for
+   retry_interval seconds; updates are held back meanwhile."""
+   logger = logging.getLogger('RRDCachedWriter')
+   log = logger.log
+   timeout = 2
+   retry_interval = 10
+   # Maximum number of update lines to keep around while rrdcached is
+   # unreachable.
+   pending_max = 65536
+   def __init__(self, *args, **kwargs):
+      RRDCachedClient.__init__(self, *args, **kwargs)
+      self.pending = []
+      self.barriers = []
+      self.stats = None
+      self.ts_retry = 0
+
+   def failure_note(self):
+      self.ts_retry = time.time() + self.retry_interval
+
+   def stats_start(self, stats):
+      """Start recording metrics to Stats instance stats."""
+      self.stats = stats
+      self.h_batch = stats.hist_get('rrdcached_batch_seconds')
+      self.h_batch_lines = stats.hist_get('rrdcached_batch_lines', 1)
+
+   def barrier(self, callback):
+      """Call callback once all updates queued so far have been accepted by
+         rrdcached."""
+      if not (self.pending):
+         callback()
+         return
+      self.barriers.append(callback)
+
+   def last_update_get(self, fn):
+      """Return time of last update written to rrd file fn, or None if it
+         can't be determined."""
+      if (time.time() < self.ts_retry):
+         self.log(30, 'Not asking rrdcached to FLUSH %r after recent failure.'
+            % (fn,))
+         return rrd_last_get(fn)
+      try:
+         self.command_send('FLUSH %s' % (self.fn_get(fn),))
+      except (EnvironmentError, ValueError):
+         self.log(30, 'Failed to FLUSH %r: %s' % (fn, sys.exc_info()[1]))
+         self.failure_note()
+      return rrd_last_get(fn)
+
+   def update(self, fn, template, vals):
+      """Queue update of rrd file fn. See RRDToolWriter.update().
+
+      rrdcached doesn't support templates; vals need to cover all DS of fn,
+      in order."""
+      self.pending.append('UPDATE %s %s' % (self.fn_get(fn), ' '.join(vals)))
+
+   def flush(self):
+      """Send all queued updates as a single BATCH."""
+      if not (self.pending):
+         return
+      ts_start = time.time()
+      if (ts_start < self.ts_retry):
+         self.pending_trim()
+         return
+      try:
+         (errors, msg, error_lines) = self.commands_send(self.pending, batch=True)
+      except (EnvironmentError, ValueError):
+         self.log(40, 'Failed to write %d updates to rrdcached at %r: %s' %
+            (len(self.pending), self.address, sys.exc_info()[1]))
+         self.failure_note()
+         self.pending_trim()
+         return
+
+      self.log(20, 'Sucessfully sent %d updates to rrdcached.' % (len(self.pending),))
+      if not (self.stats is None):
+         self.h_batch.add(time.time() - ts_start)
+         self.h_batch_lines.add(len(self.pending))
+         self.stats.count('rrdcached_error', len(error_lines))
+      for line in error_lines:
+         self.log(38, 'rrdcached error: %r' % (line,))
+      del(self.pending[:])
+      barriers = self.barriers
+      self.barriers = []
+      for callback in barriers:
+         callback()
+
+   def pending_trim(self):
+      excess = len(self.pending) - self.pending_max
+      if (excess > 0):
+         self.log(40, 'Discarding %d oldest updates.' % (excess,))
+         del(self.pending[:excess])
+
+
+if (__name__ == '__main__'):
+   # Here there be self-tests, against a fake rrdcached.
+   import shutil
+   import tempfile
+   import threading
+   tmpdir = tempfile.mkdtemp()
+   sock_fn = os.path.join(tmpdir, 'rrdcached.sock')
+   s_listen = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+   s_listen.bind(sock_fn)
+   s_listen.listen(4)
+   received = []
+   connections = []
+   stall = threading.Event()
+   unstall = threading.Event()
+   def conn_serve(sock):
+      f = sock.makefile('rb')
+      while (True):
+         line = f.readline()
+         if not (line):
+            break
+         line = line.rstrip('\n')
+         if (stall.isSet()):
+            unstall.wait()
+            break
+         if (line.startswith('FLUSH ')):
+            sock.sendall('0 Successfully flushed %s.\n' % (line[6:],))
+            continue
+         assert(line == 'BATCH'), line
+         sock.sendall('0 Go ahead.  End with dot \'.\' on its own line.\n')
+         lines = []
+         while (True):
+            line = f.readline().rstrip('\n')
+            if (line == '.'):
+               break
+            lines.append(line)
+         received.extend(lines)
+         errors = ['%d bad timestamp' % (i+1,) for i in range(len(lines))
+            if (lines[i].endswith(' bad'))]
+         sock.sendall(''.join(['%d errors\n' % (len(errors),)] +
+            [e + '\n' for e in errors]))
+      f.close()
+      sock.close()
+   def acceptor():
+      while (True):
+         try:
+            sock = s_listen.accept()[0]
+         except EnvironmentError:
+            return
+         connections.append(sock)
+         thread = threading.Thread(target=conn_serve, args=(sock,))
+         thread.setDaemon(True)
+         thread.start()
+   thread = threading.Thread(target=acceptor)
+   thread.setDaemon(True)
+   thread.start()
+
+   try:
+      writer = RRDCachedWriter(sock_fn, 0.2)
+      barriers = []
+      writer.update('a.rrd', 'x', ('1:1', '2:2'))
+      writer.update('b.rrd', 'x', ('1:bad',))
+      writer.barrier(lambda: barriers.append(1))
+      assert(barriers == [])
+      writer.flush()
+      assert(barriers == [1])
+      assert(received == ['UPDATE %s 1:1 2:2' % (os.path.abspath('a.rrd'),),
+         'UPDATE %s 1:bad' % (os.path.abspath('b.rrd'),)]), received
+      assert(writer.pending == [])
+
+      # A stalled rrdcached mustn't block us for longer than our timeout,
+      # nor again right away.
+      stall.set()
+      writer.update('a.rrd', 'x', ('3:3',))
+      writer.barrier(lambda: barriers.append(2))
+      ts = time.time()
+      writer.flush()
+      assert(time.time() - ts < 1), time.time() - ts
+      assert(writer.sock is None)
+      assert(len(writer.pending) == 1)
+      assert(barriers == [1])
+      conn_count = len(connections)
+      ts = time.time()
+      writer.flush()
+      writer.last_update_get('a.rrd')
+      assert(time.time() - ts < 0.1), time.time() - ts
+      assert(len(connections) == conn_count)
+      stall.clear()
+      unstall.set()
+
+      # Once the retry interval has passed, held back updates are sent.
+      writer.ts_retry = 0
+      writer.flush()
+      assert(barriers == [1, 2])
+      assert(received[-1] == 'UPDATE %s 3:3' % (os.path.abspath('a.rrd'),))
+      writer.close()
+   finally:
+      s_listen.close()
+      shutil.rmtree(tmpdir)
+   print('=== All tests passed. ===')
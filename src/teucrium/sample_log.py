@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compact binary logs of counter samples
+#
+# A sample log starts with MAGIC, followed by records:
+#  key definition: 'K', key id (L), dir (B), ct (B), len (B) + iface, len (B) + ds
+#  tick: 'T', timestamp (L), sample count (L), then count * (key id (L), value (Q))
+# Key ids are only valid within the log they're defined in. All integers are
+# in network byte order.
+
+import glob
+import logging
+import os, os.path
+import struct
+
+MAGIC = 'TEUCSL01'
+REC_KEY = 'K'
+REC_TICK = 'T'
+FMT_KEY = '!cLBB'
+FMT_TICK = '!cLL'
+FMT_SAMPLE = '!LQ'
+LEN_KEY = struct.calcsize(FMT_KEY)
+LEN_TICK = struct.calcsize(FMT_TICK)
+LEN_SAMPLE = struct.calcsize(FMT_SAMPLE)
+
+
+class SampleLogError(StandardError):
+   pass
+
+
+class SampleLogWriter:
+   """Write samples to a sample log"""
+   def __init__(self, f):
+      self.f = f
+      self.keys = {}
+      self.f.write(MAGIC)
+
+   def key_id_get(self, key, out):
+      try:
+         return self.keys[key]
+      except KeyError:
+         pass
+      (iface, dir_, ds, ct) = key
+      key_id = self.keys[key] = len(self.keys)
+      out.append(struct.pack(FMT_KEY, REC_KEY, key_id, dir_, ct))
+      for s in (iface, ds):
+         out.append(struct.pack('!B', len(s)))
+         out.append(s)
+      return key_id
+
+   def tick_write(self, ts, samples):
+      """Write one tick.
+
+      samples: sequence of ((iface, dir_, ds, ct), value) pairs"""
+      out = []
+      body = []
+      for (key, val) in samples:
+         body.append(struct.pack(FMT_SAMPLE, self.key_id_get(key, out), val))
+      out.append(struct.pack(FMT_TICK, REC_TICK, int(ts), len(body)))
+      out.extend(body)
+      self.f.write(''.join(out))
+
+   def flush(self, sync=False):
+      self.f.flush()
+      if (sync):
+         os.fsync(self.f.fileno())
+
+   def close(self):
+      self.f.close()
+
+
+class SampleLogReader:
+   """Read ticks from a sample log.
+
+   Iterating over instances yields (timestamp, [((iface, dir_, ds, ct), value),
+   ...]) tuples. A truncated record at the end of the log (e.g. from a crash
+   during writing) ends iteration silently."""
+   logger = logging.getLogger('SampleLogReader')
+   log = logger.log
+   def __init__(self, f):
+      self.f = f
+      self.keys = {}
+      self.truncated = False
+      if (f.read(len(MAGIC)) != MAGIC):
+         raise SampleLogError('%r is not a sample log.' % (f,))
+
+   def read(self, l):
+      rv = self.f.read(l)
+      if (len(rv) < l):
+         if (rv):
+            self.truncated = True
+         return None
+      return rv
+
+   def __iter__(self):
+      while (True):
+         tag = self.read(1)
+         if (tag is None):
+            return
+         if (tag == REC_KEY):
+            data = self.read(LEN_KEY - 1)
+            if (data is None):
+               return
+            (_, key_id, dir_, ct) = struct.unpack(FMT_KEY, tag + data)
+            strings = []
+            for i in range(2):
+               l = self.read(1)
+               if (l is None):
+                  return
+               s = self.read(ord(l))
+               if (s is None):
+                  return
+               strings.append(s)
+            self.keys[key_id] = (strings[0], dir_, strings[1], ct)
+            continue
+
+         if (tag != REC_TICK):
+            raise SampleLogError('Invalid record type %r in %r.' % (tag, self.f))
+         data = self.read(LEN_TICK - 1)
+         if (data is None):
+            return
+         (_, ts, count) = struct.unpack(FMT_TICK, tag + data)
+         data = self.read(count*LEN_SAMPLE)
+         if (data is None):
+            return
+         samples = []
+         for i in range(0, count*LEN_SAMPLE, LEN_SAMPLE):
+            (key_id, val) = struct.unpack(FMT_SAMPLE, data[i:i+LEN_SAMPLE])
+            samples.append((self.keys[key_id], val))
+         yield (ts, samples)
+
+
+def sample_log_read(fn):
+   """Return list of all ticks in the sample log file fn"""
+   f = open(fn, 'rb')
+   try:
+      reader = SampleLogReader(f)
+      rv = list(reader)
+      if (reader.truncated):
+         SampleLogReader.log(30, 'Ignoring truncated record at end of %r.' % (fn,))
+      return rv
+   finally:
+      f.close()
+
+
+class SampleJournal:
+   """Append-only journal of samples, split into numbered segment files.
+
+   The current segment is appended to until rotate() is called; closed
+   segments are kept until explicitly released. Callers that rotate
+   regularly can check rotate_due() to only do so once the current segment
+   holds segment_ticks ticks."""
+   logger = logging.getLogger('SampleJournal')
+   log = logger.log
+   SEG_FMT = '%s.%08d'
+   def __init__(self, base_filename, sync_interval=16, segment_ticks=256):
+      self.base_filename = base_filename
+      self.sync_interval = sync_interval
+      self.sync_count = 0
+      self.segment_ticks = segment_ticks
+      self.seg_ticks = 0
+      self.writer = None
+      self.seg_fn = None
+      seg_idxs = [int(fn[len(base_filename)+1:]) for fn in self.segments_get()]
+      self.seg_idx = max([0] + seg_idxs)
+
+   def segments_get(self):
+      """Return filenames of closed segments, oldest first"""
+      rv = []
+      for fn in glob.glob(self.base_filename + '.*'):
+         if (fn[len(self.base_filename)+1:].isdigit() and (fn != self.seg_fn)):
+            rv.append(fn)
+      rv.sort()
+      return rv
+
+   def tick_write(self, ts, samples):
+      if (self.writer is None):
+         self.seg_idx += 1
+         self.seg_fn = self.SEG_FMT % (self.base_filename, self.seg_idx)
+         rdir = os.path.dirname(self.seg_fn)
+         if (rdir and not os.path.exists(rdir)):
+            os.makedirs(rdir)
+         self.writer = SampleLogWriter(open(self.seg_fn, 'wb'))
+      self.writer.tick_write(ts, samples)
+      self.seg_ticks += 1
+      self.sync_count += 1
+      self.writer.flush(sync=(self.sync_count >= self.sync_interval))
+      if (self.sync_count >= self.sync_interval):
+         self.sync_count = 0
+
+   def rotate_due(self):
+      """Return whether the current segment holds segment_ticks ticks."""
+      return (self.seg_ticks >= self.segment_ticks)
+
+   def rotate(self):
+      """Close current segment; return its filename, or None if there is none."""
+      if (self.writer is None):
+         return None
+      self.writer.flush(sync=True)
+      self.writer.close()
+      self.writer = None
+      self.sync_count = 0
+      self.seg_ticks = 0
+      rv = self.seg_fn
+      self.seg_fn = None
+      return rv
+
+   def segments_release(self, fns):
+      """Remove closed segments whose data has been safely written."""
+      for fn in fns:
+         try:
+            os.remove(fn)
+         except OSError:
+            pass
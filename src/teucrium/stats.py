@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of teucrium.
+#
+# teucrium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# teucrium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cheap in-process metrics for the daemon
+
+import logging
+import os
+import sys
+import time
+
+
+class Histogram:
+   """Histogram with power-of-two buckets.
+
+   Bucket i counts values v with 2**(i-1) <= v/unit < 2**i; bucket 0 counts
+   values below unit."""
+   BUCKETS = 48
+   def __init__(self, unit):
+      self.unit = unit
+      self.buckets = [0]*self.BUCKETS
+      self.count = 0
+      self.total = 0
+      self.max = 0
+
+   def add(self, v):
+      self.count += 1
+      self.total += v
+      if (v > self.max):
+         self.max = v
+      i = int(v/self.unit).bit_length()
+      if (i >= self.BUCKETS):
+         i = self.BUCKETS - 1
+      self.buckets[i] += 1
+
+   def quantile_get(self, q):
+      """Return upper bound of bucket containing the q-quantile."""
+      if not (self.count):
+         return 0
+      rank = q*self.count
+      seen = 0
+      for i in range(self.BUCKETS):
+         seen += self.buckets[i]
+         if (seen >= rank):
+            return min(self.unit*(2**i), self.max)
+      return self.max
+
+   def summary_get(self):
+      if (self.count):
+         mean = float(self.total)/self.count
+      else:
+         mean = 0
+      return 'count=%d mean=%g p50<=%g p90<=%g p99<=%g max=%g' % (self.count,
+         mean, self.quantile_get(0.5), self.quantile_get(0.9),
+         self.quantile_get(0.99), self.max)
+
+
+class Stats:
+   """Named histograms and counters.
+
+   Call sites are expected to look up the Histogram instances they record
+   to once, and call their add() method directly."""
+   logger = logging.getLogger('Stats')
+   log = logger.log
+   def __init__(self):
+      self.ts_start = time.time()
+      self.hists = {}
+      self.counters = {}
+
+   def hist_get(self, name, unit=1e-6):
+      try:
+         return self.hists[name]
+      except KeyError:
+         pass
+      rv = self.hists[name] = Histogram(unit)
+      return rv
+
+   def count(self, name, n=1):
+      self.counters[name] = self.counters.get(name, 0) + n
+
+   def dump(self, f):
+      f.write('# teucrium stats; uptime %.0fs\n' % (time.time() - self.ts_start,))
+      names = list(self.counters.keys())
+      names.sort()
+      for name in names:
+         f.write('%s %d\n' % (name, self.counters[name]))
+      names = list(self.hists.keys())
+      names.sort()
+      for name in names:
+         f.write('%s %s\n' % (name, self.hists[name].summary_get()))
+
+   def dump_file(self, fn):
+      """Atomically replace fn with current stats."""
+      fn_tmp = '%s.tmp.%d' % (fn, os.getpid())
+      try:
+         f = open(fn_tmp, 'w')
+         try:
+            self.dump(f)
+         finally:
+            f.close()
+         os.rename(fn_tmp, fn)
+      except EnvironmentError:
+         self.log(40, 'Failed to write stats to %r: %s' % (fn, sys.exc_info()[1]))